@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, g, Response
 from flask_wtf import CSRFProtect
 from flask_wtf.csrf import CSRFError
 import kubernetes
@@ -9,8 +9,18 @@ import os
 import io
 import base64
 import logging
-import tempfile
+import hashlib
+import threading
+import time
+import copy
+import json
+import datetime
 from kubernetes.client.rest import ApiException
+import metrics
+import tracing
+from quantity import usage_percentage
+from user_import import import_users, detect_format
+from user_kubeconfig import KubeconfigCache, make_cluster_info, render_kubeconfig, render_token_request
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, 
@@ -26,6 +36,33 @@ PLURAL_USERS = 'users'
 # Пространство имен для пользователей
 USERS_NAMESPACE = 'users'
 
+# Файл, в который записываются span трассировки запросов (пусто - трассировка отключена)
+TRACE_FILE = os.environ.get('UI_TRACE_FILE', '')
+
+# Период полной пересинхронизации кеша команд и пользователей (в секундах)
+CACHE_RESYNC_PERIOD = int(os.environ.get('UI_CACHE_RESYNC_PERIOD', '300'))
+
+# Режим выдачи kubeconfig: configmap - kubeconfig читается из ConfigMap, который создает оператор,
+# on-demand - kubeconfig формируется при скачивании со свежим токеном и нигде не хранится
+KUBECONFIG_MODE = os.environ.get('UI_KUBECONFIG_MODE', 'configmap')
+
+# Срок действия токенов в kubeconfig, формируемых при скачивании (в секундах)
+KUBECONFIG_TOKEN_EXPIRATION = int(os.environ.get('UI_KUBECONFIG_TOKEN_EXPIRATION', '86400'))
+
+# Время жизни (в секундах) и размер кеша kubeconfig, формируемых при скачивании
+KUBECONFIG_CACHE_TTL = float(os.environ.get('UI_KUBECONFIG_CACHE_TTL', '300'))
+KUBECONFIG_CACHE_SIZE = int(os.environ.get('UI_KUBECONFIG_CACHE_SIZE', '256'))
+
+# Имя кластера в kubeconfig пользователей при работе веб-интерфейса внутри кластера
+CLUSTER_NAME = os.environ.get('UI_CLUSTER_NAME', 'kubernetes')
+
+# Максимальное количество пользователей в одном импорте через веб-интерфейс: пользователи
+# создаются внутри запроса, который не должен превышать таймаут worker (UI_TIMEOUT)
+IMPORT_MAX_ROWS = int(os.environ.get('UI_IMPORT_MAX_ROWS', '500'))
+
+# Трассировка запросов веб-интерфейса и запросов к API-серверу
+tracer = tracing.Tracer('team-operator-ui', TRACE_FILE)
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-key-for-testing')
 csrf = CSRFProtect(app)
@@ -43,10 +80,321 @@ def load_kubernetes_config():
             logger.error("Не удалось загрузить конфигурацию Kubernetes")
             raise
 
+class InstrumentedApiClient(kubernetes.client.ApiClient):
+    """ApiClient, который учитывает запросы к API-серверу в метриках"""
+
+    def request(self, method, url, *args, **kwargs):
+        resource, namespace, named = metrics.parse_api_path(url)
+        verb = metrics.get_api_verb(method, named, kwargs.get('query_params'))
+
+        # Запросы фоновых потоков кеша в трассировку не попадают: span создается только внутри запроса веб-интерфейса
+        with tracer.span(f"{verb} {resource}", root=False, verb=verb, resource=resource, namespace=namespace) as span:
+            started = time.monotonic()
+            code = 'error'
+            try:
+                response = super().request(method, url, *args, **kwargs)
+                code = getattr(response, 'status', code)
+                return response
+            except ApiException as e:
+                code = e.status
+                raise
+            finally:
+                span.set_attribute('status_code', code)
+                metrics.record_api_request('ui', verb, resource, code, time.monotonic() - started)
+
+# Общий для всего приложения API-клиент (создается после загрузки конфигурации)
+api_client = None
+api_client_lock = threading.Lock()
+
+def get_api_client():
+    """Возвращает общий API-клиент, соединения которого переиспользуются всеми запросами"""
+    global api_client
+
+    with api_client_lock:
+        if api_client is None:
+            api_client = InstrumentedApiClient()
+        return api_client
+
+class ResourceCache:
+    """Кеш объектов Kubernetes в памяти, поддерживаемый через list + watch
+
+    Объекты загружаются одним LIST-запросом, после чего кеш обновляется из
+    watch-потока начиная с полученного resourceVersion. Раз в resync_period
+    секунд список перечитывается целиком.
+
+    Обработчики, добавленные через add_handler, вызываются для каждого
+    изменения как handler(old, new): old равен None для нового объекта,
+    new равен None для удаленного.
+    """
+
+    def __init__(self, name, list_func, resync_period=CACHE_RESYNC_PERIOD, **list_kwargs):
+        self.name = name
+        self.list_func = list_func
+        self.list_kwargs = list_kwargs
+        self.resync_period = resync_period
+        self.items = {}
+        self.resource_version = None
+        self.synced = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.handlers = []
+
+    @staticmethod
+    def key(obj):
+        """Ключ объекта в кеше: namespace/имя или имя для кластерных объектов"""
+        metadata = obj.get('metadata', {})
+        if metadata.get('namespace'):
+            return f"{metadata['namespace']}/{metadata['name']}"
+        return metadata.get('name')
+
+    def add_handler(self, handler):
+        """Добавляет обработчик изменений объектов в кеше"""
+        self.handlers.append(handler)
+
+    def notify(self, old, new):
+        """Вызывает обработчики изменений (под блокировкой кеша)"""
+        for handler in self.handlers:
+            try:
+                handler(old, new)
+            except Exception as e:
+                logger.error(f"Кеш {self.name}: ошибка в обработчике изменений: {e}")
+
+    @staticmethod
+    def is_older(obj, current):
+        """Проверяет, что версия объекта obj старше версии current
+
+        resourceVersion сравниваются как числа (так их выдает etcd); версии,
+        которые не удается сравнить, старыми не считаются.
+        """
+        try:
+            return int(obj['metadata']['resourceVersion']) < int(current['metadata']['resourceVersion'])
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def set(self, key, obj):
+        """Сохраняет или удаляет объект и уведомляет обработчики (под блокировкой кеша)
+
+        Объект старее уже сохраненного (запоздавшее событие watch или ответ
+        на запись, опередивший событие) не сохраняется.
+        """
+        current = self.items.get(key)
+        if obj is not None and current is not None and self.is_older(obj, current):
+            return
+
+        old = self.items.pop(key, None) if obj is None else current
+        if obj is not None:
+            self.items[key] = obj
+        if old is not None or obj is not None:
+            self.notify(old, obj)
+
+    def start(self):
+        """Запускает фоновое поддержание кеша"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name=f"cache-{self.name}", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Останавливает фоновое поддержание кеша"""
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.relist()
+                deadline = time.monotonic() + self.resync_period
+                while not self.stopped.is_set() and time.monotonic() < deadline:
+                    self.watch(max(1, int(deadline - time.monotonic())))
+            except ApiException as e:
+                if e.status == 410:  # resourceVersion устарел - перечитываем список
+                    logger.info(f"Кеш {self.name}: resourceVersion устарел, перечитываем список")
+                    continue
+                logger.error(f"Кеш {self.name}: ошибка при синхронизации: {e}")
+                self.stopped.wait(5)
+            except Exception as e:
+                logger.error(f"Кеш {self.name}: ошибка при синхронизации: {e}")
+                self.stopped.wait(5)
+
+    def relist(self):
+        """Загружает полный список объектов"""
+        response = self.list_func(_preload_content=False, **self.list_kwargs)
+        data = json.loads(response.data)
+        items = {self.key(obj): obj for obj in data.get('items', [])}
+
+        with self.lock:
+            for key in list(self.items):
+                if key not in items:
+                    self.set(key, None)
+            for key, obj in items.items():
+                self.set(key, obj)
+            self.resource_version = data.get('metadata', {}).get('resourceVersion')
+        self.synced.set()
+        logger.info(f"Кеш {self.name}: загружено объектов: {len(items)}")
+
+    def watch(self, timeout):
+        """Применяет изменения из watch-потока"""
+        watch = kubernetes.watch.Watch()
+        for event in watch.stream(self.list_func, resource_version=self.resource_version,
+                                  timeout_seconds=timeout, allow_watch_bookmarks=True, **self.list_kwargs):
+            if self.stopped.is_set():
+                watch.stop()
+                break
+
+            obj = event['raw_object']
+            if event['type'] == 'ERROR':
+                raise ApiException(status=obj.get('code'), reason=obj.get('message'))
+
+            with self.lock:
+                if event['type'] in ('ADDED', 'MODIFIED'):
+                    self.set(self.key(obj), obj)
+                elif event['type'] == 'DELETED':
+                    # Удаление прежней версии не удаляет объект, созданный заново
+                    current = self.items.get(self.key(obj))
+                    if current is None or not self.is_older(obj, current):
+                        self.set(self.key(obj), None)
+                self.resource_version = obj.get('metadata', {}).get('resourceVersion', self.resource_version)
+
+    def store(self, obj):
+        """Сохраняет объект, записанный самим приложением, не дожидаясь watch-события"""
+        if obj and self.synced.is_set():
+            with self.lock:
+                self.set(self.key(obj), obj)
+
+    def remove(self, key):
+        """Удаляет объект, удаленный самим приложением, не дожидаясь watch-события"""
+        with self.lock:
+            self.set(key, None)
+
+    def list(self):
+        """Возвращает список объектов из кеша"""
+        with self.lock:
+            return list(self.items.values())
+
+    def get(self, key):
+        """Возвращает копию объекта из кеша или None"""
+        with self.lock:
+            obj = self.items.get(key)
+        return copy.deepcopy(obj) if obj is not None else None
+
+class DashboardStats:
+    """Статистика для главной страницы, обновляемая по изменениям в кешах
+
+    Каждый обработчик вычитает вклад старой версии объекта и добавляет вклад
+    новой, поэтому повторная доставка одного и того же события безопасна.
+    """
+
+    ROLES = ('admin', 'developer', 'viewer')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.teams_count = 0
+        self.users_count = 0
+        self.environments_count = 0
+        self.role_counts = {role: 0 for role in self.ROLES}
+        self.team_environments = {}
+        self.team_members = {}
+
+    @staticmethod
+    def spec(obj):
+        return (obj or {}).get('spec') or {}
+
+    def on_team(self, old, new):
+        """Обработчик изменения команды"""
+        with self.lock:
+            if old is not None:
+                self.teams_count -= 1
+                environments = len(self.spec(old).get('environments') or [])
+                self.environments_count -= environments
+                self.team_environments.pop(old['metadata']['name'], None)
+            if new is not None:
+                self.teams_count += 1
+                environments = len(self.spec(new).get('environments') or [])
+                self.environments_count += environments
+                self.team_environments[new['metadata']['name']] = environments
+
+    def on_user(self, old, new):
+        """Обработчик изменения пользователя"""
+        with self.lock:
+            if old is not None:
+                self.users_count -= 1
+                role = self.spec(old).get('role', 'developer')
+                if role in self.role_counts:
+                    self.role_counts[role] -= 1
+                for team_name in set(self.spec(old).get('teams') or []):
+                    self.team_members[team_name] -= 1
+                    if not self.team_members[team_name]:
+                        del self.team_members[team_name]
+            if new is not None:
+                self.users_count += 1
+                role = self.spec(new).get('role', 'developer')
+                if role in self.role_counts:
+                    self.role_counts[role] += 1
+                for team_name in set(self.spec(new).get('teams') or []):
+                    self.team_members[team_name] = self.team_members.get(team_name, 0) + 1
+
+    def snapshot(self):
+        """Возвращает текущую статистику"""
+        with self.lock:
+            return {
+                'teams_count': self.teams_count,
+                'users_count': self.users_count,
+                'environments_count': self.environments_count,
+                'admin_count': self.role_counts['admin'],
+                'developer_count': self.role_counts['developer'],
+                'viewer_count': self.role_counts['viewer'],
+                'team_environments': dict(self.team_environments),
+                'team_members': dict(self.team_members)
+            }
+
+# Кеши команд, пользователей и квот окружений и статистика по ним (создаются при запуске приложения)
+teams_cache = None
+users_cache = None
+quotas_cache = None
+kubeconfigs_cache = None
+dashboard_stats = None
+
+def start_caches():
+    """Создает и запускает кеши команд, пользователей, квот окружений и kubeconfig пользователей"""
+    global teams_cache, users_cache, quotas_cache, kubeconfigs_cache, dashboard_stats
+
+    custom_api = kubernetes.client.CustomObjectsApi(get_api_client())
+    teams_cache = ResourceCache('teams', custom_api.list_cluster_custom_object,
+                                group=GROUP, version=VERSION, plural=PLURAL_TEAMS)
+    users_cache = ResourceCache('users', custom_api.list_cluster_custom_object,
+                                group=GROUP, version=VERSION, plural=PLURAL_USERS)
+    quotas_cache = ResourceCache('quotas', kubernetes.client.CoreV1Api(get_api_client()).list_resource_quota_for_all_namespaces,
+                                 label_selector='managed-by=team-operator')
+    dashboard_stats = DashboardStats()
+    teams_cache.add_handler(dashboard_stats.on_team)
+    users_cache.add_handler(dashboard_stats.on_user)
+    users_cache.add_handler(forget_user_kubeconfig)
+    teams_cache.start()
+    users_cache.start()
+    quotas_cache.start()
+
+    # ConfigMap с kubeconfig пользователей нужны только в режиме configmap
+    if KUBECONFIG_MODE == 'configmap':
+        kubeconfigs_cache = ResourceCache('kubeconfigs', kubernetes.client.CoreV1Api(get_api_client()).list_namespaced_config_map,
+                                          namespace=USERS_NAMESPACE, label_selector='managed-by=team-operator')
+        kubeconfigs_cache.start()
+
+def stop_caches():
+    """Останавливает фоновое поддержание кешей"""
+    global teams_cache, users_cache, quotas_cache, kubeconfigs_cache
+
+    for cache in (teams_cache, users_cache, quotas_cache, kubeconfigs_cache):
+        if cache is not None:
+            cache.stop()
+    teams_cache = users_cache = quotas_cache = kubeconfigs_cache = None
+
+def cache_ready(cache):
+    """Проверяет, можно ли отвечать из кеша"""
+    return cache is not None and cache.synced.is_set()
+
 # Функция для создания пространства имен пользователей
 def ensure_users_namespace():
     """Создает пространство имен для пользователей, если оно не существует"""
-    api = kubernetes.client.CoreV1Api()
+    api = kubernetes.client.CoreV1Api(get_api_client())
     
     try:
         # Проверяем, существует ли пространство имен
@@ -79,7 +427,10 @@ def ensure_users_namespace():
 
 # Получение списка команд
 def get_teams():
-    custom_api = kubernetes.client.CustomObjectsApi()
+    if cache_ready(teams_cache):
+        return teams_cache.list()
+    
+    custom_api = kubernetes.client.CustomObjectsApi(get_api_client())
     try:
         teams = custom_api.list_cluster_custom_object(
             group=GROUP,
@@ -91,9 +442,15 @@ def get_teams():
         logger.error(f"Ошибка при получении списка команд: {e}")
         return []
 
-# Получение команды по имени
-def get_team(name):
-    custom_api = kubernetes.client.CustomObjectsApi()
+# Получение команды по имени (fresh - прочитать из API-сервера, минуя кеш)
+def get_team(name, fresh=False):
+    if not fresh and cache_ready(teams_cache):
+        team = teams_cache.get(name)
+        if team is None:
+            logger.error(f"Команда {name} не найдена")
+        return team
+    
+    custom_api = kubernetes.client.CustomObjectsApi(get_api_client())
     try:
         return custom_api.get_cluster_custom_object(
             group=GROUP,
@@ -107,50 +464,62 @@ def get_team(name):
 
 # Создание команды
 def create_team(team_data):
-    custom_api = kubernetes.client.CustomObjectsApi()
+    custom_api = kubernetes.client.CustomObjectsApi(get_api_client())
     try:
-        return custom_api.create_cluster_custom_object(
+        team = custom_api.create_cluster_custom_object(
             group=GROUP,
             version=VERSION,
             plural=PLURAL_TEAMS,
             body=team_data
         )
+        if teams_cache is not None:
+            teams_cache.store(team)
+        return team
     except ApiException as e:
         logger.error(f"Ошибка при создании команды: {e}")
         raise
 
 # Обновление команды
 def update_team(name, team_data):
-    custom_api = kubernetes.client.CustomObjectsApi()
+    custom_api = kubernetes.client.CustomObjectsApi(get_api_client())
     try:
-        return custom_api.replace_cluster_custom_object(
+        team = custom_api.replace_cluster_custom_object(
             group=GROUP,
             version=VERSION,
             plural=PLURAL_TEAMS,
             name=name,
             body=team_data
         )
+        if teams_cache is not None:
+            teams_cache.store(team)
+        return team
     except ApiException as e:
         logger.error(f"Ошибка при обновлении команды {name}: {e}")
         raise
 
 # Удаление команды
 def delete_team(name):
-    custom_api = kubernetes.client.CustomObjectsApi()
+    custom_api = kubernetes.client.CustomObjectsApi(get_api_client())
     try:
-        return custom_api.delete_cluster_custom_object(
+        result = custom_api.delete_cluster_custom_object(
             group=GROUP,
             version=VERSION,
             plural=PLURAL_TEAMS,
             name=name
         )
+        if teams_cache is not None:
+            teams_cache.remove(name)
+        return result
     except ApiException as e:
         logger.error(f"Ошибка при удалении команды {name}: {e}")
         raise
 
 # Получение списка пользователей
 def get_users():
-    custom_api = kubernetes.client.CustomObjectsApi()
+    if cache_ready(users_cache):
+        return users_cache.list()
+    
+    custom_api = kubernetes.client.CustomObjectsApi(get_api_client())
     try:
         users = custom_api.list_cluster_custom_object(
             group=GROUP,
@@ -162,9 +531,15 @@ def get_users():
         logger.error(f"Ошибка при получении списка пользователей: {e}")
         return []
 
-# Получение пользователя по имени
-def get_user(name):
-    custom_api = kubernetes.client.CustomObjectsApi()
+# Получение пользователя по имени (fresh - прочитать из API-сервера, минуя кеш)
+def get_user(name, fresh=False):
+    if not fresh and cache_ready(users_cache):
+        user = users_cache.get(name)
+        if user is None:
+            logger.error(f"Пользователь {name} не найден")
+        return user
+    
+    custom_api = kubernetes.client.CustomObjectsApi(get_api_client())
     try:
         return custom_api.get_cluster_custom_object(
             group=GROUP,
@@ -178,96 +553,271 @@ def get_user(name):
 
 # Создание пользователя
 def create_user(user_data):
-    custom_api = kubernetes.client.CustomObjectsApi()
+    custom_api = kubernetes.client.CustomObjectsApi(get_api_client())
     try:
-        return custom_api.create_cluster_custom_object(
+        user = custom_api.create_cluster_custom_object(
             group=GROUP,
             version=VERSION,
             plural=PLURAL_USERS,
             body=user_data
         )
+        if users_cache is not None:
+            users_cache.store(user)
+        return user
     except ApiException as e:
         logger.error(f"Ошибка при создании пользователя: {e}")
         raise
 
 # Обновление пользователя
 def update_user(name, user_data):
-    custom_api = kubernetes.client.CustomObjectsApi()
+    custom_api = kubernetes.client.CustomObjectsApi(get_api_client())
     try:
-        return custom_api.replace_cluster_custom_object(
+        user = custom_api.replace_cluster_custom_object(
             group=GROUP,
             version=VERSION,
             plural=PLURAL_USERS,
             name=name,
             body=user_data
         )
+        if users_cache is not None:
+            users_cache.store(user)
+        return user
     except ApiException as e:
         logger.error(f"Ошибка при обновлении пользователя {name}: {e}")
         raise
 
 # Удаление пользователя
 def delete_user(name):
-    custom_api = kubernetes.client.CustomObjectsApi()
+    custom_api = kubernetes.client.CustomObjectsApi(get_api_client())
     try:
-        return custom_api.delete_cluster_custom_object(
+        result = custom_api.delete_cluster_custom_object(
             group=GROUP,
             version=VERSION,
             plural=PLURAL_USERS,
             name=name
         )
+        if users_cache is not None:
+            users_cache.remove(name)
+        kubeconfig_cache.invalidate(name)
+        return result
     except ApiException as e:
         logger.error(f"Ошибка при удалении пользователя {name}: {e}")
         raise
 
-# Получение kubeconfig пользователя
-def get_user_kubeconfig(name):
-    api = kubernetes.client.CoreV1Api()
-    
+# Параметры подключения к кластеру для kubeconfig, формируемых при скачивании (определяются при первом скачивании)
+cluster_info = None
+cluster_info_lock = threading.Lock()
+
+# Кеш kubeconfig, формируемых при скачивании
+kubeconfig_cache = KubeconfigCache(KUBECONFIG_CACHE_TTL, KUBECONFIG_CACHE_SIZE)
+
+def forget_user_kubeconfig(old, new):
+    """Удаляет из кеша kubeconfig пользователя, удаленного из кластера (обработчик кеша пользователей)"""
+    if old is not None and new is None:
+        kubeconfig_cache.invalidate(old['metadata']['name'])
+
+def get_cluster_info():
+    """Возвращает параметры подключения к кластеру из загруженной конфигурации Kubernetes"""
+    global cluster_info
+
+    with cluster_info_lock:
+        if cluster_info is None:
+            # Вне кластера имя берется из активного контекста kubeconfig
+            try:
+                _, active_context = kubernetes.config.list_kube_config_contexts()
+                cluster_name = active_context['context']['cluster']
+            except kubernetes.config.config_exception.ConfigException:
+                cluster_name = CLUSTER_NAME
+            cluster_info = make_cluster_info(cluster_name, kubernetes.client.Configuration.get_default_copy())
+        return cluster_info
+
+def render_user_kubeconfig(name):
+    """Формирует kubeconfig пользователя со свежим токеном (режим on-demand)
+
+    Возвращает kubeconfig и его версию (хеш содержимого) или (None, None).
+    Готовый kubeconfig кешируется не дольше KUBECONFIG_CACHE_TTL секунд.
+    """
+    cached = kubeconfig_cache.get(name)
+    if cached is not None:
+        return cached
+
+    api = kubernetes.client.CoreV1Api(get_api_client())
     try:
-        config_map = api.read_namespaced_config_map(
-            name=f"{name}-kubeconfig",
-            namespace=USERS_NAMESPACE
+        token_request = api.create_namespaced_service_account_token(
+            name=name,
+            namespace=USERS_NAMESPACE,
+            body=render_token_request(KUBECONFIG_TOKEN_EXPIRATION)
         )
-        
-        if config_map.data and 'config' in config_map.data:
-            return config_map.data['config']
-        else:
-            logger.warning(f"ConfigMap {name}-kubeconfig не содержит данных конфигурации")
-            return None
-    except kubernetes.client.exceptions.ApiException as e:
+    except ApiException as e:
         if e.status == 404:  # Не найдено
-            logger.warning(f"ConfigMap {name}-kubeconfig не существует в пространстве имен {USERS_NAMESPACE}")
+            logger.warning(f"ServiceAccount {name} не существует в пространстве имен {USERS_NAMESPACE}")
         else:
-            logger.error(f"Ошибка при получении ConfigMap {name}-kubeconfig: {e}")
-        return None
+            logger.error(f"Ошибка при запросе токена для пользователя {name}: {e}")
+        return None, None
+
+    kubeconfig = yaml.dump(render_kubeconfig(name, token_request.status.token, get_cluster_info()))
+    version = hashlib.sha256(kubeconfig.encode()).hexdigest()[:32]
+
+    # Запись в кеше не переживает токен
+    expires = token_request.status.expiration_timestamp
+    lifetime = (expires - datetime.datetime.now(datetime.timezone.utc)).total_seconds() if expires else None
+    kubeconfig_cache.put(name, (kubeconfig, version), lifetime)
+    return kubeconfig, version
+
+# Получение kubeconfig пользователя
+def get_user_kubeconfig(name):
+    """Возвращает kubeconfig пользователя и его версию или (None, None)
+
+    Версия - resourceVersion ConfigMap с kubeconfig (в режиме on-demand -
+    хеш содержимого). ConfigMap берется из кеша без обращения к API-серверу.
+    """
+    if KUBECONFIG_MODE == 'on-demand':
+        return render_user_kubeconfig(name)
+
+    if cache_ready(kubeconfigs_cache):
+        config_map = kubeconfigs_cache.get(f"{USERS_NAMESPACE}/{name}-kubeconfig")
+        if config_map is None:
+            logger.warning(f"ConfigMap {name}-kubeconfig не существует в пространстве имен {USERS_NAMESPACE}")
+            return None, None
+    else:
+        api = kubernetes.client.CoreV1Api(get_api_client())
+        try:
+            response = api.read_namespaced_config_map(
+                name=f"{name}-kubeconfig",
+                namespace=USERS_NAMESPACE,
+                _preload_content=False
+            )
+            config_map = json.loads(response.data)
+        except kubernetes.client.exceptions.ApiException as e:
+            if e.status == 404:  # Не найдено
+                logger.warning(f"ConfigMap {name}-kubeconfig не существует в пространстве имен {USERS_NAMESPACE}")
+            else:
+                logger.error(f"Ошибка при получении ConfigMap {name}-kubeconfig: {e}")
+            return None, None
+
+    kubeconfig = (config_map.get('data') or {}).get('config')
+    if not kubeconfig:
+        logger.warning(f"ConfigMap {name}-kubeconfig не содержит данных конфигурации")
+        return None, None
+    return kubeconfig, config_map['metadata']['resourceVersion']
 
-# Вспомогательная функция для преобразования значений памяти в Mi
-def convert_memory_to_mi(memory_str):
-    memory_str = str(memory_str).upper()
-    if 'KI' in memory_str:
-        return float(memory_str.replace('KI', '')) / 1024
-    elif 'MI' in memory_str:
-        return float(memory_str.replace('MI', ''))
-    elif 'GI' in memory_str:
-        return float(memory_str.replace('GI', '')) * 1024
-    elif 'TI' in memory_str:
-        return float(memory_str.replace('TI', '')) * 1024 * 1024
-    elif 'K' in memory_str:
-        return float(memory_str.replace('K', '')) / 1024
-    elif 'M' in memory_str:
-        return float(memory_str.replace('M', ''))
-    elif 'G' in memory_str:
-        return float(memory_str.replace('G', '')) * 1024
-    elif 'T' in memory_str:
-        return float(memory_str.replace('T', '')) * 1024 * 1024
+# Имя namespace окружения команды (так же, как его формирует оператор)
+def get_namespace_name(team_name, env_name):
+    return f"{team_name}-{env_name}".lower()
+
+# Получение ResourceQuota для списка namespace
+def get_namespace_quotas(namespaces, team_name=None):
+    """Возвращает словарь namespace -> ResourceQuota (первая квота в namespace)
+
+    Квоты берутся из кеша, а до его синхронизации загружаются одним запросом
+    по всем namespace сразу. Квоты команд, созданных прежними версиями
+    оператора, не имеют меток team и managed-by, поэтому для namespace, квота
+    которых не нашлась по меткам, квоты читаются отдельным запросом без меток
+    и запоминаются на CACHE_RESYNC_PERIOD секунд.
+    """
+    # Запрос одного namespace выполняется без фильтра по меткам
+    unlabelled = False
+    if cache_ready(quotas_cache):
+        quotas = quotas_cache.list()
     else:
-        return float(memory_str) / (1024 * 1024)  # Предполагаем, что это байты
+        api = kubernetes.client.CoreV1Api(get_api_client())
+        if len(namespaces) == 1:
+            unlabelled = True
+            response = api.list_namespaced_resource_quota(namespace=namespaces[0], _preload_content=False)
+        else:
+            label_selector = "managed-by=team-operator"
+            if team_name:
+                label_selector += f",team={team_name}"
+            response = api.list_resource_quota_for_all_namespaces(
+                label_selector=label_selector,
+                _preload_content=False
+            )
+        quotas = json.loads(response.data).get('items', [])
+    
+    wanted = set(namespaces)
+    result = {}
+    for quota in sorted(quotas, key=lambda q: q['metadata']['name']):
+        namespace = quota['metadata'].get('namespace')
+        if namespace in wanted and namespace not in result:
+            result[namespace] = quota
+
+    for namespace in namespaces:
+        if namespace not in result and not unlabelled:
+            quota = read_namespace_quota(namespace)
+            if quota is not None:
+                result[namespace] = quota
+    return result
+
+# Квоты, прочитанные без фильтра по меткам: namespace -> (время устаревания, квота или None)
+unlabelled_quotas = {}
+unlabelled_quotas_lock = threading.Lock()
+
+def read_namespace_quota(namespace):
+    """Читает первую ResourceQuota namespace без фильтра по меткам
+
+    Результат (в том числе отсутствие квоты) запоминается на
+    CACHE_RESYNC_PERIOD секунд, чтобы страницы команд прежних версий
+    оператора не запрашивали квоты каждого namespace при каждом просмотре.
+    """
+    now = time.monotonic()
+    with unlabelled_quotas_lock:
+        cached = unlabelled_quotas.get(namespace)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    api = kubernetes.client.CoreV1Api(get_api_client())
+    response = api.list_namespaced_resource_quota(namespace=namespace, _preload_content=False)
+    quotas = json.loads(response.data).get('items', [])
+    quota = min(quotas, key=lambda q: q['metadata']['name']) if quotas else None
+
+    with unlabelled_quotas_lock:
+        unlabelled_quotas[namespace] = (now + CACHE_RESYNC_PERIOD, quota)
+    return quota
+
+# Формирование данных об использовании ResourceQuota для отображения
+def format_quota(quota):
+    # Получаем спецификацию (лимиты) и статус (использование)
+    hard = quota.get('spec', {}).get('hard') or {}
+    used = (quota.get('status') or {}).get('used') or {}
+    
+    # Формируем данные для отображения
+    quota_data = {
+        'name': quota['metadata']['name'],
+        'resources': []
+    }
+    
+    # Добавляем данные по каждому ресурсу
+    for resource in hard:
+        if resource in used:
+            hard_value = hard[resource]
+            used_value = used[resource]
+            
+            # Рассчитываем процент использования
+            try:
+                quota_data['resources'].append({
+                    'name': resource,
+                    'hard': hard_value,
+                    'used': used_value,
+                    'percentage': usage_percentage(used_value, hard_value)
+                })
+            except (ValueError, TypeError) as e:
+                # Если не удалось преобразовать в числа, добавляем без процента
+                quota_data['resources'].append({
+                    'name': resource,
+                    'hard': hard_value,
+                    'used': used_value,
+                    'percentage': None
+                })
+    
+    return quota_data
 
 # Маршруты Flask
 
-@app.route('/')
-def index():
-    # Получаем статистику для главной страницы
+# Получение статистики для главной страницы
+def get_stats():
+    if cache_ready(teams_cache) and cache_ready(users_cache):
+        return dashboard_stats.snapshot()
+    
     teams = get_teams()
     users = get_users()
     
@@ -285,10 +835,24 @@ def index():
         'environments_count': total_environments,
         'admin_count': admin_count,
         'developer_count': developer_count,
-        'viewer_count': viewer_count
+        'viewer_count': viewer_count,
+        'team_environments': {team['metadata']['name']: len(team.get('spec', {}).get('environments', [])) for team in teams},
+        'team_members': {}
     }
     
-    return render_template('index.html', stats=stats)
+    for user in users:
+        for team_name in set(user.get('spec', {}).get('teams', [])):
+            stats['team_members'][team_name] = stats['team_members'].get(team_name, 0) + 1
+    
+    return stats
+
+@app.route('/')
+def index():
+    return render_template('index.html', stats=get_stats())
+
+@app.route('/api/stats')
+def get_stats_api():
+    return jsonify(get_stats())
 
 # Маршруты для команд
 @app.route('/teams')
@@ -353,7 +917,8 @@ def show_team(name):
 
 @app.route('/teams/<name>/edit', methods=['GET', 'POST'])
 def edit_team(name):
-    team = get_team(name)
+    # Изменения применяются к текущей версии команды, а не к копии из кеша
+    team = get_team(name, fresh=request.method == 'POST')
     if not team:
         flash(f'Команда {name} не найдена', 'danger')
         return redirect(url_for('list_teams'))
@@ -442,6 +1007,37 @@ def new_user():
     teams = get_teams()
     return render_template('users/new.html', teams=teams)
 
+@app.route('/users/import', methods=['GET', 'POST'])
+def import_users_route():
+    results = None
+    ok = False
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Выберите файл для импорта', 'danger')
+            return render_template('users/import.html', results=None, ok=False)
+        
+        try:
+            content = upload.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            flash('Файл должен быть в кодировке UTF-8', 'danger')
+            return render_template('users/import.html', results=None, ok=False)
+        fmt = request.form.get('format') or detect_format(upload.filename)
+        known_teams = {team['metadata']['name'] for team in get_teams()}
+        known_users = {user['metadata']['name'] for user in get_users()}
+        
+        ok, results = import_users(
+            content, fmt, create_user,
+            known_teams=known_teams, known_users=known_users,
+            dry_run=bool(request.form.get('dry_run')), max_rows=IMPORT_MAX_ROWS
+        )
+        if ok:
+            flash(f'Импорт завершен: обработано пользователей: {len(results)}', 'success')
+        else:
+            flash('Импорт завершен с ошибками', 'danger')
+    
+    return render_template('users/import.html', results=results, ok=ok)
+
 @app.route('/users/<name>')
 def show_user(name):
     user = get_user(name)
@@ -453,7 +1049,8 @@ def show_user(name):
 
 @app.route('/users/<name>/edit', methods=['GET', 'POST'])
 def edit_user(name):
-    user = get_user(name)
+    # Изменения применяются к текущей версии пользователя, а не к копии из кеша
+    user = get_user(name, fresh=request.method == 'POST')
     if not user:
         flash(f'Пользователь {name} не найден', 'danger')
         return redirect(url_for('list_users'))
@@ -493,89 +1090,91 @@ def delete_user_route(name):
 
 @app.route('/users/<name>/kubeconfig')
 def download_kubeconfig(name):
-    kubeconfig = get_user_kubeconfig(name)
+    kubeconfig, version = get_user_kubeconfig(name)
     if not kubeconfig:
         flash(f'Не удалось получить kubeconfig для пользователя {name}', 'danger')
         return redirect(url_for('show_user', name=name))
     
-    # Создаем временный файл с kubeconfig
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.yaml') as temp:
-        temp.write(kubeconfig.encode())
-        temp_path = temp.name
-    
-    return send_file(
-        temp_path,
+    # kubeconfig отдается из памяти; ETag - версия kubeconfig, поэтому повторное скачивание с If-None-Match получает 304
+    response = send_file(
+        io.BytesIO(kubeconfig.encode()),
         as_attachment=True,
         download_name=f"{name}-kubeconfig.yaml",
-        mimetype='application/x-yaml'
+        mimetype='application/x-yaml',
+        etag=f"{name}-{version}"
     )
+    
+    # kubeconfig содержит токен: только для браузера пользователя и с проверкой версии перед использованием
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/api/namespaces/<namespace>/quota')
 def get_namespace_quota(namespace):
-    api = kubernetes.client.CoreV1Api()
     try:
-        quotas = api.list_namespaced_resource_quota(namespace=namespace)
-        if quotas.items:
-            # Берем первую ResourceQuota в namespace
-            quota = quotas.items[0]
-            
-            # Получаем спецификацию (лимиты) и статус (использование)
-            hard = quota.spec.hard
-            used = quota.status.used if quota.status else {}
-            
-            # Формируем данные для отображения
-            quota_data = {
-                'name': quota.metadata.name,
-                'resources': []
-            }
-            
-            # Добавляем данные по каждому ресурсу
-            for resource in hard:
-                if resource in used:
-                    # Преобразуем значения в числа для расчета процента
-                    hard_value = hard[resource]
-                    used_value = used[resource]
-                    
-                    # Пытаемся преобразовать значения в числа для расчета процента
-                    try:
-                        # Для CPU (может быть в формате "100m")
-                        if resource in ['requests.cpu', 'limits.cpu']:
-                            hard_num = float(hard_value.replace('m', '')) / 1000 if 'm' in hard_value else float(hard_value)
-                            used_num = float(used_value.replace('m', '')) / 1000 if 'm' in used_value else float(used_value)
-                        # Для памяти (может быть в формате "100Mi" или "1Gi")
-                        elif resource in ['requests.memory', 'limits.memory']:
-                            # Преобразуем все в Mi для единообразия
-                            hard_num = convert_memory_to_mi(hard_value)
-                            used_num = convert_memory_to_mi(used_value)
-                        # Для остальных ресурсов (pods, services и т.д.)
-                        else:
-                            hard_num = int(hard_value)
-                            used_num = int(used_value)
-                        
-                        # Рассчитываем процент использования
-                        percentage = (used_num / hard_num * 100) if hard_num > 0 else 0
-                        
-                        # Добавляем данные в список
-                        quota_data['resources'].append({
-                            'name': resource,
-                            'hard': hard_value,
-                            'used': used_value,
-                            'percentage': min(percentage, 100)  # Ограничиваем максимум 100%
-                        })
-                    except (ValueError, TypeError) as e:
-                        # Если не удалось преобразовать в числа, добавляем без процента
-                        quota_data['resources'].append({
-                            'name': resource,
-                            'hard': hard_value,
-                            'used': used_value,
-                            'percentage': None
-                        })
-            
-            return jsonify(quota_data)
+        quota = get_namespace_quotas([namespace]).get(namespace)
+        if quota:
+            return jsonify(format_quota(quota))
         return jsonify({'error': 'ResourceQuota не найдена'})
     except ApiException as e:
         return jsonify({'error': f'Ошибка при получении ResourceQuota: {e}'}), 500
 
+@app.route('/api/teams/<name>/quota')
+def get_team_quota(name):
+    team = get_team(name)
+    if not team:
+        return jsonify({'error': f'Команда {name} не найдена'}), 404
+    
+    namespaces = [get_namespace_name(name, env.get('name')) for env in team.get('spec', {}).get('environments', [])]
+    try:
+        quotas = get_namespace_quotas(namespaces, team_name=name)
+    except ApiException as e:
+        return jsonify({'error': f'Ошибка при получении ResourceQuota: {e}'}), 500
+    
+    result = {}
+    for namespace in namespaces:
+        if namespace in quotas:
+            result[namespace] = format_quota(quotas[namespace])
+        else:
+            result[namespace] = {'error': 'ResourceQuota не найдена'}
+    
+    return jsonify({'team': name, 'namespaces': result})
+
+@app.before_request
+def start_request_metrics():
+    """Начинает учет длительности и запросов к API для запроса веб-интерфейса"""
+    g.request_started = time.monotonic()
+    g.api_requests, g.api_requests_token = metrics.start_api_request_count()
+    g.span, g.span_token = tracer.start_span(f"{request.method} {request.path}", method=request.method, path=request.path)
+
+@app.after_request
+def record_request_metrics(response):
+    """Учитывает длительность и число запросов к API запроса веб-интерфейса"""
+    if 'request_started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.HTTP_REQUEST_DURATION.labels(request.method, route, str(response.status_code)).observe(time.monotonic() - g.request_started)
+        metrics.HTTP_API_REQUESTS.labels(route).observe(g.api_requests[0])
+        g.span.set_attribute('route', route)
+        g.span.set_attribute('status_code', response.status_code)
+        g.span.set_attribute('api_requests', g.api_requests[0])
+    return response
+
+@app.teardown_request
+def stop_request_metrics(exception=None):
+    """Завершает подсчет запросов к API и span запроса веб-интерфейса"""
+    if 'span_token' in g:
+        if exception is not None:
+            g.span.set_error(exception)
+        tracer.end_span(g.span, g.pop('span_token'))
+    if 'api_requests_token' in g:
+        metrics.stop_api_request_count(g.pop('api_requests_token'))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики Prometheus веб-интерфейса"""
+    data, content_type = metrics.render_metrics()
+    return Response(data, content_type=content_type)
+
 @app.errorhandler(CSRFError)
 def handle_csrf_error(e):
     flash('Ошибка CSRF-токена. Пожалуйста, попробуйте еще раз.', 'danger')
@@ -589,12 +1188,35 @@ def page_not_found(e):
 def internal_server_error(e):
     return render_template('500.html'), 500
 
+# Признак того, что приложение уже подготовлено к работе в текущем процессе
+app_initialized = False
+app_initialized_lock = threading.Lock()
+
+def create_app():
+    """Подготавливает приложение к работе в текущем процессе и возвращает его
+
+    Точка входа для WSGI-сервера (gunicorn 'app:create_app()'). Конфигурация
+    Kubernetes загружается, а кеши запускаются один раз в каждом процессе
+    (worker): фоновые потоки кешей не переживают fork, поэтому при импорте
+    модуля они не создаются.
+    """
+    global app_initialized
+
+    with app_initialized_lock:
+        if not app_initialized:
+            # Загружаем конфигурацию Kubernetes
+            load_kubernetes_config()
+
+            # Убеждаемся, что пространство имен пользователей существует
+            ensure_users_namespace()
+
+            # Запускаем кеши команд, пользователей и квот окружений
+            start_caches()
+            app_initialized = True
+    return app
+
 if __name__ == '__main__':
-    # Загружаем конфигурацию Kubernetes
-    load_kubernetes_config()
-    
-    # Убеждаемся, что пространство имен пользователей существует
-    ensure_users_namespace()
-    
-    # Запускаем приложение
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    # Сервер разработки Flask: для работы в кластере используется gunicorn (gunicorn.conf.py)
+    create_app()
+    app.run(host='0.0.0.0', port=int(os.environ.get('UI_PORT', '8080')), threaded=True,
+            debug=os.environ.get('UI_DEBUG', '').lower() in ('1', 'true', 'yes'), use_reloader=False)
@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+"""Нагрузочное тестирование оператора и веб-интерфейса
+
+Запускает настоящие обработчики оператора (create_fn, update_fn, delete_fn,
+create_user, update_user, delete_user) и маршруты Flask против локального
+API-сервера из fake_apiserver.py. Индексы kopf строятся по тем же функциям
+индексов, что и в операторе, одновременность обработчиков ограничивается
+теми же ограничителями, что и под kopf.
+
+Для каждого сценария выводится время выполнения, число запросов к API на
+объект и p50/p99 длительности обработчика (или HTTP-запроса). После каждого
+сценария объекты в API-сервере сверяются с ожидаемыми: namespace окружений,
+ServiceAccount и ConfigMap пользователей, RoleBinding с их субъектами, а
+удаленные объекты должны отсутствовать. При расхождениях код выхода равен 1.
+
+Пример:
+
+    python bench/benchmark.py --teams 500 --envs 10 --users 2000 --user-teams 40
+"""
+
+import argparse
+import asyncio
+import copy
+import importlib.util
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+# Корень репозитория добавляется в конец пути, чтобы operator.py не подменял стандартный модуль operator
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+import kopf
+import kubernetes
+import kubernetes_asyncio
+from kopf._core.engines.posting import settings_var
+
+from fake_apiserver import FakeApiServer
+
+def load_operator():
+    """Загружает operator.py под именем team_operator"""
+    spec = importlib.util.spec_from_file_location('team_operator', os.path.join(ROOT, 'operator.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['team_operator'] = module
+    spec.loader.exec_module(module)
+    return module
+
+def percentile(values, q):
+    """Возвращает перцентиль q (от 0 до 1) списка значений"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+class Benchmark:
+    """Состояние нагрузочного теста: объекты Team и User, их статусы и индексы kopf"""
+
+    def __init__(self, op, app, fake, args):
+        self.op = op
+        self.app = app
+        self.fake = fake
+        self.args = args
+        self.logger = logging.getLogger('bench')
+        self.random = random.Random(args.seed)
+        self.teams = {}
+        self.users = {}
+        self.results = []
+
+    # Индексы kopf
+
+    def build_index(self, index_fn, objects):
+        index = {}
+        for obj in objects:
+            metadata = obj['metadata']
+            for key, value in index_fn(name=metadata['name'], namespace=metadata.get('namespace'),
+                                       spec=obj.get('spec', {}), body=obj, meta=metadata).items():
+                index.setdefault(key, []).append(value)
+        return index
+
+    def team_namespaces(self):
+        return self.build_index(self.op.team_namespaces, self.teams.values())
+
+    def team_members(self):
+        return self.build_index(self.op.team_members, self.users.values())
+
+    def owned_index(self, index_fn, resource):
+        with self.fake.lock:
+            objects = [copy.deepcopy(obj) for obj in self.fake.list('api/v1', None, resource, 'managed-by=team-operator')]
+        return self.build_index(index_fn, objects)
+
+    def owned_namespaces(self):
+        return self.owned_index(self.op.owned_namespaces, 'namespaces')
+
+    def owned_config_maps(self):
+        return self.owned_index(self.op.owned_config_maps, 'configmaps')
+
+    # Объекты
+
+    def save(self, plural, obj):
+        """Сохраняет ресурс Team или User в API-сервере, чтобы его видел веб-интерфейс"""
+        self.fake.put(f"{self.op.GROUP}/{self.op.VERSION}", plural, obj)
+
+    def apply_patch(self, plural, obj, patch):
+        """Применяет к объекту изменения статуса, сделанные обработчиком, как это делает kopf"""
+        status = obj.setdefault('status', {})
+        for key, value in patch.get('status', {}).items():
+            if value is None:
+                status.pop(key, None)
+            else:
+                status[key] = copy.deepcopy(value)
+        self.save(plural, obj)
+
+    def render_team(self, index, envs):
+        name = f"team-{index:04d}"
+        return {
+            'apiVersion': f"{self.op.GROUP}/{self.op.VERSION}",
+            'kind': 'Team',
+            'metadata': {'name': name},
+            'spec': {
+                'environments': [
+                    {'name': f"env{env:02d}", 'quota': {'cpu': '4', 'memory': '8Gi', 'pods': '20'}}
+                    for env in range(envs)
+                ]
+            }
+        }
+
+    def render_user(self, index):
+        team_count = min(self.args.teams, self.args.user_teams)
+        teams = sorted({f"team-{(index + offset) % team_count:04d}" for offset in range(self.args.teams_per_user)})
+        return {
+            'apiVersion': f"{self.op.GROUP}/{self.op.VERSION}",
+            'kind': 'User',
+            'metadata': {'name': f"user-{index:05d}"},
+            'spec': {
+                'fullName': f"User {index}",
+                'email': f"user{index}@example.com",
+                'role': 'developer',
+                'teams': teams
+            }
+        }
+
+    # Выполнение сценариев
+
+    async def call(self, handler, make_kwargs):
+        """Вызывает обработчик с повторами, как kopf; возвращает (длительность, повторы, успех)
+
+        make_kwargs вызывается перед каждой попыткой, чтобы индексы отражали
+        текущее состояние.
+        """
+        started = time.monotonic()
+        for attempt in range(self.args.retries + 1):
+            try:
+                await handler(logger=self.logger, **make_kwargs())
+                return time.monotonic() - started, attempt, True
+            except kopf.PermanentError as e:
+                self.logger.error(f"{handler.__name__}: {e}")
+                return time.monotonic() - started, attempt, False
+            except Exception as e:
+                self.logger.info(f"{handler.__name__}: повтор после ошибки: {e}")
+        return time.monotonic() - started, self.args.retries, False
+
+    async def run_handlers(self, scenario, calls):
+        """Выполняет вызовы обработчиков одновременно и записывает результат сценария
+
+        calls - список функций без аргументов, возвращающих корутину call().
+        """
+        semaphore = asyncio.Semaphore(self.args.concurrency) if self.args.concurrency > 0 else None
+
+        async def run(call):
+            if semaphore is None:
+                return await call()
+            async with semaphore:
+                return await call()
+
+        self.fake.reset_counts()
+        started = time.monotonic()
+        results = await asyncio.gather(*(run(call) for call in calls))
+        wall = time.monotonic() - started
+
+        self.record(scenario, len(calls), wall,
+                    [duration for duration, _, _ in results],
+                    retries=sum(retries for _, retries, _ in results),
+                    failures=sum(1 for _, _, ok in results if not ok))
+
+    def record(self, scenario, objects, wall, latencies, retries=0, failures=0):
+        with self.fake.lock:
+            counts = dict(self.fake.counts)
+            injected = self.fake.errors
+        api_calls = sum(counts.values())
+        self.results.append({
+            'scenario': scenario,
+            'objects': objects,
+            'wall_seconds': round(wall, 3),
+            'objects_per_second': round(objects / wall, 1) if wall else 0.0,
+            'api_calls': api_calls,
+            'api_calls_per_object': round(api_calls / objects, 2) if objects else 0.0,
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+            'retries': retries,
+            'failures': failures,
+            'injected_errors': injected,
+            'api_calls_by_resource': {f"{verb} {resource}": count for (verb, resource), count in sorted(counts.items())}
+        })
+
+    # Сценарии оператора
+
+    async def teams_create(self):
+        for index in range(self.args.teams):
+            team = self.render_team(index, self.args.envs)
+            self.teams[team['metadata']['name']] = team
+            self.save(self.op.PLURAL_TEAMS, team)
+
+        def create(team):
+            patch = kopf.Patch()
+
+            async def call():
+                result = await self.call(self.op.create_fn, lambda: dict(
+                    body=team, spec=team['spec'], name=team['metadata']['name'], patch=patch,
+                    team_members=self.team_members()
+                ))
+                self.apply_patch(self.op.PLURAL_TEAMS, team, patch)
+                return result
+            return call
+
+        await self.run_handlers('teams_create', [create(team) for team in self.teams.values()])
+
+    async def teams_add_env(self):
+        def update(team):
+            patch = kopf.Patch()
+            old = copy.deepcopy(team)
+            team['spec']['environments'].append({'name': f"env{self.args.envs:02d}", 'quota': {'cpu': '2', 'pods': '10'}})
+
+            async def call():
+                result = await self.call(self.op.update_fn, lambda: dict(
+                    body=team, spec=team['spec'], status=team.get('status', {}), old=old,
+                    name=team['metadata']['name'], patch=patch, team_members=self.team_members()
+                ))
+                self.apply_patch(self.op.PLURAL_TEAMS, team, patch)
+                return result
+            return call
+
+        await self.run_handlers('teams_add_env', [update(team) for team in self.teams.values()])
+
+    async def users_create(self):
+        for index in range(self.args.users):
+            user = self.render_user(index)
+            self.users[user['metadata']['name']] = user
+            self.save(self.op.PLURAL_USERS, user)
+
+        # Индексы строятся один раз: kopf заполняет их до вызова обработчиков
+        team_namespaces = self.team_namespaces()
+        team_members = self.team_members()
+
+        def create(user):
+            patch = kopf.Patch()
+
+            async def call():
+                result = await self.call(self.op.create_user, lambda: dict(
+                    body=user, spec=user['spec'], name=user['metadata']['name'], patch=patch,
+                    team_namespaces=team_namespaces, team_members=team_members
+                ))
+                self.apply_patch(self.op.PLURAL_USERS, user, patch)
+                return result
+            return call
+
+        await self.run_handlers('users_create', [create(user) for user in self.users.values()])
+
+    async def users_change_role(self):
+        olds = {}
+        for name, user in self.users.items():
+            olds[name] = copy.deepcopy(user)
+            user['spec']['role'] = 'viewer'
+        team_namespaces = self.team_namespaces()
+        team_members = self.team_members()
+        owned_config_maps = self.owned_config_maps()
+
+        def update(user):
+            patch = kopf.Patch()
+            name = user['metadata']['name']
+
+            async def call():
+                result = await self.call(self.op.update_user, lambda: dict(
+                    body=user, spec=user['spec'], status=user.get('status', {}), old=olds[name],
+                    name=name, patch=patch, team_namespaces=team_namespaces, team_members=team_members,
+                    owned_config_maps=owned_config_maps
+                ))
+                self.apply_patch(self.op.PLURAL_USERS, user, patch)
+                return result
+            return call
+
+        await self.run_handlers('users_change_role', [update(user) for user in self.users.values()])
+
+    async def users_delete(self):
+        team_namespaces = self.team_namespaces()
+        users, self.users = self.users, {}
+        team_members = self.team_members()
+        owned_config_maps = self.owned_config_maps()
+
+        def delete(user):
+            async def call():
+                return await self.call(self.op.delete_user, lambda: dict(
+                    body=user, spec=user['spec'], name=user['metadata']['name'],
+                    team_namespaces=team_namespaces, team_members=team_members,
+                    owned_config_maps=owned_config_maps
+                ))
+            return call
+
+        await self.run_handlers('users_delete', [delete(user) for user in users.values()])
+
+    async def teams_delete(self):
+        teams, self.teams = self.teams, {}
+
+        def delete(team):
+            patch = kopf.Patch()
+
+            async def call():
+                # delete_fn завершается повтором, пока namespace не удалены; API-сервер удаляет их сразу
+                return await self.call(self.op.delete_fn, lambda: dict(
+                    body=team, spec=team['spec'], status=team.get('status', {}), name=team['metadata']['name'],
+                    patch=patch, owned_namespaces=self.owned_namespaces()
+                ))
+            return call
+
+        await self.run_handlers('teams_delete', [delete(team) for team in teams.values()])
+
+    # Проверка итогового состояния
+
+    def expected_bindings(self):
+        """Возвращает ожидаемые RoleBinding пользователей: (namespace, имя) -> отсортированные имена субъектов
+
+        В режиме group RoleBinding роли без участников может отсутствовать,
+        поэтому такие RoleBinding не ожидаются (и пустые не считаются лишними).
+        """
+        op = self.op
+        bindings = {}
+        for user_name, user in sorted(self.users.items()):
+            role = user['spec'].get('role', 'developer')
+            for team_name in user['spec'].get('teams', []):
+                team = self.teams.get(team_name)
+                if team is None:
+                    continue
+                role_name = op.get_user_role_name(team_name, role)
+                for env in team['spec'].get('environments', []):
+                    namespace = op.get_namespace_name(team_name, env['name'])
+                    if op.BINDING_MODE == 'group':
+                        bindings.setdefault((namespace, f"{role_name}-members"), []).append(user_name)
+                    else:
+                        bindings[(namespace, f"{user_name}-{role_name}-binding")] = [user_name]
+        return bindings
+
+    def actual_bindings(self):
+        label = 'user-role' if self.op.BINDING_MODE == 'group' else 'user'
+        bindings = {}
+        for obj in self.fake.list('apis/rbac.authorization.k8s.io/v1', None, 'rolebindings', 'managed-by=team-operator'):
+            metadata = obj['metadata']
+            subjects = sorted(subject['name'] for subject in obj.get('subjects') or [])
+            if label in (metadata.get('labels') or {}) and subjects:
+                bindings[(metadata['namespace'], metadata['name'])] = subjects
+        return bindings
+
+    def check_state(self):
+        """Сверяет объекты API-сервера с ожидаемыми и возвращает список расхождений"""
+        op = self.op
+        expected = {
+            'Namespace': {
+                op.get_namespace_name(team_name, env['name']): None
+                for team_name, team in self.teams.items() for env in team['spec'].get('environments', [])
+            },
+            'ServiceAccount': {name: None for name in self.users},
+            'ConfigMap': {f"{name}-kubeconfig": None for name in self.users} if op.KUBECONFIG_MODE == 'configmap' else {},
+            'RoleBinding': self.expected_bindings()
+        }
+
+        with self.fake.lock:
+            actual = {
+                'Namespace': {
+                    obj['metadata']['name']: None
+                    for obj in self.fake.list('api/v1', None, 'namespaces', 'managed-by=team-operator')
+                    if 'team' in obj['metadata'].get('labels', {})
+                },
+                'ServiceAccount': {
+                    obj['metadata']['name']: None
+                    for obj in self.fake.list('api/v1', op.USERS_NAMESPACE, 'serviceaccounts', 'managed-by=team-operator')
+                },
+                'ConfigMap': {
+                    obj['metadata']['name']: None
+                    for obj in self.fake.list('api/v1', op.USERS_NAMESPACE, 'configmaps', 'managed-by=team-operator')
+                    if 'user' in obj['metadata'].get('labels', {})
+                },
+                'RoleBinding': self.actual_bindings()
+            }
+
+        problems = []
+        for kind in expected:
+            wanted, found = expected[kind], actual[kind]
+            for name in sorted(wanted.keys() - found.keys(), key=str):
+                problems.append(f"{kind} {name}: отсутствует")
+            for name in sorted(found.keys() - wanted.keys(), key=str):
+                problems.append(f"{kind} {name}: лишний")
+            for name in sorted(wanted.keys() & found.keys(), key=str):
+                if wanted[name] != found[name]:
+                    problems.append(f"{kind} {name}: субъекты {found[name]}, ожидались {wanted[name]}")
+        return problems
+
+    # Сценарии веб-интерфейса
+
+    def ui_paths(self):
+        teams = sorted(self.teams)
+        users = sorted(self.users)
+        paths = ['/', '/teams', '/users', '/api/stats']
+        for _ in range(self.args.ui_requests):
+            paths.append(self.random.choice([
+                f"/teams/{self.random.choice(teams)}",
+                f"/api/teams/{self.random.choice(teams)}/quota",
+                f"/users/{self.random.choice(users)}",
+                f"/users/{self.random.choice(users)}/kubeconfig"
+            ]))
+        return paths
+
+    def ui_requests(self, scenario):
+        client = self.app.app.test_client()
+        paths = self.ui_paths()
+
+        self.fake.reset_counts()
+        latencies = []
+        failures = 0
+        started = time.monotonic()
+        for path in paths:
+            request_started = time.monotonic()
+            response = client.get(path)
+            latencies.append(time.monotonic() - request_started)
+            if response.status_code >= 400:
+                failures += 1
+        self.record(scenario, len(paths), time.monotonic() - started, latencies, failures=failures)
+
+    def ui_routes(self):
+        self.ui_requests('ui_routes')
+
+    def ui_routes_cached(self):
+        self.app.start_caches()
+        caches = [cache for cache in (self.app.teams_cache, self.app.users_cache, self.app.quotas_cache,
+                                      self.app.kubeconfigs_cache) if cache is not None]
+        for cache in caches:
+            cache.synced.wait()
+        # Даем кешам перейти к watch, чтобы начальная загрузка не попала в подсчет
+        time.sleep(0.2)
+        try:
+            self.ui_requests('ui_routes_cached')
+        finally:
+            self.app.stop_caches()
+
+    async def run(self, scenarios):
+        loop = asyncio.get_running_loop()
+        try:
+            for scenario in scenarios:
+                self.logger.warning(f"Сценарий {scenario}")
+                method = getattr(self, scenario)
+                if asyncio.iscoroutinefunction(method):
+                    await method()
+                else:
+                    await loop.run_in_executor(None, method)
+
+                problems = self.check_state()
+                self.results[-1]['mismatches'] = len(problems)
+                self.results[-1]['mismatch_examples'] = problems[:MISMATCH_EXAMPLES]
+        finally:
+            await self.op.close_api_client()
+
+# Количество расхождений, выводимых для каждого сценария
+MISMATCH_EXAMPLES = 5
+
+SCENARIOS = ('teams_create', 'teams_add_env', 'users_create', 'users_change_role',
+             'ui_routes', 'ui_routes_cached', 'users_delete', 'teams_delete')
+
+def print_report(results, breakdown):
+    columns = [
+        ('scenario', 'Сценарий', 18), ('objects', 'Объекты', 8), ('wall_seconds', 'Время, с', 9),
+        ('objects_per_second', 'Об./с', 8), ('api_calls', 'Запросы', 8),
+        ('api_calls_per_object', 'Запр./об.', 9), ('p50_ms', 'p50, мс', 8), ('p99_ms', 'p99, мс', 8),
+        ('retries', 'Повторы', 8), ('failures', 'Ошибки', 7), ('mismatches', 'Расхожд.', 8)
+    ]
+    print(' '.join(title.rjust(width) if index else title.ljust(width) for index, (_, title, width) in enumerate(columns)))
+    for result in results:
+        print(' '.join(str(result[key]).rjust(width) if index else str(result[key]).ljust(width)
+                       for index, (key, _, width) in enumerate(columns)))
+        if breakdown:
+            for resource, count in result['api_calls_by_resource'].items():
+                print(f"    {resource}: {count}")
+        for problem in result['mismatch_examples']:
+            print(f"    ! {problem}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Нагрузочное тестирование оператора и веб-интерфейса')
+    parser.add_argument('--teams', type=int, default=500, help='Количество команд')
+    parser.add_argument('--envs', type=int, default=10, help='Количество окружений в команде')
+    parser.add_argument('--users', type=int, default=2000, help='Количество пользователей')
+    parser.add_argument('--user-teams', type=int, default=40, help='Количество команд, в которые добавляются пользователи')
+    parser.add_argument('--teams-per-user', type=int, default=1, help='Количество команд у каждого пользователя')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='Сценарий (можно указать несколько раз, по умолчанию все по порядку)')
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='Одновременно обрабатываемые объекты (по умолчанию без ограничения, как в kopf)')
+    parser.add_argument('--retries', type=int, default=5, help='Повторы обработчика после временной ошибки')
+    parser.add_argument('--latency', type=float, default=0.0, help='Задержка ответа API-сервера, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Случайная добавка к задержке ответа, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля запросов, на которые API-сервер отвечает 500')
+    parser.add_argument('--qps', type=float, default=0.0, help='Ограничение частоты запросов оператора (0 - без ограничения)')
+    parser.add_argument('--ui-requests', type=int, default=200, help='Количество запросов к страницам команд и пользователей')
+    parser.add_argument('--seed', type=int, default=1, help='Начальное значение генератора случайных чисел')
+    parser.add_argument('--log-level', default='ERROR', help='Уровень логирования')
+    parser.add_argument('--breakdown', action='store_true', help='Выводить запросы к API по глаголам и ресурсам')
+    parser.add_argument('--json', action='store_true', help='Вывести результаты в формате JSON')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    fake = FakeApiServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    url = fake.start()
+
+    # Оба клиента Kubernetes подключаются к локальному API-серверу
+    configuration = kubernetes.client.Configuration()
+    configuration.host = url
+    kubernetes.client.Configuration.set_default(configuration)
+    async_configuration = kubernetes_asyncio.client.Configuration()
+    async_configuration.host = url
+    kubernetes_asyncio.client.Configuration.set_default(async_configuration)
+
+    op = load_operator()
+    import app
+
+    logging.getLogger().setLevel(args.log_level.upper())
+    op.API_QPS = args.qps
+    op.cluster_info = op.ClusterInfo('bench', url, None, False)
+
+    # События kopf не публикуются: обработчики вызываются вне kopf
+    settings = kopf.OperatorSettings()
+    settings.posting.enabled = False
+    settings.posting.level = logging.CRITICAL
+    settings_var.set(settings)
+
+    benchmark = Benchmark(op, app, fake, args)
+    try:
+        asyncio.run(benchmark.run(args.scenario or SCENARIOS))
+    finally:
+        fake.stop()
+
+    if args.json:
+        print(json.dumps(benchmark.results, ensure_ascii=False, indent=2))
+    else:
+        print_report(benchmark.results, args.breakdown)
+
+    if any(result['mismatches'] for result in benchmark.results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""Локальный API-сервер Kubernetes для нагрузочных тестов
+
+Хранит объекты в памяти и отвечает на запросы, которые делают оператор и
+веб-интерфейс: server-side apply и merge patch (PATCH), чтение объектов и
+списков с фильтром по меткам (GET), watch без событий, создание (POST),
+запрос токена ServiceAccount (TokenRequest) и удаление (DELETE). Удаление
+namespace удаляет все объекты в нем сразу.
+
+Задержка ответа и доля ошибок настраиваются, все запросы подсчитываются по
+глаголу и ресурсу Kubernetes.
+"""
+
+import collections
+import datetime
+import json
+import random
+import secrets
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+
+def parse_path(path):
+    """Разбирает путь API на (префикс группы и версии, namespace, ресурс, имя, подресурс)"""
+    parts = path.strip('/').split('/')
+    if parts[0] == 'api':
+        prefix, parts = '/'.join(parts[:2]), parts[2:]
+    else:
+        prefix, parts = '/'.join(parts[:3]), parts[3:]
+
+    namespace = None
+    if len(parts) >= 3 and parts[0] == 'namespaces':
+        namespace, parts = parts[1], parts[2:]
+
+    parts += [None] * (3 - len(parts))
+    return prefix, namespace, parts[0], parts[1], parts[2]
+
+def matches_selector(obj, selector):
+    """Проверяет метки объекта по селектору вида "ключ=значение,ключ2=значение2" """
+    labels = obj.get('metadata', {}).get('labels') or {}
+    for requirement in filter(None, (selector or '').split(',')):
+        key, _, value = requirement.partition('=')
+        if labels.get(key) != value:
+            return False
+    return True
+
+def merge(target, patch):
+    """Применяет JSON merge patch к объекту"""
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+class FakeApiServer:
+    """API-сервер Kubernetes в памяти процесса
+
+    latency и jitter - задержка каждого ответа в секундах (jitter - случайная
+    добавка), error_rate - доля запросов, на которые отвечается 500.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.objects = {}
+        self.counts = collections.Counter()
+        self.errors = 0
+        self.resource_version = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        """Запускает сервер в фоновом потоке и возвращает его адрес"""
+        fake = self
+
+        class Handler(RequestHandler):
+            server_fake = fake
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts.clear()
+            self.errors = 0
+
+    @property
+    def total_requests(self):
+        with self.lock:
+            return sum(self.counts.values())
+
+    def next_resource_version(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def put(self, api_version, plural, obj, namespace=None):
+        """Сохраняет объект напрямую, минуя HTTP (как kubectl apply)"""
+        prefix = 'api/v1' if api_version == 'v1' else f"apis/{api_version}"
+        with self.lock:
+            self.store(prefix, namespace, plural, obj['metadata']['name'], obj)
+
+    def store(self, prefix, namespace, resource, name, obj):
+        metadata = obj.setdefault('metadata', {})
+        metadata['name'] = name
+        if namespace:
+            metadata['namespace'] = namespace
+        key = (prefix, namespace, resource, name)
+        previous = self.objects.get(key)
+        metadata['uid'] = previous['metadata']['uid'] if previous else secrets.token_hex(8)
+        metadata.setdefault('creationTimestamp', datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+        metadata['resourceVersion'] = self.next_resource_version()
+
+        self.objects[key] = obj
+        return obj
+
+    def list(self, prefix, namespace, resource, selector):
+        return [
+            obj for (obj_prefix, obj_namespace, obj_resource, _), obj in sorted(self.objects.items(), key=lambda item: str(item[0]))
+            if obj_prefix == prefix and obj_resource == resource
+            and (namespace is None or obj_namespace == namespace)
+            and matches_selector(obj, selector)
+        ]
+
+    def delete(self, prefix, namespace, resource, name):
+        obj = self.objects.pop((prefix, namespace, resource, name), None)
+        if obj is not None and prefix == 'api/v1' and resource == 'namespaces':
+            for key in [key for key in self.objects if key[1] == name]:
+                del self.objects[key]
+        return obj
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов FakeApiServer"""
+
+    protocol_version = 'HTTP/1.1'
+    server_fake = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, code, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_status(self, code, reason):
+        self.send_json(code, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'code': code, 'reason': reason})
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'null')
+
+    def handle_request(self, method):
+        fake = self.server_fake
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        # Тело читается всегда (в том числе DeleteOptions), чтобы не нарушить keep-alive соединение
+        body = self.read_body()
+
+        resource, _, named = metrics.parse_api_path(url.path)
+        verb = metrics.get_api_verb(method, named, list(query.items()))
+        with fake.lock:
+            fake.counts[(verb, resource)] += 1
+            fail = fake.error_rate > 0 and fake.random.random() < fake.error_rate
+            delay = fake.latency + (fake.random.uniform(0, fake.jitter) if fake.jitter else 0)
+
+        if delay:
+            time.sleep(delay)
+        if fail:
+            with fake.lock:
+                fake.errors += 1
+            return self.send_status(500, 'InternalError')
+
+        if verb == 'watch':
+            return self.watch(query)
+
+        prefix, namespace, resource, name, subresource = parse_path(url.path)
+        with fake.lock:
+            code, obj = getattr(self, f"do_{method.lower()}")(fake, prefix, namespace, resource, name, subresource, query, body)
+        self.send_json(code, obj)
+
+    def watch(self, query):
+        """Watch без событий: соединение держится до таймаута или остановки сервера"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        self.server_fake.stopped.wait(float(query.get('timeoutSeconds', 60)))
+
+    def do_get(self, fake, prefix, namespace, resource, name, subresource, query, body):
+        if name is None:
+            items = fake.list(prefix, namespace, resource, query.get('labelSelector'))
+            return 200, {'kind': 'List', 'apiVersion': 'v1', 'items': items,
+                         'metadata': {'resourceVersion': str(fake.resource_version)}}
+
+        obj = fake.objects.get((prefix, namespace, resource, name))
+        if obj is None:
+            return 404, {'kind': 'Status', 'code': 404, 'reason': 'NotFound'}
+        return 200, obj
+
+    def do_post(self, fake, prefix, namespace, resource, name, subresource, query, body):
+        if subresource == 'token':
+            return self.token_request(fake, prefix, namespace, resource, name, body)
+
+        name = body.get('metadata', {}).get('name')
+        if (prefix, namespace, resource, name) in fake.objects:
+            return 409, {'kind': 'Status', 'code': 409, 'reason': 'AlreadyExists'}
+        return 201, fake.store(prefix, namespace, resource, name, body)
+
+    def token_request(self, fake, prefix, namespace, resource, name, body):
+        """TokenRequest: токен ServiceAccount с запрошенным сроком действия"""
+        if (prefix, namespace, resource, name) not in fake.objects:
+            return 404, {'kind': 'Status', 'code': 404, 'reason': 'NotFound'}
+
+        spec = body.setdefault('spec', {})
+        spec.setdefault('audiences', ['https://kubernetes.default.svc'])
+        expiration_seconds = spec.get('expirationSeconds') or 3600
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expiration_seconds)
+        body['status'] = {
+            'token': secrets.token_urlsafe(32),
+            'expirationTimestamp': expires.strftime('%Y-%m-%dT%H:%M:%SZ')
+        }
+        return 201, body
+
+    def do_patch(self, fake, prefix, namespace, resource, name, subresource, query, body):
+        key = (prefix, namespace, resource, name)
+        if self.headers.get('Content-Type', '').startswith('application/apply-patch'):
+            return 200, fake.store(prefix, namespace, resource, name, body)
+
+        if key not in fake.objects:
+            return 404, {'kind': 'Status', 'code': 404, 'reason': 'NotFound'}
+        return 200, fake.store(prefix, namespace, resource, name, merge(fake.objects[key], body))
+
+    def do_put(self, fake, prefix, namespace, resource, name, subresource, query, body):
+        return 200, fake.store(prefix, namespace, resource, name, body)
+
+    def do_delete(self, fake, prefix, namespace, resource, name, subresource, query, body):
+        if fake.delete(prefix, namespace, resource, name) is None:
+            return 404, {'kind': 'Status', 'code': 404, 'reason': 'NotFound'}
+        return 200, {'kind': 'Status', 'status': 'Success'}
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
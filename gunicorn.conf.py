@@ -0,0 +1,44 @@
+"""Настройки gunicorn для веб-интерфейса
+
+Запуск: gunicorn -c gunicorn.conf.py 'app:create_app()'
+
+Каждый worker импортирует приложение сам (preload_app выключен), поэтому
+конфигурация Kubernetes загружается, а кеши запускаются один раз в каждом
+worker. Запросы внутри worker обрабатываются пулом потоков (gthread), который
+поддерживает keep-alive соединения. По SIGTERM worker дообрабатывают текущие
+запросы в течение graceful_timeout секунд.
+"""
+
+import multiprocessing
+import os
+
+from prometheus_client import multiprocess
+
+bind = os.environ.get('UI_BIND', '0.0.0.0:8080')
+
+# Количество процессов и потоков в каждом из них
+workers = int(os.environ.get('UI_WORKERS', str(min(multiprocessing.cpu_count(), 4))))
+worker_class = 'gthread'
+threads = int(os.environ.get('UI_THREADS', '8'))
+
+# Время ожидания keep-alive соединения, таймаут обработки запроса и время на завершение (в секундах)
+keepalive = int(os.environ.get('UI_KEEPALIVE', '5'))
+timeout = int(os.environ.get('UI_TIMEOUT', '60'))
+graceful_timeout = int(os.environ.get('UI_GRACEFUL_TIMEOUT', '30'))
+
+# Перезапуск worker после заданного числа запросов (0 - без перезапуска)
+max_requests = int(os.environ.get('UI_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.environ.get('UI_MAX_REQUESTS_JITTER', '0'))
+
+preload_app = False
+accesslog = os.environ.get('UI_ACCESS_LOG', '-') or None
+
+def worker_exit(server, worker):
+    """Останавливает кеши завершающегося worker"""
+    import app
+    app.stop_caches()
+
+def child_exit(server, worker):
+    """Удаляет метрики завершившегося worker"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,166 @@
+"""Метрики Prometheus оператора и веб-интерфейса
+
+Оба процесса отдают метрики в формате Prometheus на /metrics: оператор - на
+отдельном порту (start_metrics_server), веб-интерфейс - маршрутом Flask.
+Запросы к API-серверу учитываются по компоненту, глаголу Kubernetes и типу
+ресурса, а также суммируются в пределах одного вызова обработчика или
+одного HTTP-запроса (count_api_requests).
+"""
+
+import contextlib
+import contextvars
+import os
+import urllib.parse
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess, start_http_server
+
+# Границы гистограмм количества запросов к API за один вызов
+API_REQUESTS_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+API_REQUESTS = Counter(
+    'team_operator_api_requests_total',
+    'Запросы к API-серверу Kubernetes',
+    ['component', 'verb', 'resource', 'code']
+)
+API_REQUEST_DURATION = Histogram(
+    'team_operator_api_request_duration_seconds',
+    'Длительность запросов к API-серверу Kubernetes',
+    ['component', 'verb', 'resource']
+)
+
+HANDLER_DURATION = Histogram(
+    'team_operator_handler_duration_seconds',
+    'Длительность выполнения обработчиков оператора',
+    ['handler'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+HANDLER_RESULTS = Counter(
+    'team_operator_handler_results_total',
+    'Результаты выполнения обработчиков оператора (success, failure, retry)',
+    ['handler', 'result']
+)
+HANDLER_API_REQUESTS = Histogram(
+    'team_operator_handler_api_requests',
+    'Количество запросов к API-серверу за один вызов обработчика',
+    ['handler'],
+    buckets=API_REQUESTS_BUCKETS
+)
+HANDLERS_WAITING = Gauge(
+    'team_operator_handlers_waiting',
+    'Обработчики, ожидающие свободного места в ограничителе',
+    ['limiter']
+)
+HANDLERS_ACTIVE = Gauge(
+    'team_operator_handlers_active',
+    'Обработчики, занимающие место в ограничителе',
+    ['limiter']
+)
+
+HTTP_REQUEST_DURATION = Histogram(
+    'team_operator_ui_request_duration_seconds',
+    'Длительность обработки запросов веб-интерфейса',
+    ['method', 'route', 'status']
+)
+HTTP_API_REQUESTS = Histogram(
+    'team_operator_ui_request_api_requests',
+    'Количество запросов к API-серверу за один запрос веб-интерфейса',
+    ['route'],
+    buckets=API_REQUESTS_BUCKETS
+)
+
+# Счетчик запросов к API текущего обработчика или HTTP-запроса.
+# Задачи asyncio, созданные внутри обработчика, наследуют контекст и увеличивают тот же счетчик
+api_request_counter = contextvars.ContextVar('api_request_counter', default=None)
+
+def parse_api_path(url):
+    """Разбирает путь запроса к API-серверу
+
+    Возвращает тип ресурса (с подресурсом через "/"), namespace (или None) и
+    признак обращения к объекту по имени.
+    """
+    parts = urllib.parse.urlsplit(url).path.strip('/').split('/')
+
+    # /api/v1/... или /apis/<группа>/<версия>/... (адрес API-сервера может содержать префикс)
+    for index, part in enumerate(parts):
+        if part == 'api':
+            parts = parts[index + 2:]
+            break
+        if part == 'apis':
+            parts = parts[index + 3:]
+            break
+    else:
+        return '', None, False
+
+    namespace = None
+    if len(parts) >= 3 and parts[0] == 'namespaces':
+        namespace = parts[1]
+        parts = parts[2:]
+    if not parts:
+        return '', None, False
+
+    resource = parts[0] if len(parts) < 3 else f"{parts[0]}/{parts[2]}"
+    return resource, namespace, len(parts) > 1
+
+def get_api_verb(method, named, query_params=None):
+    """Определяет глагол Kubernetes по HTTP-методу и пути запроса"""
+    method = method.upper()
+    if method == 'GET':
+        if named:
+            return 'get'
+        watch = dict(query_params or []).get('watch')
+        return 'watch' if watch in (True, 'true', 'True', '1') else 'list'
+    if method == 'POST':
+        return 'create'
+    if method == 'PUT':
+        return 'update'
+    if method == 'PATCH':
+        return 'patch'
+    if method == 'DELETE':
+        return 'delete' if named else 'deletecollection'
+    return method.lower()
+
+def record_api_request(component, verb, resource, code, duration):
+    """Учитывает запрос к API-серверу"""
+    API_REQUESTS.labels(component, verb, resource, str(code)).inc()
+    API_REQUEST_DURATION.labels(component, verb, resource).observe(duration)
+
+    counter = api_request_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+def start_api_request_count():
+    """Начинает подсчет запросов к API в текущем контексте
+
+    Возвращает счетчик (список из одного числа) и токен для stop_api_request_count.
+    """
+    counter = [0]
+    return counter, api_request_counter.set(counter)
+
+def stop_api_request_count(token):
+    """Завершает подсчет запросов к API, начатый start_api_request_count"""
+    api_request_counter.reset(token)
+
+@contextlib.contextmanager
+def count_api_requests():
+    """Контекст, в котором подсчитываются запросы к API"""
+    counter, token = start_api_request_count()
+    try:
+        yield counter
+    finally:
+        stop_api_request_count(token)
+
+def start_metrics_server(port):
+    """Запускает HTTP-сервер метрик в фоновом потоке"""
+    start_http_server(port)
+
+def render_metrics():
+    """Возвращает метрики в текстовом формате Prometheus и их Content-Type
+
+    Если задан PROMETHEUS_MULTIPROC_DIR (веб-интерфейс под gunicorn с
+    несколькими worker), метрики собираются со всех процессов.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,15 +1,31 @@
 #!/usr/bin/env python3
 
 import kopf
-import kubernetes
+import kubernetes_asyncio
 import yaml
 import logging
 import argparse
+import asyncio
 import os
+import random
 import sys
-import base64
 import json
 import datetime
+import hashlib
+import copy
+import signal
+import time
+import contextlib
+import fnmatch
+import functools
+import heapq
+import itertools
+import weakref
+
+import metrics
+import tracing
+from quantity import parse_quantity, validate_quota
+from user_kubeconfig import KUBECONFIG_MODES, ClusterInfo, make_cluster_info, render_kubeconfig, render_token_request
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, 
@@ -25,80 +41,494 @@ PLURAL_USERS = 'users'
 # Пространство имен для пользователей
 USERS_NAMESPACE = 'users'
 
+# Признак того, что пространство имен пользователей уже применено, и блокировка,
+# под которой его применяет первый из одновременно запущенных обработчиков
+users_namespace_applied = False
+users_namespace_lock = None
+
+# Имя кластера в kubeconfig пользователей при работе оператора внутри кластера
+CLUSTER_NAME = os.environ.get('TEAM_OPERATOR_CLUSTER_NAME', 'kubernetes')
+
+# Закешированные параметры подключения и время изменения kubeconfig, из которого они получены
+cluster_info = None
+cluster_info_mtime = None
+
+# Максимальное количество одновременных запросов к API при обработке окружений команды
+MAX_IN_FLIGHT = int(os.environ.get('TEAM_OPERATOR_MAX_IN_FLIGHT', '10'))
+
+# Ограничение частоты запросов к API-серверу на стороне клиента: запросов в секунду и допустимый всплеск
+API_QPS = float(os.environ.get('TEAM_OPERATOR_API_QPS', '50'))
+API_BURST = int(os.environ.get('TEAM_OPERATOR_API_BURST', '100'))
+
+# Размер пула соединений с API-сервером (по умолчанию - не меньше 100 и не меньше MAX_IN_FLIGHT)
+API_POOL_SIZE = int(os.environ.get('TEAM_OPERATOR_API_POOL_SIZE', '0'))
+
+# Период сверки фактического состояния объектов с желаемым (в секундах, 0 - сверка отключена)
+RECONCILE_INTERVAL = float(os.environ.get('TEAM_OPERATOR_RECONCILE_INTERVAL', '600'))
+
+# Разброс периода сверки (доля от периода), чтобы сверки команд и пользователей не совпадали по времени
+RECONCILE_JITTER = 0.1
+
+# Метки объектов, которые создает оператор
+OWNED_LABELS = {'managed-by': 'team-operator'}
+
+# Индексы объектов оператора по типам: kind -> имя индекса
+OWNED_INDEXES = {
+    'Namespace': 'owned_namespaces',
+    'ServiceAccount': 'owned_service_accounts',
+    'ConfigMap': 'owned_config_maps',
+    'ResourceQuota': 'owned_resource_quotas',
+    'NetworkPolicy': 'owned_network_policies',
+    'Role': 'owned_roles',
+    'RoleBinding': 'owned_role_bindings'
+}
+
+# Поля объектов, которые сравниваются с желаемым состоянием при сверке (кроме меток и аннотаций)
+DRIFT_FIELDS = ('spec', 'rules', 'subjects', 'roleRef', 'type')
+
+# Пространства имен (допускаются шаблоны), в которых оператор наблюдает за своими объектами.
+# Пустой список - все пространства имен; пространство имен пользователей наблюдается всегда
+WATCH_NAMESPACES = [ns for ns in os.environ.get('TEAM_OPERATOR_NAMESPACES', '').split(',') if ns]
+
+# Максимальное количество одновременно обрабатываемых объектов каждого типа (0 - без ограничения)
+MAX_WORKERS = int(os.environ.get('TEAM_OPERATOR_MAX_WORKERS', '0'))
+
+# Максимальное количество одновременно выполняемых обработчиков всех типов (0 - без ограничения).
+# Свободные места получают обработчики с более высоким приоритетом
+MAX_HANDLERS = int(os.environ.get('TEAM_OPERATOR_MAX_HANDLERS', '20'))
+
+# Максимальное количество одновременно выполняемых обработчиков команд и пользователей (0 - без ограничения)
+TEAM_CONCURRENCY = int(os.environ.get('TEAM_OPERATOR_TEAM_CONCURRENCY', '0'))
+USER_CONCURRENCY = int(os.environ.get('TEAM_OPERATOR_USER_CONCURRENCY', '0'))
+
+# Приоритеты обработчиков (меньшее значение - более высокий приоритет)
+PRIORITY_TEAM = 0
+PRIORITY_USER = 1
+PRIORITY_KUBECONFIG = 2
+PRIORITY_RECONCILE = 3
+
+# Минимальный уровень сообщений, которые публикуются как события Kubernetes
+POSTING_LEVEL = os.environ.get('TEAM_OPERATOR_POSTING_LEVEL', 'INFO')
+
+# Таймаут watch-запросов на стороне API-сервера (в секундах, 0 - значение kopf по умолчанию)
+WATCH_SERVER_TIMEOUT = float(os.environ.get('TEAM_OPERATOR_WATCH_SERVER_TIMEOUT', '0'))
+
+# Файл, в который записываются span трассировки обработчиков (пусто - трассировка отключена)
+TRACE_FILE = os.environ.get('TEAM_OPERATOR_TRACE_FILE', '')
+
+# Порт HTTP-сервера метрик Prometheus (0 - метрики не публикуются)
+METRICS_PORT = int(os.environ.get('TEAM_OPERATOR_METRICS_PORT', '8000'))
+
+# Интервал проверки удаления namespace окружений команды (в секундах)
+TEARDOWN_POLL_INTERVAL = float(os.environ.get('TEAM_OPERATOR_TEARDOWN_POLL_INTERVAL', '10'))
+
+# Окно накопления записей RoleBinding пользователей (в секундах, 0 - записи выполняются сразу)
+BATCH_WINDOW = float(os.environ.get('TEAM_OPERATOR_BATCH_WINDOW', '0'))
+
+# Срок действия токенов пользователей, запрашиваемых через TokenRequest API (в секундах)
+TOKEN_EXPIRATION = int(os.environ.get('TEAM_OPERATOR_TOKEN_EXPIRATION', '86400'))
+
+# За сколько секунд до истечения токен пользователя запрашивается заново (0 - за пятую часть срока действия)
+TOKEN_REFRESH_BEFORE = float(os.environ.get('TEAM_OPERATOR_TOKEN_REFRESH_BEFORE', '0'))
+
+# Интервал проверки истекающих токенов (в секундах) и максимальное количество токенов, обновляемых за одну проверку
+TOKEN_REFRESH_INTERVAL = float(os.environ.get('TEAM_OPERATOR_TOKEN_REFRESH_INTERVAL', '60'))
+TOKEN_REFRESH_BATCH = int(os.environ.get('TEAM_OPERATOR_TOKEN_REFRESH_BATCH', '100'))
+
+# Режим выдачи kubeconfig пользователям: configmap - оператор хранит kubeconfig в ConfigMap,
+# on-demand - веб-интерфейс формирует kubeconfig при скачивании, оператор ничего не записывает
+KUBECONFIG_MODE = os.environ.get('TEAM_OPERATOR_KUBECONFIG_MODE', 'configmap')
+
+# Аннотация ConfigMap с kubeconfig, в которой хранится время истечения токена
+TOKEN_EXPIRATION_ANNOTATION = 'team.example.com/token-expiration'
+
+# Режим привязки пользователей к ролям команд:
+# user - отдельный RoleBinding для каждого пользователя в каждом namespace команды,
+# group - один RoleBinding на роль команды в namespace со списком всех участников с этой ролью
+BINDING_MODES = ('user', 'group')
+BINDING_MODE = os.environ.get('TEAM_OPERATOR_BINDING_MODE', 'user')
+
+# Шаблоны ролей команды: роль пользователя -> правила Role.
+# Role всех шаблонов создаются в каждом окружении при создании и обновлении
+# команды, обработчики пользователей записывают только RoleBinding
+ROLE_TEMPLATES = {
+    'admin': [
+        {
+            'apiGroups': ['*'],
+            'resources': ['*'],
+            'verbs': ['*']
+        }
+    ],
+    'developer': [
+        {
+            'apiGroups': [''],
+            'resources': ['pods', 'services', 'configmaps', 'secrets'],
+            'verbs': ['get', 'list', 'watch', 'create', 'update', 'patch', 'delete']
+        },
+        {
+            'apiGroups': ['apps'],
+            'resources': ['deployments', 'statefulsets', 'daemonsets'],
+            'verbs': ['get', 'list', 'watch', 'create', 'update', 'patch', 'delete']
+        },
+        {
+            'apiGroups': ['batch'],
+            'resources': ['jobs', 'cronjobs'],
+            'verbs': ['get', 'list', 'watch', 'create', 'update', 'patch', 'delete']
+        }
+    ],
+    'viewer': [
+        {
+            'apiGroups': ['*'],
+            'resources': ['*'],
+            'verbs': ['get', 'list', 'watch']
+        }
+    ]
+}
+
+# Роли пользователей в команде
+USER_ROLES = tuple(ROLE_TEMPLATES)
+
+# Менеджер полей, от имени которого оператор применяет объекты (server-side apply)
+FIELD_MANAGER = 'team-operator'
+
+# Ресурсы, которые применяет оператор: kind -> (plural, namespaced)
+APPLY_RESOURCES = {
+    'Namespace': ('namespaces', False),
+    'ServiceAccount': ('serviceaccounts', True),
+    'ConfigMap': ('configmaps', True),
+    'ResourceQuota': ('resourcequotas', True),
+    'NetworkPolicy': ('networkpolicies', True),
+    'Role': ('roles', True),
+    'RoleBinding': ('rolebindings', True)
+}
+
+# Общий для всего процесса API-клиент
+api_client = None
+
+# Трассировка обработчиков и запросов к API-серверу
+tracer = tracing.Tracer('team-operator', TRACE_FILE)
+
+class RateLimiter:
+    """Ограничитель частоты запросов по алгоритму token bucket"""
+
+    def __init__(self, qps, burst):
+        self.qps = qps
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Дожидается свободного токена для очередного запроса"""
+        if self.qps <= 0:
+            return
+
+        # Все запросы выполняются в одном цикле событий, поэтому блокировка не нужна
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.qps)
+        self.updated = now
+        self.tokens -= 1
+        delay = -self.tokens / self.qps if self.tokens < 0 else 0
+
+        if delay:
+            await asyncio.sleep(delay)
+
+class RateLimitedApiClient(kubernetes_asyncio.client.ApiClient):
+    """ApiClient, ограничивающий частоту запросов к API-серверу"""
+
+    def __init__(self, configuration, rate_limiter):
+        super().__init__(configuration)
+        self.rate_limiter = rate_limiter
+
+    async def request(self, method, url, *args, **kwargs):
+        resource, namespace, named = metrics.parse_api_path(url)
+        verb = metrics.get_api_verb(method, named, kwargs.get('query_params'))
+
+        # Запрос учитывается в метриках и в трассировке обработчика, включая ожидание ограничителя частоты
+        with tracer.span(f"{verb} {resource}", root=False, verb=verb, resource=resource, namespace=namespace) as span:
+            await self.rate_limiter.acquire()
+
+            started = time.monotonic()
+            code = 'error'
+            try:
+                response = await super().request(method, url, *args, **kwargs)
+                code = getattr(response, 'status', code)
+                return response
+            except kubernetes_asyncio.client.exceptions.ApiException as e:
+                code = e.status
+                raise
+            finally:
+                span.set_attribute('status_code', code)
+                metrics.record_api_request('operator', verb, resource, code, time.monotonic() - started)
+
+def get_api_client():
+    """Возвращает общий для всего процесса API-клиент
+
+    Клиент создается один раз в цикле событий kopf после загрузки
+    конфигурации Kubernetes и переиспользует соединения с API-сервером
+    (keep-alive) из общего пула aiohttp.
+    """
+    global api_client
+
+    if api_client is None:
+        configuration = kubernetes_asyncio.client.Configuration.get_default_copy()
+
+        # Одновременные запросы всех обработчиков и параллельная обработка окружений
+        configuration.connection_pool_maxsize = API_POOL_SIZE or max(100, MAX_IN_FLIGHT)
+
+        api_client = RateLimitedApiClient(configuration, RateLimiter(API_QPS, API_BURST))
+    return api_client
+
+async def close_api_client():
+    """Закрывает общий API-клиент и его соединения"""
+    global api_client
+
+    if api_client is not None:
+        await api_client.close()
+        api_client = None
+
+class PriorityLimiter:
+    """Ограничитель числа одновременно выполняемых задач с приоритетами
+
+    Освободившееся место отдается ожидающей задаче с наименьшим значением
+    приоритета, при равных приоритетах - в порядке очереди. При limit <= 0
+    ограничения нет.
+    """
+
+    def __init__(self, name, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiters = []
+        self.counter = itertools.count()
+
+        # Глубина очереди и занятые места публикуются в метриках
+        metrics.HANDLERS_WAITING.labels(name).set_function(
+            lambda: sum(1 for _, _, future in self.waiters if not future.done())
+        )
+        metrics.HANDLERS_ACTIVE.labels(name).set_function(lambda: self.active)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority):
+        """Контекст, в котором задача занимает одно место"""
+        if self.limit <= 0:
+            yield
+            return
+
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Место уже было передано отмененной задаче - отдаем его следующей
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        # Место передается ожидающей задаче без освобождения, чтобы его не заняла новая задача
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+# Общее ограничение обработчиков и ограничения по типам объектов
+handler_limiter = PriorityLimiter('handlers', MAX_HANDLERS)
+kind_limiters = {
+    PLURAL_TEAMS: PriorityLimiter(PLURAL_TEAMS, TEAM_CONCURRENCY),
+    PLURAL_USERS: PriorityLimiter(PLURAL_USERS, USER_CONCURRENCY)
+}
+
+def limited(plural, priority):
+    """Выполняет обработчик в пределах ограничения его типа объектов и общего ограничения с приоритетом
+
+    Декоратор указывается под декоратором kopf. Место в общем ограничении
+    занимается только после места в ограничении типа, чтобы обработчики,
+    ожидающие своего типа, не задерживали остальные.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            async with kind_limiters[plural].slot(priority):
+                async with handler_limiter.slot(priority):
+                    return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def measured(fn):
+    """Учитывает в метриках длительность, результат и число запросов к API каждого вызова
+
+    Результат: success, failure (kopf.PermanentError) или retry (остальные
+    ошибки, после которых kopf повторяет обработку). Вызов оборачивается в
+    span трассировки, запросы к API внутри него становятся дочерними span.
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        result = 'success'
+        # kopf передает имя объекта в name, функции сверки - первым аргументом
+        name = kwargs.get('name', args[0] if args and isinstance(args[0], str) else None)
+        with tracer.span(fn.__name__, object=name) as span, metrics.count_api_requests() as api_requests:
+            try:
+                return await fn(*args, **kwargs)
+            except kopf.PermanentError:
+                result = 'failure'
+                raise
+            except Exception:
+                result = 'retry'
+                raise
+            finally:
+                span.set_attribute('result', result)
+                span.set_attribute('api_requests', api_requests[0])
+                metrics.HANDLER_DURATION.labels(fn.__name__).observe(time.monotonic() - started)
+                metrics.HANDLER_RESULTS.labels(fn.__name__, result).inc()
+                metrics.HANDLER_API_REQUESTS.labels(fn.__name__).observe(api_requests[0])
+    return wrapper
+
+def is_watched_namespace(namespace_name):
+    """Проверяет, наблюдает ли оператор за объектами в пространстве имен"""
+    if namespace_name is None or not WATCH_NAMESPACES or namespace_name == USERS_NAMESPACE:
+        return True
+    return any(fnmatch.fnmatchcase(namespace_name, pattern) for pattern in WATCH_NAMESPACES)
+
 # Функция для создания пространства имен пользователей
-def ensure_users_namespace(logger):
+async def ensure_users_namespace(logger):
     """Создает пространство имен для пользователей, если оно не существует"""
-    api = kubernetes.client.CoreV1Api()
-    
-    try:
-        # Проверяем, существует ли пространство имен
-        api.read_namespace(name=USERS_NAMESPACE)
-        logger.info(f"Пространство имен {USERS_NAMESPACE} уже существует")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 404:  # Не найдено - создаем
-            # Создаем пространство имен
-            namespace = {
-                'apiVersion': 'v1',
-                'kind': 'Namespace',
-                'metadata': {
-                    'name': USERS_NAMESPACE,
-                    'labels': {
-                        'managed-by': 'team-operator',
-                        'purpose': 'user-accounts'
-                    }
+    global users_namespace_applied, users_namespace_lock
+
+    # Пространство имен достаточно применить один раз за время работы оператора
+    if users_namespace_applied:
+        return
+
+    if users_namespace_lock is None:
+        users_namespace_lock = asyncio.Lock()
+
+    # Одновременно запущенные обработчики ждут, пока его применит первый из них
+    async with users_namespace_lock:
+        if users_namespace_applied:
+            return
+
+        namespace = {
+            'apiVersion': 'v1',
+            'kind': 'Namespace',
+            'metadata': {
+                'name': USERS_NAMESPACE,
+                'labels': {
+                    'managed-by': 'team-operator',
+                    'purpose': 'user-accounts'
                 }
             }
-            
-            try:
-                api.create_namespace(body=namespace)
-                logger.info(f"Пространство имен {USERS_NAMESPACE} создано")
-            except kubernetes.client.exceptions.ApiException as e:
-                logger.error(f"Ошибка при создании пространства имен {USERS_NAMESPACE}: {e}")
-                raise kopf.PermanentError(f"Не удалось создать пространство имен {USERS_NAMESPACE}: {e}")
-        else:
-            logger.error(f"Ошибка при проверке пространства имен {USERS_NAMESPACE}: {e}")
-            raise kopf.PermanentError(f"Не удалось проверить пространство имен {USERS_NAMESPACE}: {e}")
+        }
 
-@kopf.on.create(group=GROUP, version=VERSION, plural=PLURAL_TEAMS)
-def create_fn(body, spec, name, logger, **kwargs):
-    """Обработчик создания ресурса Team"""
-    logger.info(f"Создание ресурса Team {name}")
-    
-    # Получаем данные из спецификации
-    environments = spec.get('environments', [])
-    
-    if not environments:
-        logger.warning(f"Для команды {name} не указаны окружения")
-        kopf.warn(body, reason='NoEnvironments', message=f'Для команды {name} не указаны окружения')
-        return {'environments_created': 0}
-    
-    # Создаем API-клиент Kubernetes
-    api = kubernetes.client.CoreV1Api()
-    rbac_api = kubernetes.client.RbacAuthorizationV1Api()
-    
-    created_namespaces = []
-    
-    # Создаем namespace для каждого окружения
-    for env in environments:
-        env_name = env.get('name')
-        env_description = env.get('description', '')
-        env_labels = env.get('labels', {})
-        
-        if not env_name:
-            logger.warning(f"Пропускаем окружение без имени для команды {name}")
-            continue
-        
-        # Формируем имя namespace на основе имени команды и окружения
-        namespace_name = f"{name}-{env_name}".lower()
-        
-        # Создаем namespace
-        namespace = {
+        try:
+            await apply_object(namespace, logger)
+            users_namespace_applied = True
+        except kubernetes_asyncio.client.exceptions.ApiException as e:
+            logger.error(f"Ошибка при применении пространства имен {USERS_NAMESPACE}: {e}")
+            raise kopf.PermanentError(f"Не удалось создать пространство имен {USERS_NAMESPACE}: {e}")
+
+def compute_hash(*manifests):
+    """Возвращает хеш содержимого желаемых объектов
+
+    Хеш сохраняется в статусе ресурса и позволяет пропускать запись объектов,
+    желаемое состояние которых не изменилось с прошлой обработки.
+    """
+    data = json.dumps(manifests, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+async def apply_object(manifest, logger):
+    """Применяет объект через server-side apply и возвращает его итоговое состояние
+
+    Объект отправляется целиком одним PATCH-запросом от имени FIELD_MANAGER,
+    поэтому запрос идемпотентен: отсутствующий объект создается, существующий
+    приводится к желаемому состоянию без предварительного чтения.
+    """
+    api_version = manifest['apiVersion']
+    metadata = manifest['metadata']
+    plural, namespaced = APPLY_RESOURCES[manifest['kind']]
+
+    # Формируем путь к объекту в API
+    prefix = '/api/v1' if api_version == 'v1' else f"/apis/{api_version}"
+    if namespaced:
+        path = f"{prefix}/namespaces/{metadata['namespace']}/{plural}/{metadata['name']}"
+    else:
+        path = f"{prefix}/{plural}/{metadata['name']}"
+
+    result = await get_api_client().call_api(
+        path, 'PATCH',
+        query_params=[('fieldManager', FIELD_MANAGER), ('force', 'true')],
+        header_params={
+            'Accept': 'application/json',
+            'Content-Type': 'application/apply-patch+yaml'
+        },
+        body=manifest,
+        response_types_map={200: 'object', 201: 'object'},
+        auth_settings=['BearerToken'],
+        _return_http_data_only=True
+    )
+
+    if namespaced:
+        logger.info(f"{manifest['kind']} {metadata['name']} применен в пространстве имен {metadata['namespace']}")
+    else:
+        logger.info(f"{manifest['kind']} {metadata['name']} применен")
+    return result
+
+def get_namespace_name(team_name, env_name):
+    """Возвращает имя namespace для окружения команды"""
+    return f"{team_name}-{env_name}".lower()
+
+def get_user_role_name(team_name, role):
+    """Возвращает имя роли команды в зависимости от роли пользователя"""
+    if role not in ROLE_TEMPLATES:
+        role = 'viewer'
+    return f"{team_name}-{role}"
+
+def render_team_role(team_name, role, namespace_name):
+    """Формирует манифест Role команды по шаблону роли пользователя"""
+    return {
+        'apiVersion': 'rbac.authorization.k8s.io/v1',
+        'kind': 'Role',
+        'metadata': {
+            'name': get_user_role_name(team_name, role),
+            'namespace': namespace_name,
+            'labels': {
+                'team': team_name,
+                'managed-by': 'team-operator'
+            }
+        },
+        'rules': ROLE_TEMPLATES.get(role, ROLE_TEMPLATES['viewer'])
+    }
+
+def render_environment(team_name, env):
+    """Формирует манифесты ресурсов окружения команды"""
+    env_name = env.get('name')
+    env_description = env.get('description', '')
+    env_labels = env.get('labels', {})
+    quota = env.get('quota', {})
+    network_policy = env.get('network_policy', {})
+
+    # Формируем имя namespace на основе имени команды и окружения
+    namespace_name = get_namespace_name(team_name, env_name)
+
+    return {
+        'namespace': {
             'apiVersion': 'v1',
             'kind': 'Namespace',
             'metadata': {
                 'name': namespace_name,
                 'labels': {
-                    'team': name,
+                    'team': team_name,
                     'environment': env_name,
                     'managed-by': 'team-operator',
                     **env_labels
@@ -107,140 +537,193 @@ def create_fn(body, spec, name, logger, **kwargs):
                     'description': env_description
                 }
             }
-        }
-        
-        # Создаем ResourceQuota для namespace
-        resource_quota = {
+        },
+        'resource_quota': {
             'apiVersion': 'v1',
             'kind': 'ResourceQuota',
             'metadata': {
                 'name': f"{namespace_name}-quota",
-                'namespace': namespace_name
+                'namespace': namespace_name,
+                'labels': {
+                    'team': team_name,
+                    'environment': env_name,
+                    'managed-by': 'team-operator'
+                }
             },
             'spec': {
                 'hard': {
-                    'requests.cpu': env.get('quota', {}).get('cpu', '10'),
-                    'requests.memory': env.get('quota', {}).get('memory', '20Gi'),
-                    'limits.cpu': env.get('quota', {}).get('cpu_limit', '20'),
-                    'limits.memory': env.get('quota', {}).get('memory_limit', '40Gi'),
-                    'pods': env.get('quota', {}).get('pods', '20'),
-                    'services': env.get('quota', {}).get('services', '10')
+                    'requests.cpu': quota.get('cpu', '10'),
+                    'requests.memory': quota.get('memory', '20Gi'),
+                    'limits.cpu': quota.get('cpu_limit', '20'),
+                    'limits.memory': quota.get('memory_limit', '40Gi'),
+                    'pods': quota.get('pods', '20'),
+                    'services': quota.get('services', '10')
                 }
             }
-        }
-        
-        # Создаем NetworkPolicy для namespace
-        network_policy = {
+        },
+        'network_policy': {
             'apiVersion': 'networking.k8s.io/v1',
             'kind': 'NetworkPolicy',
             'metadata': {
                 'name': f"{namespace_name}-default-deny",
-                'namespace': namespace_name
+                'namespace': namespace_name,
+                'labels': {
+                    'team': team_name,
+                    'environment': env_name,
+                    'managed-by': 'team-operator'
+                }
             },
             'spec': {
                 'podSelector': {},
                 'policyTypes': ['Ingress', 'Egress'],
-                'ingress': env.get('network_policy', {}).get('ingress', []),
-                'egress': env.get('network_policy', {}).get('egress', [])
+                'ingress': network_policy.get('ingress', []),
+                'egress': network_policy.get('egress', [])
             }
-        }
-        
-        # Создаем Role и RoleBinding для команды
-        role = {
-            'apiVersion': 'rbac.authorization.k8s.io/v1',
-            'kind': 'Role',
-            'metadata': {
-                'name': f"{name}-admin",
-                'namespace': namespace_name
-            },
-            'rules': [
-                {
-                    'apiGroups': ['*'],
-                    'resources': ['*'],
-                    'verbs': ['*']
-                }
-            ]
-        }
-        
-        role_binding = {
+        },
+        **{
+            f"role_{role}": render_team_role(team_name, role, namespace_name)
+            for role in ROLE_TEMPLATES
+        },
+        'role_binding': {
             'apiVersion': 'rbac.authorization.k8s.io/v1',
             'kind': 'RoleBinding',
             'metadata': {
-                'name': f"{name}-admin-binding",
-                'namespace': namespace_name
+                'name': f"{team_name}-admin-binding",
+                'namespace': namespace_name,
+                'labels': {
+                    'team': team_name,
+                    'managed-by': 'team-operator'
+                }
             },
             'subjects': [
                 {
                     'kind': 'Group',
-                    'name': f"{name}-admins",
+                    'name': f"{team_name}-admins",
                     'apiGroup': 'rbac.authorization.k8s.io'
                 }
             ],
             'roleRef': {
                 'kind': 'Role',
-                'name': f"{name}-admin",
+                'name': f"{team_name}-admin",
                 'apiGroup': 'rbac.authorization.k8s.io'
             }
         }
-        
+    }
+
+async def run_environment_jobs(jobs):
+    """Выполняет задания по окружениям параллельно.
+
+    Задание - корутина, которая выполняет первый шаг (namespace) и
+    возвращает список шагов - корутин, не зависящих друг от друга и
+    выполняемых параллельно после первого шага. Одновременно выполняется
+    не более MAX_IN_FLIGHT запросов. Возвращает списки ошибок в порядке заданий.
+    """
+    semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+    async def bounded(coro):
+        async with semaphore:
+            return await coro
+
+    async def run_job(job):
         try:
-            # Создаем namespace
-            api.create_namespace(body=namespace)
-            logger.info(f"Namespace {namespace_name} создан для команды {name}, окружение {env_name}")
-            
-            # Создаем ResourceQuota
-            api.create_namespaced_resource_quota(
-                namespace=namespace_name,
-                body=resource_quota
-            )
-            logger.info(f"ResourceQuota создана для namespace {namespace_name}")
-            
-            # Создаем NetworkPolicy
-            net_api = kubernetes.client.NetworkingV1Api()
-            net_api.create_namespaced_network_policy(
-                namespace=namespace_name,
-                body=network_policy
-            )
-            logger.info(f"NetworkPolicy создана для namespace {namespace_name}")
-            
-            # Создаем Role
-            rbac_api.create_namespaced_role(
-                namespace=namespace_name,
-                body=role
-            )
-            logger.info(f"Role создана для namespace {namespace_name}")
-            
-            # Создаем RoleBinding
-            rbac_api.create_namespaced_role_binding(
-                namespace=namespace_name,
-                body=role_binding
-            )
-            logger.info(f"RoleBinding создан для namespace {namespace_name}")
-            
-            created_namespaces.append({
-                'name': namespace_name,
-                'environment': env_name,
-                'description': env_description
-            })
-            
-        except kubernetes.client.exceptions.ApiException as e:
-            logger.error(f"Ошибка при создании ресурсов для namespace {namespace_name}: {e}")
-            if e.status == 409:  # Конфликт - ресурс уже существует
-                logger.info(f"Namespace {namespace_name} уже существует")
-                created_namespaces.append({
-                    'name': namespace_name,
-                    'environment': env_name,
-                    'description': env_description,
-                    'status': 'already_exists'
-                })
-            else:
-                raise kopf.PermanentError(f"Не удалось создать ресурсы для namespace {namespace_name}: {e}")
-    
-    
+            steps = await bounded(job)
+        except Exception as e:
+            return [e]
+
+        # После применения namespace запускаем остальные шаги окружения
+        results = await asyncio.gather(*(bounded(step) for step in steps), return_exceptions=True)
+        return [result for result in results if isinstance(result, Exception)]
+
+    return await asyncio.gather(*(run_job(job) for job in jobs))
+
+async def apply_environment_job(manifests, logger):
+    """Задание применения ресурсов окружения"""
+    # Применяем namespace - остальные объекты зависят от него
+    await apply_object(manifests['namespace'], logger)
+
+    return [apply_object(manifest, logger) for key, manifest in manifests.items() if key != 'namespace']
+
+def raise_environment_failure(namespace_name, e, action):
+    """Преобразует ошибку обработки окружения в ошибку обработчика"""
+    if not isinstance(e, kubernetes_asyncio.client.exceptions.ApiException):
+        raise e
+    raise kopf.PermanentError(f"Не удалось {action} ресурсы для namespace {namespace_name}: {e}")
+
+def validate_environments(team_name, environments):
+    """Проверяет квоты окружений команды до применения каких-либо объектов"""
+    errors = []
+    for env in environments:
+        for error in validate_quota(env.get('quota')):
+            errors.append(f"окружение {env.get('name')}: {error}")
+
+    if errors:
+        raise kopf.PermanentError(f"Некорректные квоты команды {team_name}: {'; '.join(errors)}")
+
+@kopf.on.create(group=GROUP, version=VERSION, plural=PLURAL_TEAMS)
+@limited(PLURAL_TEAMS, PRIORITY_TEAM)
+@measured
+async def create_fn(body, spec, name, patch, team_members, logger, **kwargs):
+    """Обработчик создания ресурса Team"""
+    logger.info(f"Создание ресурса Team {name}")
+
+    # Получаем данные из спецификации
+    environments = spec.get('environments', [])
+
+    if not environments:
+        logger.warning(f"Для команды {name} не указаны окружения")
+        kopf.warn(body, reason='NoEnvironments', message=f'Для команды {name} не указаны окружения')
+        return {'environments_created': 0}
+
+    validate_environments(name, environments)
+
+    # Готовим задания для каждого окружения
+    envs = []
+    jobs = []
+    for env in environments:
+        if not env.get('name'):
+            logger.warning(f"Пропускаем окружение без имени для команды {name}")
+            continue
+
+        manifests = render_environment(name, env)
+        envs.append((env, compute_hash(manifests)))
+        jobs.append(apply_environment_job(manifests, logger))
+
+    # Создаем окружения параллельно
+    created_namespaces = []
+    hashes = {}
+    failures = []
+    for (env, env_hash), errors in zip(envs, await run_environment_jobs(jobs)):
+        namespace_name = get_namespace_name(name, env['name'])
+
+        if errors:
+            for e in errors:
+                logger.error(f"Ошибка при создании ресурсов для namespace {namespace_name}: {e}")
+            failures.append((namespace_name, errors[0]))
+            continue
+
+        created_namespaces.append({
+            'name': namespace_name,
+            'environment': env['name'],
+            'description': env.get('description', '')
+        })
+        hashes[namespace_name] = env_hash
+
+    # Сохраняем хеши примененных окружений, чтобы не переприменять их без изменений
+    patch.status['team-operator'] = {
+        'namespaces': created_namespaces,
+        'hashes': hashes
+    }
+
+    # Пользователи могли быть добавлены в команду до ее создания
+    await bind_team_members(name, [ns['name'] for ns in created_namespaces], team_members, logger)
+
+    if failures:
+        raise_environment_failure(*failures[0], 'создать')
+
     # Обновляем статус ресурса
     message = f'Созданы окружения для команды {name}: {len(created_namespaces)}'
     kopf.info(body, reason='Created', message=message)
-    
+
     # Возвращаем информацию о созданных ресурсах
     return {
         'environments_created': len(created_namespaces),
@@ -248,331 +731,288 @@ def create_fn(body, spec, name, logger, **kwargs):
     }
 
 @kopf.on.update(group=GROUP, version=VERSION, plural=PLURAL_TEAMS)
-def update_fn(body, spec, status, name, logger, **kwargs):
+@limited(PLURAL_TEAMS, PRIORITY_TEAM)
+@measured
+async def update_fn(body, spec, status, old, name, patch, team_members, logger, **kwargs):
     """Обработчик обновления ресурса Team"""
     logger.info(f"Обновление ресурса Team {name}")
-    
+
     # Получаем данные из спецификации
     environments = spec.get('environments', [])
-    
-    # Получаем текущие окружения из статуса
+    validate_environments(name, environments)
+
+    # Получаем текущие окружения из статуса и предыдущей версии спецификации
     current_namespaces = status.get('team-operator', {}).get('namespaces', [])
     current_namespace_names = [ns['name'] for ns in current_namespaces if 'name' in ns]
-    
-    # Создаем API-клиент Kubernetes
-    api = kubernetes.client.CoreV1Api()
-    rbac_api = kubernetes.client.RbacAuthorizationV1Api()
-    
-    updated_namespaces = []
-    created_namespaces = []
-    
-    # Обрабатываем каждое окружение из спецификации
+    for env in (old or {}).get('spec', {}).get('environments', []):
+        if env.get('name') and get_namespace_name(name, env['name']) not in current_namespace_names:
+            current_namespace_names.append(get_namespace_name(name, env['name']))
+
+    # Хеши желаемого состояния окружений с прошлой обработки
+    current_hashes = status.get('team-operator', {}).get('hashes', {})
+
+    # Готовим задания для окружений, желаемое состояние которых изменилось
+    unchanged_namespaces = []
+    hashes = {}
+    envs = []
+    jobs = []
     for env in environments:
-        env_name = env.get('name')
-        env_description = env.get('description', '')
-        env_labels = env.get('labels', {})
-        
-        if not env_name:
+        if not env.get('name'):
             logger.warning(f"Пропускаем окружение без имени для команды {name}")
             continue
-        
-        # Формируем имя namespace на основе имени команды и окружения
-        namespace_name = f"{name}-{env_name}".lower()
-        
-        # Проверяем, существует ли уже namespace
-        try:
-            existing_ns = api.read_namespace(name=namespace_name)
-            
-            # Обновляем метки и аннотации namespace
-            existing_ns.metadata.labels.update({
-                'team': name,
-                'environment': env_name,
-                'managed-by': 'team-operator',
-                **env_labels
+
+        namespace_name = get_namespace_name(name, env['name'])
+        manifests = render_environment(name, env)
+        env_hash = compute_hash(manifests)
+
+        if current_hashes.get(namespace_name) == env_hash:
+            logger.info(f"Окружение {namespace_name} не изменилось, пропускаем")
+            unchanged_namespaces.append({
+                'name': namespace_name,
+                'environment': env['name'],
+                'description': env.get('description', ''),
+                'status': 'unchanged'
             })
-            existing_ns.metadata.annotations['description'] = env_description
-            
-            # Применяем изменения
-            api.patch_namespace(name=namespace_name, body=existing_ns)
-            logger.info(f"Namespace {namespace_name} обновлен")
-            
-            # Обновляем ResourceQuota
-            try:
-                resource_quota = {
-                    'apiVersion': 'v1',
-                    'kind': 'ResourceQuota',
-                    'metadata': {
-                        'name': f"{namespace_name}-quota",
-                    },
-                    'spec': {
-                        'hard': {
-                            'requests.cpu': env.get('quota', {}).get('cpu', '10'),
-                            'requests.memory': env.get('quota', {}).get('memory', '20Gi'),
-                            'limits.cpu': env.get('quota', {}).get('cpu_limit', '20'),
-                            'limits.memory': env.get('quota', {}).get('memory_limit', '40Gi'),
-                            'pods': env.get('quota', {}).get('pods', '20'),
-                            'services': env.get('quota', {}).get('services', '10')
-                        }
-                    }
-                }
-                
-                api.patch_namespaced_resource_quota(
-                    name=f"{namespace_name}-quota",
-                    namespace=namespace_name,
-                    body=resource_quota
-                )
-                logger.info(f"ResourceQuota обновлена для namespace {namespace_name}")
-            except kubernetes.client.exceptions.ApiException as e:
-                if e.status == 404:  # Не найдено - создаем заново
-                    resource_quota['metadata']['namespace'] = namespace_name
-                    api.create_namespaced_resource_quota(
-                        namespace=namespace_name,
-                        body=resource_quota
-                    )
-                    logger.info(f"ResourceQuota создана для namespace {namespace_name}")
-                else:
-                    logger.error(f"Ошибка при обновлении ResourceQuota для {namespace_name}: {e}")
-            
+            hashes[namespace_name] = env_hash
+            continue
+
+        envs.append((env, env_hash))
+        jobs.append(apply_environment_job(manifests, logger))
+
+    # Применяем окружения параллельно
+    updated_namespaces = []
+    created_namespaces = []
+    failures = []
+    for (env, env_hash), errors in zip(envs, await run_environment_jobs(jobs)):
+        namespace_name = get_namespace_name(name, env['name'])
+
+        if errors:
+            for e in errors:
+                logger.error(f"Ошибка при обновлении ресурсов для namespace {namespace_name}: {e}")
+            failures.append((namespace_name, errors[0]))
+            hashes[namespace_name] = None
+            continue
+
+        if namespace_name in current_namespace_names:
             updated_namespaces.append({
                 'name': namespace_name,
-                'environment': env_name,
-                'description': env_description,
+                'environment': env['name'],
+                'description': env.get('description', ''),
                 'status': 'updated'
             })
-            
-        except kubernetes.client.exceptions.ApiException as e:
-            if e.status == 404:  # Не найдено - создаем новый namespace
-                # Создаем namespace
-                namespace = {
-                    'apiVersion': 'v1',
-                    'kind': 'Namespace',
-                    'metadata': {
-                        'name': namespace_name,
-                        'labels': {
-                            'team': name,
-                            'environment': env_name,
-                            'managed-by': 'team-operator',
-                            **env_labels
-                        },
-                        'annotations': {
-                            'description': env_description
-                        }
-                    }
-                }
-                
-                # Создаем ResourceQuota для namespace
-                resource_quota = {
-                    'apiVersion': 'v1',
-                    'kind': 'ResourceQuota',
-                    'metadata': {
-                        'name': f"{namespace_name}-quota",
-                        'namespace': namespace_name
-                    },
-                    'spec': {
-                        'hard': {
-                            'requests.cpu': env.get('quota', {}).get('cpu', '10'),
-                            'requests.memory': env.get('quota', {}).get('memory', '20Gi'),
-                            'limits.cpu': env.get('quota', {}).get('cpu_limit', '20'),
-                            'limits.memory': env.get('quota', {}).get('memory_limit', '40Gi'),
-                            'pods': env.get('quota', {}).get('pods', '20'),
-                            'services': env.get('quota', {}).get('services', '10')
-                        }
-                    }
-                }
-                
-                # Создаем NetworkPolicy для namespace
-                network_policy = {
-                    'apiVersion': 'networking.k8s.io/v1',
-                    'kind': 'NetworkPolicy',
-                    'metadata': {
-                        'name': f"{namespace_name}-default-deny",
-                        'namespace': namespace_name
-                    },
-                    'spec': {
-                        'podSelector': {},
-                        'policyTypes': ['Ingress', 'Egress'],
-                        'ingress': env.get('network_policy', {}).get('ingress', []),
-                        'egress': env.get('network_policy', {}).get('egress', [])
-                    }
-                }
-                
-                # Создаем Role и RoleBinding для команды
-                role = {
-                    'apiVersion': 'rbac.authorization.k8s.io/v1',
-                    'kind': 'Role',
-                    'metadata': {
-                        'name': f"{name}-admin",
-                        'namespace': namespace_name
-                    },
-                    'rules': [
-                        {
-                            'apiGroups': ['*'],
-                            'resources': ['*'],
-                            'verbs': ['*']
-                        }
-                    ]
-                }
-                
-                role_binding = {
-                    'apiVersion': 'rbac.authorization.k8s.io/v1',
-                    'kind': 'RoleBinding',
-                    'metadata': {
-                        'name': f"{name}-admin-binding",
-                        'namespace': namespace_name
-                    },
-                    'subjects': [
-                        {
-                            'kind': 'Group',
-                            'name': f"{name}-admins",
-                            'apiGroup': 'rbac.authorization.k8s.io'
-                        }
-                    ],
-                    'roleRef': {
-                        'kind': 'Role',
-                        'name': f"{name}-admin",
-                        'apiGroup': 'rbac.authorization.k8s.io'
-                    }
-                }
-                
-                try:
-                    # Создаем namespace
-                    api.create_namespace(body=namespace)
-                    logger.info(f"Namespace {namespace_name} создан для команды {name}, окружение {env_name}")
-                    
-                    # Создаем ResourceQuota
-                    api.create_namespaced_resource_quota(
-                        namespace=namespace_name,
-                        body=resource_quota
-                    )
-                    logger.info(f"ResourceQuota создана для namespace {namespace_name}")
-                    
-                    # Создаем NetworkPolicy
-                    net_api = kubernetes.client.NetworkingV1Api()
-                    net_api.create_namespaced_network_policy(
-                        namespace=namespace_name,
-                        body=network_policy
-                    )
-                    logger.info(f"NetworkPolicy создана для namespace {namespace_name}")
-                    
-                    # Создаем Role
-                    rbac_api.create_namespaced_role(
-                        namespace=namespace_name,
-                        body=role
-                    )
-                    logger.info(f"Role создана для namespace {namespace_name}")
-                    
-                    # Создаем RoleBinding
-                    rbac_api.create_namespaced_role_binding(
-                        namespace=namespace_name,
-                        body=role_binding
-                    )
-                    logger.info(f"RoleBinding создан для namespace {namespace_name}")
-                    
-                    created_namespaces.append({
-                        'name': namespace_name,
-                        'environment': env_name,
-                        'description': env_description,
-                        'status': 'created'
-                    })
-                    
-                except kubernetes.client.exceptions.ApiException as e:
-                    logger.error(f"Ошибка при создании ресурсов для namespace {namespace_name}: {e}")
-                    raise kopf.PermanentError(f"Не удалось создать ресурсы для namespace {namespace_name}: {e}")
-            else:
-                logger.error(f"Ошибка при обновлении namespace {namespace_name}: {e}")
-                raise kopf.PermanentError(f"Не удалось обновить namespace {namespace_name}: {e}")
-    
+        else:
+            created_namespaces.append({
+                'name': namespace_name,
+                'environment': env['name'],
+                'description': env.get('description', ''),
+                'status': 'created'
+            })
+        hashes[namespace_name] = env_hash
+
+    # Привязываем текущих участников команды к новым окружениям
+    await bind_team_members(name, [ns['name'] for ns in created_namespaces], team_members, logger)
+
+    if failures:
+        patch.status['team-operator'] = {'hashes': hashes}
+        raise_environment_failure(*failures[0], 'обновить')
+
     # Проверяем, есть ли окружения, которые нужно удалить
-    env_names_in_spec = [f"{name}-{env.get('name')}".lower() for env in environments if env.get('name')]
+    env_names_in_spec = [get_namespace_name(name, env.get('name')) for env in environments if env.get('name')]
     namespaces_to_delete = [ns for ns in current_namespace_names if ns not in env_names_in_spec]
-    
-    deleted_namespaces = []
+
+    # Удаляем namespace одновременно, не дожидаясь их завершения: ход удаления
+    # отслеживает таймер teardown_progress_timer по статусу команды
+    teardown = await delete_namespaces(namespaces_to_delete, logger)
+    deleted_namespaces = [ns_name for ns_name, state in teardown.items() if state != 'error']
     for ns_name in namespaces_to_delete:
-        try:
-            api.delete_namespace(name=ns_name)
-            logger.info(f"Namespace {ns_name} удален")
-            deleted_namespaces.append(ns_name)
-        except kubernetes.client.exceptions.ApiException as e:
-            logger.error(f"Ошибка при удалении namespace {ns_name}: {e}")
-    
-    
+        hashes[ns_name] = None
+
+    # Удаляем из статуса хеши окружений, которых больше нет
+    for ns_name in current_hashes:
+        if ns_name not in hashes:
+            hashes[ns_name] = None
+
+    # Сохраняем окружения, хеши их желаемого состояния и состояние удаляемых namespace
+    patch.status['team-operator'] = {
+        'namespaces': created_namespaces + updated_namespaces + unchanged_namespaces,
+        'hashes': hashes
+    }
+    teardown = {ns_name: state for ns_name, state in teardown.items() if state != 'deleted'}
+
+    # Окружения, которые вернули в команду до завершения удаления, больше не отслеживаются
+    for ns_name in status.get('team-operator', {}).get('teardown') or {}:
+        if ns_name in env_names_in_spec:
+            teardown[ns_name] = None
+    if teardown:
+        patch.status['team-operator']['teardown'] = teardown
+
     # Обновляем статус ресурса
-    message = f'Обновлены окружения для команды {name}: создано {len(created_namespaces)}, обновлено {len(updated_namespaces)}, удалено {len(deleted_namespaces)}'
+    message = f'Обновлены окружения для команды {name}: создано {len(created_namespaces)}, обновлено {len(updated_namespaces)}, без изменений {len(unchanged_namespaces)}, удалено {len(deleted_namespaces)}'
     kopf.info(body, reason='Updated', message=message)
-    
+
     # Возвращаем информацию об обновленных ресурсах
     return {
         'environments_created': len(created_namespaces),
         'environments_updated': len(updated_namespaces),
+        'environments_unchanged': len(unchanged_namespaces),
         'environments_deleted': len(deleted_namespaces),
-        'namespaces': created_namespaces + updated_namespaces,
+        'namespaces': created_namespaces + updated_namespaces + unchanged_namespaces,
         'deleted_namespaces': deleted_namespaces
     }
 
+def get_namespace_state(owned_namespaces, namespace_name):
+    """Возвращает состояние namespace по индексу: active, terminating или deleted"""
+    for summary in owned_namespaces.get((None, namespace_name), []):
+        return 'terminating' if summary.get('terminating') else 'active'
+    return 'deleted'
+
+async def delete_namespaces(namespace_names, logger):
+    """Запрашивает удаление namespace одновременно (не более MAX_IN_FLIGHT запросов)
+
+    Не дожидается завершения удаления. Возвращает состояние каждого
+    namespace: terminating, deleted (namespace уже нет) или error.
+    """
+    api = kubernetes_asyncio.client.CoreV1Api(get_api_client())
+    semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+    async def delete(namespace_name):
+        async with semaphore:
+            try:
+                # Удаляем namespace (это автоматически удалит все ресурсы внутри)
+                await api.delete_namespace(name=namespace_name)
+                logger.info(f"Namespace {namespace_name} удаляется")
+                return 'terminating'
+            except kubernetes_asyncio.client.exceptions.ApiException as e:
+                if e.status == 404:  # Не найдено
+                    logger.info(f"Namespace {namespace_name} не существует или уже удален")
+                    return 'deleted'
+                if e.status == 409:  # Уже удаляется
+                    return 'terminating'
+                logger.error(f"Ошибка при удалении namespace {namespace_name}: {e}")
+                return 'error'
+
+    states = await asyncio.gather(*(delete(namespace_name) for namespace_name in namespace_names))
+    return dict(zip(namespace_names, states))
+
 @kopf.on.delete(group=GROUP, version=VERSION, plural=PLURAL_TEAMS)
-def delete_fn(body, spec, name, logger, **kwargs):
-    """Обработчик удаления ресурса Team"""
+@limited(PLURAL_TEAMS, PRIORITY_TEAM)
+@measured
+async def delete_fn(body, spec, status, name, patch, owned_namespaces, logger, **kwargs):
+    """Обработчик удаления ресурса Team
+
+    Удаление всех namespace окружений запрашивается одновременно, после чего
+    обработчик завершается с повторной попыткой через TEARDOWN_POLL_INTERVAL,
+    пока namespace не исчезнут из индекса owned_namespaces. Состояние каждого
+    namespace сохраняется в статусе команды, а ресурс Team удаляется только
+    после удаления всех его namespace.
+    """
     logger.info(f"Удаление ресурса Team {name}")
     
-    # Получаем данные из спецификации
-    environments = spec.get('environments', [])
+    # Namespace окружений из спецификации и из статуса
+    namespace_names = [get_namespace_name(name, env['name']) for env in spec.get('environments', []) if env.get('name')]
+    for ns in status.get('team-operator', {}).get('namespaces', []):
+        if ns.get('name') and ns['name'] not in namespace_names:
+            namespace_names.append(ns['name'])
     
-    # Создаем API-клиент Kubernetes
-    api = kubernetes.client.CoreV1Api()
+    # Запрашиваем удаление namespace, которые еще не удаляются
+    states = {ns_name: get_namespace_state(owned_namespaces, ns_name) for ns_name in namespace_names}
+    states.update(await delete_namespaces([ns_name for ns_name, state in states.items() if state == 'active'], logger))
     
-    deleted_namespaces = []
-    
-    # Удаляем namespace для каждого окружения
-    for env in environments:
-        env_name = env.get('name')
-        
-        if not env_name:
-            continue
-        
-        # Формируем имя namespace на основе имени команды и окружения
-        namespace_name = f"{name}-{env_name}".lower()
-        
-        try:
-            # Удаляем namespace (это автоматически удалит все ресурсы внутри)
-            api.delete_namespace(name=namespace_name)
-            logger.info(f"Namespace {namespace_name} удален")
-            deleted_namespaces.append(namespace_name)
-        except kubernetes.client.exceptions.ApiException as e:
-            if e.status == 404:  # Не найдено
-                logger.info(f"Namespace {namespace_name} не существует или уже удален")
-            else:
-                logger.warning(f"Ошибка при удалении namespace {namespace_name}: {e}")
+    patch.status['team-operator'] = {'teardown': states}
     
+    remaining = [ns_name for ns_name, state in states.items() if state != 'deleted']
+    if remaining:
+        raise kopf.TemporaryError(f"Ожидание удаления namespace: {', '.join(remaining)}", delay=TEARDOWN_POLL_INTERVAL)
     
     # Обновляем статус ресурса (хотя это не будет сохранено, так как ресурс удаляется)
-    kopf.info(body, reason='Deleted', message=f'Удалены окружения для команды {name}: {len(deleted_namespaces)}')
+    kopf.info(body, reason='Deleted', message=f'Удалены окружения для команды {name}: {len(namespace_names)}')
     
     # Возвращаем информацию об удаленных ресурсах
     return {
-        'environments_deleted': len(deleted_namespaces),
-        'deleted_namespaces': deleted_namespaces
+        'environments_deleted': len(namespace_names),
+        'deleted_namespaces': namespace_names
     }
 
-@kopf.on.create(group=GROUP, version=VERSION, plural=PLURAL_USERS)
-def create_user(body, spec, name, logger, **kwargs):
-    """Обработчик создания ресурса User"""
-    logger.info(f"Создание ресурса User {name}")
-    
-    # Убеждаемся, что пространство имен пользователей существует
-    ensure_users_namespace(logger)
-    
-    # Получаем данные из спецификации
+def has_teardown(status, **kwargs):
+    """Проверяет, есть ли у команды namespace, удаление которых еще не завершено"""
+    return bool(status.get('team-operator', {}).get('teardown'))
+
+@kopf.timer(group=GROUP, version=VERSION, plural=PLURAL_TEAMS, interval=TEARDOWN_POLL_INTERVAL, when=has_teardown)
+@measured
+async def teardown_progress_timer(name, status, meta, patch, owned_namespaces, team_namespaces, logger, **kwargs):
+    """Отслеживает удаление namespace окружений, убранных из команды
+
+    Состояние берется из индекса owned_namespaces без запросов к API.
+    Удаленные namespace убираются из статуса, удаление namespace, которое
+    завершилось ошибкой, запрашивается повторно. Namespace окружений, которые
+    снова есть в команде, убираются из статуса без удаления.
+    """
+    teardown = status['team-operator']['teardown']
+
+    # Пока удаляется сама команда, удаляются все ее окружения
+    restored = set()
+    if not meta.get('deletionTimestamp'):
+        restored = set(get_team_namespaces(team_namespaces, name) or []) & set(teardown)
+    for ns_name in sorted(restored):
+        logger.info(f"Окружение {ns_name} снова есть в команде, удаление не отслеживается")
+
+    states = {ns_name: get_namespace_state(owned_namespaces, ns_name) for ns_name in teardown if ns_name not in restored}
+
+    retry = [ns_name for ns_name, state in states.items() if state == 'active' and teardown[ns_name] == 'error']
+    states.update(await delete_namespaces(retry, logger))
+
+    for ns_name, state in states.items():
+        if state == 'deleted':
+            logger.info(f"Namespace {ns_name} удален")
+            states[ns_name] = None
+        elif state == 'active':
+            # Индекс еще не получил событие об удалении
+            states[ns_name] = teardown[ns_name]
+    for ns_name in restored:
+        states[ns_name] = None
+
+    patch.status['team-operator'] = {'teardown': states}
+
+@kopf.index(group=GROUP, version=VERSION, plural=PLURAL_TEAMS)
+def team_namespaces(name, spec, **kwargs):
+    """Индекс команд: имя команды -> список namespace ее окружений"""
+    return {name: [get_namespace_name(name, env['name']) for env in spec.get('environments', []) if env.get('name')]}
+
+def get_team_namespaces(team_namespaces, team_name):
+    """Возвращает namespace окружений команды из индекса или None, если команда не найдена"""
+    for namespaces in team_namespaces.get(team_name, []):
+        return namespaces
+    return None
+
+@kopf.index(group=GROUP, version=VERSION, plural=PLURAL_USERS)
+def team_members(name, spec, meta, **kwargs):
+    """Индекс участников команд: имя команды -> (имя пользователя, роль)
+
+    Пользователи, которые удаляются, в индекс не попадают.
+    """
+    if meta.get('deletionTimestamp'):
+        return {}
+
+    role = spec.get('role', 'developer')
+    return {team_name: (name, role) for team_name in spec.get('teams', [])}
+
+def get_team_members(team_members, team_name, role, exclude=None):
+    """Возвращает отсортированный список участников команды с указанной ролью
+
+    Пользователь exclude не включается в список.
+    """
+    return sorted({
+        member for member, member_role in team_members.get(team_name, [])
+        if member_role == role and member != exclude
+    })
+
+def render_service_account(name, spec):
+    """Формирует манифест ServiceAccount пользователя"""
     full_name = spec.get('fullName', '')
     email = spec.get('email', '')
-    teams = spec.get('teams', [])
     role = spec.get('role', 'developer')
-    
-    # Создаем API-клиент Kubernetes
-    api = kubernetes.client.CoreV1Api()
-    rbac_api = kubernetes.client.RbacAuthorizationV1Api()
-    
-    # Создаем ServiceAccount для пользователя
-    service_account = {
+
+    return {
         'apiVersion': 'v1',
         'kind': 'ServiceAccount',
         'metadata': {
@@ -589,353 +1029,597 @@ def create_user(body, spec, name, logger, **kwargs):
             }
         }
     }
-    
-    # Создаем Secret для токена ServiceAccount
-    token_secret = {
+
+def render_user_role_binding(name, role_name, namespace_name):
+    """Формирует манифест RoleBinding пользователя"""
+    return {
+        'apiVersion': 'rbac.authorization.k8s.io/v1',
+        'kind': 'RoleBinding',
+        'metadata': {
+            'name': f"{name}-{role_name}-binding",
+            'namespace': namespace_name,
+            'labels': {
+                'user': name,
+                'managed-by': 'team-operator'
+            }
+        },
+        'subjects': [
+            {
+                'kind': 'ServiceAccount',
+                'name': name,
+                'namespace': USERS_NAMESPACE
+            }
+        ],
+        'roleRef': {
+            'kind': 'Role',
+            'name': role_name,
+            'apiGroup': 'rbac.authorization.k8s.io'
+        }
+    }
+
+def render_group_role_binding(team_name, role, namespace_name, members):
+    """Формирует манифест общего RoleBinding роли команды для списка участников"""
+    role_name = get_user_role_name(team_name, role)
+
+    return {
+        'apiVersion': 'rbac.authorization.k8s.io/v1',
+        'kind': 'RoleBinding',
+        'metadata': {
+            'name': f"{role_name}-members",
+            'namespace': namespace_name,
+            'labels': {
+                'team': team_name,
+                'user-role': role,
+                'managed-by': 'team-operator'
+            }
+        },
+        'subjects': [
+            {
+                'kind': 'ServiceAccount',
+                'name': member,
+                'namespace': USERS_NAMESPACE
+            }
+            for member in members
+        ],
+        'roleRef': {
+            'kind': 'Role',
+            'name': role_name,
+            'apiGroup': 'rbac.authorization.k8s.io'
+        }
+    }
+
+def render_kubeconfig_config_map(name, uid, kubeconfig, token_expiration=None):
+    """Формирует манифест ConfigMap с kubeconfig пользователя"""
+    return {
         'apiVersion': 'v1',
-        'kind': 'Secret',
+        'kind': 'ConfigMap',
         'metadata': {
-            'name': f"{name}-token",
+            'name': f"{name}-kubeconfig",
             'namespace': USERS_NAMESPACE,
+            'labels': {
+                'managed-by': 'team-operator',
+                'user': name
+            },
             'annotations': {
-                'kubernetes.io/service-account.name': name
-            }
+                TOKEN_EXPIRATION_ANNOTATION: token_expiration or ''
+            },
+            'ownerReferences': [
+                {
+                    'apiVersion': f"{GROUP}/{VERSION}",
+                    'kind': 'User',
+                    'name': name,
+                    'uid': uid,
+                    'controller': True
+                }
+            ]
         },
-        'type': 'kubernetes.io/service-account-token'
+        'data': {
+            'config': yaml.dump(kubeconfig)
+        }
     }
-    
+
+async def apply_user_account(name, spec, logger, current_hash=None):
+    """Применяет ServiceAccount пользователя
+
+    Возвращает хеш желаемого состояния ServiceAccount. Если он совпадает с
+    current_hash, ServiceAccount не записывается.
+    """
+    service_account = render_service_account(name, spec)
+    account_hash = compute_hash(service_account)
+
+    if account_hash == current_hash:
+        logger.info(f"ServiceAccount {name} не изменился, пропускаем")
+        return account_hash
+
     try:
-        # Создаем ServiceAccount
-        api.create_namespaced_service_account(
-            namespace=USERS_NAMESPACE,
-            body=service_account
+        await apply_object(service_account, logger)
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
+        logger.error(f"Ошибка при применении ServiceAccount {name}: {e}")
+        raise kopf.PermanentError(f"Не удалось применить ServiceAccount {name}: {e}")
+
+    return account_hash
+
+async def delete_user_kubeconfig(name, logger):
+    """Удаляет ConfigMap с kubeconfig пользователя"""
+    api = kubernetes_asyncio.client.CoreV1Api(get_api_client())
+
+    try:
+        await api.delete_namespaced_config_map(
+            name=f"{name}-kubeconfig",
+            namespace=USERS_NAMESPACE
         )
-        logger.info(f"ServiceAccount {name} создан в пространстве имен {USERS_NAMESPACE}")
-        
-        # Создаем Secret для токена
+        logger.info(f"ConfigMap {name}-kubeconfig удален из пространства имен {USERS_NAMESPACE}")
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
+        if e.status == 404:  # Не найдено
+            logger.info(f"ConfigMap {name}-kubeconfig не существует в пространстве имен {USERS_NAMESPACE}")
+        else:
+            logger.warning(f"Ошибка при удалении ConfigMap {name}-kubeconfig: {e}")
+
+async def delete_legacy_token_secret(name, logger):
+    """Удаляет Secret с токеном пользователя, созданный прежними версиями оператора
+
+    Оператор больше не создает Secret и не наблюдает за ними, поэтому Secret
+    удаляется одним запросом без предварительного чтения.
+    """
+    api = kubernetes_asyncio.client.CoreV1Api(get_api_client())
+
+    try:
+        await api.delete_namespaced_secret(
+            name=f"{name}-token",
+            namespace=USERS_NAMESPACE
+        )
+        logger.info(f"Secret {name}-token удален из пространства имен {USERS_NAMESPACE}")
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
+        if e.status == 404:  # Не найдено
+            logger.info(f"Secret {name}-token не существует в пространстве имен {USERS_NAMESPACE}")
+        else:
+            logger.warning(f"Ошибка при удалении Secret {name}-token: {e}")
+
+class ApplyBatcher:
+    """Накопитель записей объектов для одновременной обработки многих пользователей
+
+    Объекты, переданные в apply в течение window секунд после первого из
+    них, записываются одним пакетом: повторные записи одного и того же
+    объекта объединяются в одну, а записи в один namespace выполняются
+    вместе. Записи, пришедшие после окна, попадают в следующий пакет, поэтому
+    объект записывается один раз за каждое окно, в которое его передавали. Каждый вызывающий получает
+    результат или ошибку записи своего объекта, ошибки записи попадают в
+    журнал обработчика, последним передавшего объект. При window <= 0
+    объекты записываются сразу.
+
+    Если передана функция render, объект формируется ею непосредственно перед
+    записью, а записи одного объекта выполняются строго по очереди: так
+    последним записывается объект, сформированный по самому новому состоянию
+    (например, состав участников общего RoleBinding из индекса team_members),
+    даже если обработчики, которые его изменили, выполнялись одновременно.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+        self.flush_task = None
+        # Блокировка удаляется, когда ее не держит и не ждет ни одна запись
+        self.locks = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def key(manifest):
+        metadata = manifest['metadata']
+        return (manifest['kind'], metadata.get('namespace'), metadata['name'])
+
+    async def write(self, key, manifest, render, logger):
+        """Записывает объект, сформированный непосредственно перед записью"""
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+
+        async with lock:
+            return await apply_object(render() if render else manifest, logger)
+
+    async def apply(self, manifest, logger, render=None):
+        """Записывает объект (возможно, в составе пакета) и возвращает его состояние"""
+        if self.window <= 0:
+            return await self.write(self.key(manifest), manifest, render, logger)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = self.pending.setdefault(self.key(manifest), {'manifest': manifest, 'futures': []})
+        entry['manifest'] = manifest
+        entry['render'] = render
+        entry['logger'] = logger
+        entry['futures'].append(future)
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush())
+        return await future
+
+    async def flush(self):
+        await asyncio.sleep(self.window)
+        pending, self.pending, self.flush_task = self.pending, {}, None
+
+        semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+        async def write(key, entry):
+            async with semaphore:
+                try:
+                    result = await self.write(key, entry['manifest'], entry['render'], entry['logger'])
+                except Exception as e:
+                    for future in entry['futures']:
+                        if not future.done():
+                            future.set_exception(e)
+                    return
+            for future in entry['futures']:
+                if not future.done():
+                    future.set_result(result)
+
+        # Записи группируются по namespace, чтобы объекты одного namespace уходили подряд
+        entries = sorted(pending.items(), key=lambda item: (item[0][1] or '', item[0][0], item[0][2]))
+        await asyncio.gather(*(write(key, entry) for key, entry in entries))
+
+        requested = sum(len(entry['futures']) for entry in pending.values())
+        namespaces = {key[1] for key in pending}
+        logger.info(f"Пакет записей: запрошено {requested}, записано объектов {len(pending)} в {len(namespaces)} namespace")
+
+# Накопитель записей общих RoleBinding ролей команд (режим group)
+rbac_batcher = ApplyBatcher(BATCH_WINDOW)
+
+async def apply_binding(manifest, logger, render=None):
+    """Применяет RoleBinding, ошибки записи только логируются
+
+    В режиме group записи идут через rbac_batcher: общий RoleBinding роли
+    команды, который одновременно меняют обработчики многих пользователей,
+    записывается один раз за окно и формируется функцией render в момент
+    записи. В режиме user у каждого пользователя свой RoleBinding, объединять
+    нечего, и он записывается сразу.
+    """
+    metadata = manifest['metadata']
+    try:
+        if BINDING_MODE == 'group':
+            await rbac_batcher.apply(manifest, logger, render)
+        else:
+            await apply_object(manifest, logger)
+        return True
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
+        logger.error(f"Ошибка при применении RoleBinding {metadata['name']} в пространстве имен {metadata['namespace']}: {e}")
+        return False
+
+async def bind_user_to_team(name, role, team_name, namespaces, logger):
+    """Применяет RoleBinding пользователя в namespace окружений команды
+
+    Role команды создаются вместе с окружениями, поэтому пользователь
+    только привязывается к ним. RoleBinding всех namespace применяются
+    одновременно.
+    """
+    role_name = get_user_role_name(team_name, role)
+    await asyncio.gather(*(
+        apply_binding(render_user_role_binding(name, role_name, namespace_name), logger)
+        for namespace_name in namespaces
+    ))
+
+def group_binding_renderer(team_name, role, namespace_name, team_members, exclude=None):
+    """Возвращает функцию, формирующую общий RoleBinding роли команды по текущему составу из индекса"""
+    return lambda: render_group_role_binding(
+        team_name, role, namespace_name, get_team_members(team_members, team_name, role, exclude)
+    )
+
+async def sync_team_bindings(team_name, roles, namespaces, team_members, logger, exclude=None):
+    """Приводит общие RoleBinding ролей команды к текущему составу участников
+
+    Используется в режиме group: для каждой роли из roles в каждом namespace
+    команды применяется один RoleBinding со всеми участниками этой роли из
+    индекса team_members, поэтому изменение состава стоит одной записи на
+    namespace и роль независимо от числа участников. Участники берутся из
+    индекса в момент записи, а записи одного RoleBinding выполняются по
+    очереди, поэтому одновременные обработчики участников команды не
+    затирают изменения друг друга.
+    """
+    steps = []
+    for role in roles:
+        for namespace_name in namespaces:
+            render = group_binding_renderer(team_name, role, namespace_name, team_members, exclude)
+            steps.append(apply_binding(render(), logger, render))
+
+    await asyncio.gather(*steps)
+
+async def bind_team_members(team_name, namespaces, team_members, logger):
+    """Применяет RoleBinding всех текущих участников команды в новых namespace
+
+    Участники берутся из индекса team_members, поэтому новое окружение
+    команды получает привязки за один проход без обработки каждого User.
+    RoleBinding в удаленных окружениях удаляются вместе с namespace.
+    """
+    members = set(team_members.get(team_name, []))
+    if not namespaces or not members:
+        return
+
+    if BINDING_MODE == 'group':
+        roles = sorted({role for _, role in members})
+        await sync_team_bindings(team_name, roles, namespaces, team_members, logger)
+    else:
+        await asyncio.gather(*(
+            bind_user_to_team(member, role, team_name, namespaces, logger)
+            for member, role in sorted(members)
+        ))
+    logger.info(f"Участники команды {team_name} ({len(members)}) добавлены в namespace: {', '.join(namespaces)}")
+
+async def unbind_user_from_team(name, team_name, namespaces, logger):
+    """Удаляет RoleBinding пользователя из namespace окружений команды"""
+    rbac_api = kubernetes_asyncio.client.RbacAuthorizationV1Api(get_api_client())
+
+    # Определяем возможные имена ролей
+    role_names = [get_user_role_name(team_name, role) for role in USER_ROLES]
+
+    for namespace_name in namespaces:
+        # Удаляем все возможные RoleBinding
+        for role_name in role_names:
+            try:
+                await rbac_api.delete_namespaced_role_binding(
+                    name=f"{name}-{role_name}-binding",
+                    namespace=namespace_name
+                )
+                logger.info(f"RoleBinding {name}-{role_name}-binding удален из пространства имен {namespace_name}")
+            except kubernetes_asyncio.client.exceptions.ApiException as e:
+                if e.status == 404:  # Не найдено
+                    logger.info(f"RoleBinding {name}-{role_name}-binding не существует в пространстве имен {namespace_name}")
+                else:
+                    logger.warning(f"Ошибка при удалении RoleBinding {name}-{role_name}-binding: {e}")
+
+def get_kubeconfig_path():
+    """Возвращает путь к kubeconfig, из которого оператор берет доступ к кластеру"""
+    paths = os.environ.get('KUBECONFIG', kubernetes_asyncio.config.kube_config.KUBE_CONFIG_DEFAULT_LOCATION)
+    return os.path.expanduser(paths.split(os.pathsep)[0])
+
+async def load_cluster_info():
+    """Определяет параметры подключения к кластеру для kubeconfig пользователей
+
+    Внутри кластера параметры берутся из конфигурации ServiceAccount оператора,
+    вне кластера - из активного контекста kubeconfig. Возвращает пару
+    (ClusterInfo, время изменения kubeconfig или None внутри кластера).
+    """
+    configuration = kubernetes_asyncio.client.Configuration()
+
+    try:
+        kubernetes_asyncio.config.load_incluster_config(client_configuration=configuration)
+        cluster_name = CLUSTER_NAME
+        mtime = None
+    except kubernetes_asyncio.config.config_exception.ConfigException:
+        path = get_kubeconfig_path()
+        mtime = os.path.getmtime(path)
+        await kubernetes_asyncio.config.load_kube_config(config_file=path, client_configuration=configuration)
+        _, active_context = kubernetes_asyncio.config.list_kube_config_contexts(config_file=path)
+        cluster_name = active_context['context']['cluster']
+
+    return make_cluster_info(cluster_name, configuration), mtime
+
+async def get_cluster_info(logger):
+    """Возвращает закешированные параметры подключения к кластеру
+
+    Параметры перечитываются только после сигнала SIGHUP или при изменении
+    файла kubeconfig.
+    """
+    global cluster_info, cluster_info_mtime
+
+    if cluster_info is not None and cluster_info_mtime is not None:
+        try:
+            if os.path.getmtime(get_kubeconfig_path()) != cluster_info_mtime:
+                logger.info("Файл kubeconfig изменился, перечитываем параметры подключения к кластеру")
+                cluster_info = None
+        except OSError:
+            pass
+
+    if cluster_info is None:
+        cluster_info, cluster_info_mtime = await load_cluster_info()
+        logger.info(f"Параметры подключения к кластеру {cluster_info.name} загружены: {cluster_info.server}")
+
+    return cluster_info
+
+def reset_cluster_info(signum=None, frame=None):
+    """Сбрасывает кеш параметров подключения к кластеру (обработчик SIGHUP)"""
+    global cluster_info
+    cluster_info = None
+    logger.info("Кеш параметров подключения к кластеру сброшен")
+
+def format_timestamp(value):
+    """Форматирует время в UTC в формате Kubernetes"""
+    return value.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def parse_timestamp(value):
+    """Разбирает время в формате Kubernetes"""
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
+
+def get_token_refresh_before():
+    """Возвращает, за сколько секунд до истечения токен запрашивается заново"""
+    return TOKEN_REFRESH_BEFORE or TOKEN_EXPIRATION / 5
+
+def is_token_expiring(token_expiration):
+    """Проверяет, пора ли запросить токен заново (время истечения неизвестно - пора)"""
+    if not token_expiration:
+        return True
+    try:
+        expires = parse_timestamp(token_expiration)
+    except ValueError:
+        return True
+    remaining = (expires - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    return remaining <= get_token_refresh_before()
+
+def get_token_expiration(owned_config_maps, name):
+    """Возвращает время истечения токена в kubeconfig пользователя из индекса или None"""
+    for summary in owned_config_maps.get((USERS_NAMESPACE, f"{name}-kubeconfig"), []):
+        return summary['metadata']['annotations'].get(TOKEN_EXPIRATION_ANNOTATION) or None
+    return None
+
+async def request_user_token(name):
+    """Запрашивает токен ServiceAccount пользователя через TokenRequest API
+
+    Токен не хранится в кластере. Возвращает токен и время его истечения
+    (API-сервер может сократить запрошенный срок действия).
+    """
+    api = kubernetes_asyncio.client.CoreV1Api(get_api_client())
+    token_request = await api.create_namespaced_service_account_token(
+        name=name,
+        namespace=USERS_NAMESPACE,
+        body=render_token_request(TOKEN_EXPIRATION)
+    )
+    return token_request.status.token, token_request.status.expiration_timestamp
+
+async def apply_user_kubeconfig(name, uid, logger, current_hash=None, token_expiration=None):
+    """Запрашивает токен пользователя, формирует kubeconfig и применяет ConfigMap с ним
+
+    Возвращает хеш ConfigMap без токена или None, если kubeconfig не удалось
+    создать. Если хеш совпадает с current_hash, а токен с временем истечения
+    token_expiration еще не пора обновлять, токен не запрашивается и
+    ConfigMap не записывается.
+    """
+    # Получаем информацию о кластере
+    try:
+        cluster = await get_cluster_info(logger)
+    except Exception as e:
+        logger.error(f"Не удалось получить информацию о кластере для пользователя {name}: {e}")
+        return None
+
+    # Хеш не зависит от токена, который при каждом запросе новый
+    kubeconfig_hash = compute_hash(render_kubeconfig_config_map(name, uid, render_kubeconfig(name, '', cluster)))
+    if kubeconfig_hash == current_hash and not is_token_expiring(token_expiration):
+        logger.info(f"ConfigMap {name}-kubeconfig не изменился, пропускаем")
+        return kubeconfig_hash
+
+    try:
+        token, expiration = await request_user_token(name)
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
+        logger.warning(f"Не удалось запросить токен для пользователя {name}: {e}")
+        return None
+    logger.info(f"Токен для пользователя {name} получен, действует до {format_timestamp(expiration)}")
+
+    kubeconfig_cm = render_kubeconfig_config_map(name, uid, render_kubeconfig(name, token, cluster), format_timestamp(expiration))
+
+    # Применяем ConfigMap с kubeconfig
+    try:
+        await apply_object(kubeconfig_cm, logger)
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
+        logger.error(f"Ошибка при применении ConfigMap {name}-kubeconfig: {e}")
+        return None
+
+    return kubeconfig_hash
+
+def get_expiring_tokens(owned_config_maps):
+    """Возвращает пользователей, токены которых пора обновить, начиная с истекающих раньше всех
+
+    Пользователи берутся из индекса ConfigMap с kubeconfig: (время истечения
+    или None, имя, uid). Возвращается не более TOKEN_REFRESH_BATCH пользователей.
+    """
+    expiring = []
+    for (namespace, _), summaries in owned_config_maps.items():
+        if namespace != USERS_NAMESPACE:
+            continue
+        for summary in summaries:
+            name = summary['metadata']['labels'].get('user')
+            expiration = summary['metadata']['annotations'].get(TOKEN_EXPIRATION_ANNOTATION) or None
+            if name and summary.get('owner_uid') and is_token_expiring(expiration):
+                expiring.append((expiration, name, summary['owner_uid']))
+
+    # kubeconfig без времени истечения (с токеном из Secret прежних версий) обновляются первыми
+    expiring.sort(key=lambda item: (item[0] or '', item[1]))
+    return expiring[:TOKEN_REFRESH_BATCH]
+
+@measured
+async def refresh_user_tokens(expiring, logger):
+    """Запрашивает новые токены пользователей и обновляет их kubeconfig
+
+    Одновременно обновляется не более MAX_IN_FLIGHT пользователей. Возвращает
+    количество обновленных kubeconfig.
+    """
+    semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+    async def refresh(expiration, name, uid):
+        async with semaphore:
+            if await apply_user_kubeconfig(name, uid, logger) is None:
+                return False
+
+            # Токен из Secret прежних версий оператора больше не нужен
+            if expiration is None:
+                await delete_legacy_token_secret(name, logger)
+            return True
+
+    results = await asyncio.gather(*(refresh(*item) for item in expiring))
+    return sum(results)
+
+async def run_token_refresher(owned_config_maps):
+    """Периодически обновляет токены пользователей, срок действия которых подходит к концу
+
+    Время истечения токенов берется из индекса owned_config_maps без запросов
+    к API. Истекающие токены обновляются пакетами не более TOKEN_REFRESH_BATCH
+    за проверку.
+    """
+    while True:
+        await asyncio.sleep(TOKEN_REFRESH_INTERVAL)
+        expiring = get_expiring_tokens(owned_config_maps)
+        if not expiring:
+            continue
+
         try:
-            api.create_namespaced_secret(
-                namespace=USERS_NAMESPACE,
-                body=token_secret
-            )
-            logger.info(f"Secret {name}-token создан в пространстве имен {USERS_NAMESPACE}")
-        except kubernetes.client.exceptions.ApiException as e:
-            if e.status == 409:  # Конфликт - ресурс уже существует
-                logger.info(f"Secret {name}-token уже существует в пространстве имен {USERS_NAMESPACE}")
-            else:
-                logger.error(f"Ошибка при создании Secret {name}-token: {e}")
-                
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 409:  # Конфликт - ресурс уже существует
-            logger.info(f"ServiceAccount {name} уже существует в пространстве имен {USERS_NAMESPACE}")
-            
-            # Проверяем, существует ли Secret для токена
-            try:
-                api.read_namespaced_secret(
-                    name=f"{name}-token",
-                    namespace=USERS_NAMESPACE
-                )
-                logger.info(f"Secret {name}-token уже существует в пространстве имен {USERS_NAMESPACE}")
-            except kubernetes.client.exceptions.ApiException as e:
-                if e.status == 404:  # Не найдено - создаем
-                    try:
-                        api.create_namespaced_secret(
-                            namespace=USERS_NAMESPACE,
-                            body=token_secret
-                        )
-                        logger.info(f"Secret {name}-token создан в пространстве имен {USERS_NAMESPACE}")
-                    except kubernetes.client.exceptions.ApiException as e:
-                        logger.error(f"Ошибка при создании Secret {name}-token: {e}")
-        else:
-            logger.error(f"Ошибка при создании ServiceAccount {name}: {e}")
-            raise kopf.PermanentError(f"Не удалось создать ServiceAccount {name}: {e}")
-    
+            # Обновление токенов уступает место обработчикам изменений команд и пользователей
+            async with handler_limiter.slot(PRIORITY_KUBECONFIG):
+                refreshed = await refresh_user_tokens(expiring, logger)
+            logger.info(f"Обновлены токены пользователей: {refreshed} из {len(expiring)}")
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении токенов пользователей: {e}")
+
+async def apply_user(name, spec, uid, team_namespaces, team_members, logger):
+    """Применяет все объекты пользователя и возвращает его состояние для статуса
+
+    Используется при создании пользователя и при первой сверке пользователя,
+    созданного прежней версией оператора.
+    """
+    # Убеждаемся, что пространство имен пользователей существует
+    await ensure_users_namespace(logger)
+
+    # Получаем данные из спецификации
+    teams = spec.get('teams', [])
+    role = spec.get('role', 'developer')
+
+    # Применяем ServiceAccount
+    account_hash = await apply_user_account(name, spec, logger)
+
     # Создаем RoleBinding для каждой команды
     for team_name in teams:
-        # Проверяем, существует ли команда
-        try:
-            custom_api = kubernetes.client.CustomObjectsApi()
-            team = custom_api.get_cluster_custom_object(
-                group=GROUP,
-                version=VERSION,
-                plural=PLURAL_TEAMS,
-                name=team_name
-            )
-            
-            # Получаем окружения команды
-            environments = team.get('spec', {}).get('environments', [])
-            
-            # Создаем RoleBinding для каждого окружения
-            for env in environments:
-                env_name = env.get('name')
-                if not env_name:
-                    continue
-                
-                # Формируем имя namespace на основе имени команды и окружения
-                namespace_name = f"{team_name}-{env_name}".lower()
-                
-                # Определяем роль в зависимости от роли пользователя
-                role_name = ""
-                if role == "admin":
-                    role_name = f"{team_name}-admin"
-                elif role == "developer":
-                    role_name = f"{team_name}-developer"
-                else:  # viewer
-                    role_name = f"{team_name}-viewer"
-                
-                # Проверяем, существует ли роль, если нет - создаем
-                try:
-                    rbac_api.read_namespaced_role(name=role_name, namespace=namespace_name)
-                except kubernetes.client.exceptions.ApiException as e:
-                    if e.status == 404:  # Не найдено - создаем
-                        # Создаем соответствующую роль
-                        if role == "admin":
-                            role_def = {
-                                'apiVersion': 'rbac.authorization.k8s.io/v1',
-                                'kind': 'Role',
-                                'metadata': {
-                                    'name': role_name,
-                                    'namespace': namespace_name
-                                },
-                                'rules': [
-                                    {
-                                        'apiGroups': ['*'],
-                                        'resources': ['*'],
-                                        'verbs': ['*']
-                                    }
-                                ]
-                            }
-                        elif role == "developer":
-                            role_def = {
-                                'apiVersion': 'rbac.authorization.k8s.io/v1',
-                                'kind': 'Role',
-                                'metadata': {
-                                    'name': role_name,
-                                    'namespace': namespace_name
-                                },
-                                'rules': [
-                                    {
-                                        'apiGroups': [''],
-                                        'resources': ['pods', 'services', 'configmaps', 'secrets'],
-                                        'verbs': ['get', 'list', 'watch', 'create', 'update', 'patch', 'delete']
-                                    },
-                                    {
-                                        'apiGroups': ['apps'],
-                                        'resources': ['deployments', 'statefulsets', 'daemonsets'],
-                                        'verbs': ['get', 'list', 'watch', 'create', 'update', 'patch', 'delete']
-                                    },
-                                    {
-                                        'apiGroups': ['batch'],
-                                        'resources': ['jobs', 'cronjobs'],
-                                        'verbs': ['get', 'list', 'watch', 'create', 'update', 'patch', 'delete']
-                                    }
-                                ]
-                            }
-                        else:  # viewer
-                            role_def = {
-                                'apiVersion': 'rbac.authorization.k8s.io/v1',
-                                'kind': 'Role',
-                                'metadata': {
-                                    'name': role_name,
-                                    'namespace': namespace_name
-                                },
-                                'rules': [
-                                    {
-                                        'apiGroups': ['*'],
-                                        'resources': ['*'],
-                                        'verbs': ['get', 'list', 'watch']
-                                    }
-                                ]
-                            }
-                        
-                        try:
-                            rbac_api.create_namespaced_role(
-                                namespace=namespace_name,
-                                body=role_def
-                            )
-                            logger.info(f"Role {role_name} создана в пространстве имен {namespace_name}")
-                        except kubernetes.client.exceptions.ApiException as e:
-                            logger.error(f"Ошибка при создании Role {role_name}: {e}")
-                
-                # Создаем RoleBinding
-                role_binding = {
-                    'apiVersion': 'rbac.authorization.k8s.io/v1',
-                    'kind': 'RoleBinding',
-                    'metadata': {
-                        'name': f"{name}-{role_name}-binding",
-                        'namespace': namespace_name
-                    },
-                    'subjects': [
-                        {
-                            'kind': 'ServiceAccount',
-                            'name': name,
-                            'namespace': USERS_NAMESPACE
-                        }
-                    ],
-                    'roleRef': {
-                        'kind': 'Role',
-                        'name': role_name,
-                        'apiGroup': 'rbac.authorization.k8s.io'
-                    }
-                }
-                
-                try:
-                    rbac_api.create_namespaced_role_binding(
-                        namespace=namespace_name,
-                        body=role_binding
-                    )
-                    logger.info(f"RoleBinding {name}-{role_name}-binding создан в пространстве имен {namespace_name}")
-                except kubernetes.client.exceptions.ApiException as e:
-                    if e.status == 409:  # Конфликт - ресурс уже существует
-                        logger.info(f"RoleBinding {name}-{role_name}-binding уже существует в пространстве имен {namespace_name}")
-                    else:
-                        logger.error(f"Ошибка при создании RoleBinding {name}-{role_name}-binding: {e}")
-            
-        except kubernetes.client.exceptions.ApiException as e:
-            logger.warning(f"Команда {team_name} не найдена: {e}")
-    
-    # Создаем kubeconfig для пользователя
-    try:
-        # Получаем токен из Secret
-        secret = api.read_namespaced_secret(
-            name=f"{name}-token",
-            namespace=USERS_NAMESPACE
-        )
-        
-        if secret.data and 'token' in secret.data:
-            token = base64.b64decode(secret.data['token']).decode('utf-8')
-            logger.info(f"Токен для пользователя {name} получен")
-            
-            # Получаем информацию о кластере
-            try:
-                # Получаем URL API-сервера
-                kube_config = kubernetes.config.load_kube_config()
-                contexts, active_context = kubernetes.config.list_kube_config_contexts()
-                if active_context:
-                    cluster_name = active_context['context']['cluster']
-                    cluster_info = None
-                    for context in contexts:
-                        if context['context']['cluster'] == cluster_name:
-                            cluster_info = context
-                            break
-                    
-                    if cluster_info:
-                        # Получаем информацию о кластере
-                        k8s_client = kubernetes.client.ApiClient()
-                        k8s_configuration = k8s_client.configuration
-                        
-                        # Создаем kubeconfig
-                        kubeconfig = {
-                            "apiVersion": "v1",
-                            "kind": "Config",
-                            "current-context": name,
-                            "clusters": [
-                                {
-                                    "name": cluster_name,
-                                    "cluster": {
-                                        "server": k8s_configuration.host,
-                                        "certificate-authority-data": base64.b64encode(k8s_configuration.ssl_ca_cert.encode()).decode() if k8s_configuration.ssl_ca_cert else None
-                                    }
-                                }
-                            ],
-                            "users": [
-                                {
-                                    "name": name,
-                                    "user": {
-                                        "token": token
-                                    }
-                                }
-                            ],
-                            "contexts": [
-                                {
-                                    "name": name,
-                                    "context": {
-                                        "cluster": cluster_name,
-                                        "user": name
-                                    }
-                                }
-                            ]
-                        }
-                        
-                        # Создаем ConfigMap с kubeconfig
-                        kubeconfig_cm = {
-                            'apiVersion': 'v1',
-                            'kind': 'ConfigMap',
-                            'metadata': {
-                                'name': f"{name}-kubeconfig",
-                                'namespace': USERS_NAMESPACE,
-                                'labels': {
-                                    'managed-by': 'team-operator',
-                                    'user': name
-                                },
-                                'ownerReferences': [
-                                    {
-                                        'apiVersion': f"{GROUP}/{VERSION}",
-                                        'kind': 'User',
-                                        'name': name,
-                                        'uid': body['metadata']['uid'],
-                                        'controller': True
-                                    }
-                                ]
-                            },
-                            'data': {
-                                'config': yaml.dump(kubeconfig)
-                            }
-                        }
-                        
-                        # Удаляем None значения из kubeconfig
-                        if kubeconfig["clusters"][0]["cluster"]["certificate-authority-data"] is None:
-                            del kubeconfig["clusters"][0]["cluster"]["certificate-authority-data"]
-                            # Если используется небезопасное соединение, добавляем insecure-skip-tls-verify
-                            if not k8s_configuration.verify_ssl:
-                                kubeconfig["clusters"][0]["cluster"]["insecure-skip-tls-verify"] = True
-                        
-                        # Удаляем None значения из kubeconfig
-                        if kubeconfig["clusters"][0]["cluster"]["certificate-authority-data"] is None:
-                            del kubeconfig["clusters"][0]["cluster"]["certificate-authority-data"]
-                            # Если используется небезопасное соединение, добавляем insecure-skip-tls-verify
-                            if not k8s_configuration.verify_ssl:
-                                kubeconfig["clusters"][0]["cluster"]["insecure-skip-tls-verify"] = True
-                        
-                        try:
-                            # Создаем или обновляем ConfigMap
-                            try:
-                                api.read_namespaced_config_map(
-                                    name=f"{name}-kubeconfig",
-                                    namespace=USERS_NAMESPACE
-                                )
-                                # ConfigMap существует - обновляем
-                                api.replace_namespaced_config_map(
-                                    name=f"{name}-kubeconfig",
-                                    namespace=USERS_NAMESPACE,
-                                    body=kubeconfig_cm
-                                )
-                                logger.info(f"ConfigMap {name}-kubeconfig обновлен в пространстве имен {USERS_NAMESPACE}")
-                            except kubernetes.client.exceptions.ApiException as e:
-                                if e.status == 404:  # Не найдено - создаем
-                                    api.create_namespaced_config_map(
-                                        namespace=USERS_NAMESPACE,
-                                        body=kubeconfig_cm
-                                    )
-                                    logger.info(f"ConfigMap {name}-kubeconfig создан в пространстве имен {USERS_NAMESPACE}")
-                                else:
-                                    logger.error(f"Ошибка при проверке ConfigMap {name}-kubeconfig: {e}")
-                        except kubernetes.client.exceptions.ApiException as e:
-                            logger.error(f"Ошибка при создании/обновлении ConfigMap {name}-kubeconfig: {e}")
-                    else:
-                        logger.warning(f"Не удалось получить информацию о кластере для пользователя {name}")
-                else:
-                    logger.warning(f"Не удалось получить активный контекст для пользователя {name}")
-            except Exception as e:
-                logger.error(f"Ошибка при создании kubeconfig для пользователя {name}: {e}")
+        # Получаем namespace окружений команды из индекса
+        namespaces = get_team_namespaces(team_namespaces, team_name)
+        if namespaces is None:
+            logger.warning(f"Команда {team_name} не найдена")
+            continue
+
+        if BINDING_MODE == 'group':
+            await sync_team_bindings(team_name, [role], namespaces, team_members, logger)
         else:
-            logger.warning(f"Токен для пользователя {name} не найден в Secret")
-    except kubernetes.client.exceptions.ApiException as e:
-        logger.warning(f"Не удалось получить Secret с токеном для пользователя {name}: {e}")
-    
+            await bind_user_to_team(name, role, team_name, namespaces, logger)
+
+    # Создаем kubeconfig для пользователя (в режиме on-demand его формирует веб-интерфейс при скачивании)
+    kubeconfig_hash = None
+    if KUBECONFIG_MODE == 'configmap':
+        kubeconfig_hash = await apply_user_kubeconfig(name, uid, logger)
+
+    return {
+        'teams': teams,
+        'kubeconfig_created': KUBECONFIG_MODE == 'on-demand' or kubeconfig_hash is not None,
+        'hashes': {
+            'account': account_hash,
+            'kubeconfig': kubeconfig_hash
+        }
+    }
+
+@kopf.on.create(group=GROUP, version=VERSION, plural=PLURAL_USERS)
+@limited(PLURAL_USERS, PRIORITY_USER)
+@measured
+async def create_user(body, spec, name, patch, team_namespaces, team_members, logger, **kwargs):
+    """Обработчик создания ресурса User"""
+    logger.info(f"Создание ресурса User {name}")
+
+    # Сохраняем команды и хеши желаемого состояния пользователя
+    state = await apply_user(name, spec, body['metadata']['uid'], team_namespaces, team_members, logger)
+    patch.status['team-operator'] = state
+    teams = state['teams']
+
     # Обновляем статус ресурса
     kopf.info(body, reason='Created', message=f'Пользователь {name} создан, добавлен в команды: {teams}')
-    
+
     return {
         'service_account_created': True,
         'teams': teams,
@@ -943,459 +1627,101 @@ def create_user(body, spec, name, logger, **kwargs):
     }
 
 @kopf.on.update(group=GROUP, version=VERSION, plural=PLURAL_USERS)
-def update_user(body, spec, status, name, logger, **kwargs):
+@limited(PLURAL_USERS, PRIORITY_USER)
+@measured
+async def update_user(body, spec, status, old, name, patch, team_namespaces, team_members, owned_config_maps, logger, **kwargs):
     """Обработчик обновления ресурса User"""
     logger.info(f"Обновление ресурса User {name}")
-    
+
     # Убеждаемся, что пространство имен пользователей существует
-    ensure_users_namespace(logger)
-    
+    await ensure_users_namespace(logger)
+
     # Получаем данные из спецификации
-    full_name = spec.get('fullName', '')
-    email = spec.get('email', '')
     new_teams = spec.get('teams', [])
     role = spec.get('role', 'developer')
-    
-    # Получаем текущие команды из статуса
+
+    # Получаем текущие команды и хеши желаемого состояния из статуса
     current_teams = status.get('team-operator', {}).get('teams', [])
-    
-    # Создаем API-клиент Kubernetes
-    api = kubernetes.client.CoreV1Api()
-    rbac_api = kubernetes.client.RbacAuthorizationV1Api()
-    
-    # Обновляем ServiceAccount
-    try:
-        # Получаем текущий ServiceAccount
-        service_account = api.read_namespaced_service_account(
-            name=name,
-            namespace=USERS_NAMESPACE
-        )
-        
-        # Обновляем метки и аннотации
-        service_account.metadata.labels['user-email'] = email.replace('@', '-at-').replace('.', '-dot-')
-        service_account.metadata.labels['user-role'] = role
-        service_account.metadata.annotations['team.example.com/full-name'] = full_name
-        service_account.metadata.annotations['team.example.com/email'] = email
-        
-        # Применяем изменения
-        api.replace_namespaced_service_account(
-            name=name,
-            namespace=USERS_NAMESPACE,
-            body=service_account
-        )
-        logger.info(f"ServiceAccount {name} обновлен")
-        
-        # Проверяем, существует ли Secret для токена
-        try:
-            api.read_namespaced_secret(
-                name=f"{name}-token",
-                namespace=USERS_NAMESPACE
-            )
-            logger.info(f"Secret {name}-token уже существует в пространстве имен {USERS_NAMESPACE}")
-        except kubernetes.client.exceptions.ApiException as e:
-            if e.status == 404:  # Не найдено - создаем
-                # Создаем Secret для токена ServiceAccount
-                token_secret = {
-                    'apiVersion': 'v1',
-                    'kind': 'Secret',
-                    'metadata': {
-                        'name': f"{name}-token",
-                        'namespace': USERS_NAMESPACE,
-                        'annotations': {
-                            'kubernetes.io/service-account.name': name
-                        }
-                    },
-                    'type': 'kubernetes.io/service-account-token'
-                }
-                
-                try:
-                    api.create_namespaced_secret(
-                        namespace=USERS_NAMESPACE,
-                        body=token_secret
-                    )
-                    logger.info(f"Secret {name}-token создан в пространстве имен {USERS_NAMESPACE}")
-                except kubernetes.client.exceptions.ApiException as e:
-                    logger.error(f"Ошибка при создании Secret {name}-token: {e}")
-            else:
-                logger.warning(f"Ошибка при проверке Secret {name}-token: {e}")
-                
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 404:  # Не найдено - создаем
-            # Создаем ServiceAccount
-            service_account = {
-                'apiVersion': 'v1',
-                'kind': 'ServiceAccount',
-                'metadata': {
-                    'name': name,
-                    'namespace': USERS_NAMESPACE,
-                    'labels': {
-                        'managed-by': 'team-operator',
-                        'user-email': email.replace('@', '-at-').replace('.', '-dot-'),
-                        'user-role': role
-                    },
-                    'annotations': {
-                        'team.example.com/full-name': full_name,
-                        'team.example.com/email': email
-                    }
-                }
-            }
-            
-            # Создаем Secret для токена ServiceAccount
-            token_secret = {
-                'apiVersion': 'v1',
-                'kind': 'Secret',
-                'metadata': {
-                    'name': f"{name}-token",
-                    'namespace': USERS_NAMESPACE,
-                    'annotations': {
-                        'kubernetes.io/service-account.name': name
-                    }
-                },
-                'type': 'kubernetes.io/service-account-token'
-            }
-            
-            try:
-                api.create_namespaced_service_account(
-                    namespace=USERS_NAMESPACE,
-                    body=service_account
-                )
-                logger.info(f"ServiceAccount {name} создан")
-                
-                try:
-                    api.create_namespaced_secret(
-                        namespace=USERS_NAMESPACE,
-                        body=token_secret
-                    )
-                    logger.info(f"Secret {name}-token создан в пространстве имен {USERS_NAMESPACE}")
-                except kubernetes.client.exceptions.ApiException as e:
-                    logger.error(f"Ошибка при создании Secret {name}-token: {e}")
-                    
-            except kubernetes.client.exceptions.ApiException as e:
-                logger.error(f"Ошибка при создании ServiceAccount {name}: {e}")
-                raise kopf.PermanentError(f"Не удалось создать ServiceAccount {name}: {e}")
-        else:
-            logger.error(f"Ошибка при обновлении ServiceAccount {name}: {e}")
-            raise kopf.PermanentError(f"Не удалось обновить ServiceAccount {name}: {e}")
-    
+    current_hashes = status.get('team-operator', {}).get('hashes', {})
+
+    # Применяем ServiceAccount
+    account_hash = await apply_user_account(name, spec, logger, current_hashes.get('account'))
+
     # Находим команды, которые нужно добавить и удалить
     teams_to_add = [team for team in new_teams if team not in current_teams]
     teams_to_remove = [team for team in current_teams if team not in new_teams]
-    
-    # Добавляем пользователя в новые команды
-    for team_name in teams_to_add:
-        try:
-            custom_api = kubernetes.client.CustomObjectsApi()
-            team = custom_api.get_cluster_custom_object(
-                group=GROUP,
-                version=VERSION,
-                plural=PLURAL_TEAMS,
-                name=team_name
-            )
-            
-            # Получаем окружения команды
-            environments = team.get('spec', {}).get('environments', [])
-            
-            # Создаем RoleBinding для каждого окружения
-            for env in environments:
-                env_name = env.get('name')
-                if not env_name:
-                    continue
-                
-                # Формируем имя namespace на основе имени команды и окружения
-                namespace_name = f"{team_name}-{env_name}".lower()
-                
-                # Определяем роль в зависимости от роли пользователя
-                role_name = ""
-                if role == "admin":
-                    role_name = f"{team_name}-admin"
-                elif role == "developer":
-                    role_name = f"{team_name}-developer"
-                else:  # viewer
-                    role_name = f"{team_name}-viewer"
-                
-                # Проверяем, существует ли роль, если нет - создаем
-                try:
-                    rbac_api.read_namespaced_role(name=role_name, namespace=namespace_name)
-                except kubernetes.client.exceptions.ApiException as e:
-                    if e.status == 404:  # Не найдено - создаем
-                        # Создаем соответствующую роль (код аналогичен create_user)
-                        if role == "admin":
-                            role_def = {
-                                'apiVersion': 'rbac.authorization.k8s.io/v1',
-                                'kind': 'Role',
-                                'metadata': {
-                                    'name': role_name,
-                                    'namespace': namespace_name
-                                },
-                                'rules': [
-                                    {
-                                        'apiGroups': ['*'],
-                                        'resources': ['*'],
-                                        'verbs': ['*']
-                                    }
-                                ]
-                            }
-                        elif role == "developer":
-                            role_def = {
-                                'apiVersion': 'rbac.authorization.k8s.io/v1',
-                                'kind': 'Role',
-                                'metadata': {
-                                    'name': role_name,
-                                    'namespace': namespace_name
-                                },
-                                'rules': [
-                                    {
-                                        'apiGroups': [''],
-                                        'resources': ['pods', 'services', 'configmaps', 'secrets'],
-                                        'verbs': ['get', 'list', 'watch', 'create', 'update', 'patch', 'delete']
-                                    },
-                                    {
-                                        'apiGroups': ['apps'],
-                                        'resources': ['deployments', 'statefulsets', 'daemonsets'],
-                                        'verbs': ['get', 'list', 'watch', 'create', 'update', 'patch', 'delete']
-                                    },
-                                    {
-                                        'apiGroups': ['batch'],
-                                        'resources': ['jobs', 'cronjobs'],
-                                        'verbs': ['get', 'list', 'watch', 'create', 'update', 'patch', 'delete']
-                                    }
-                                ]
-                            }
-                        else:  # viewer
-                            role_def = {
-                                'apiVersion': 'rbac.authorization.k8s.io/v1',
-                                'kind': 'Role',
-                                'metadata': {
-                                    'name': role_name,
-                                    'namespace': namespace_name
-                                },
-                                'rules': [
-                                    {
-                                        'apiGroups': ['*'],
-                                        'resources': ['*'],
-                                        'verbs': ['get', 'list', 'watch']
-                                    }
-                                ]
-                            }
-                        
-                        try:
-                            rbac_api.create_namespaced_role(
-                                namespace=namespace_name,
-                                body=role_def
-                            )
-                            logger.info(f"Role {role_name} создана в пространстве имен {namespace_name}")
-                        except kubernetes.client.exceptions.ApiException as e:
-                            logger.error(f"Ошибка при создании Role {role_name}: {e}")
-                
-                # Создаем RoleBinding
-                role_binding = {
-                    'apiVersion': 'rbac.authorization.k8s.io/v1',
-                    'kind': 'RoleBinding',
-                    'metadata': {
-                        'name': f"{name}-{role_name}-binding",
-                        'namespace': namespace_name
-                    },
-                    'subjects': [
-                        {
-                            'kind': 'ServiceAccount',
-                            'name': name,
-                            'namespace': USERS_NAMESPACE
-                        }
-                    ],
-                    'roleRef': {
-                        'kind': 'Role',
-                        'name': role_name,
-                        'apiGroup': 'rbac.authorization.k8s.io'
-                    }
-                }
-                
-                try:
-                    rbac_api.create_namespaced_role_binding(
-                        namespace=namespace_name,
-                        body=role_binding
-                    )
-                    logger.info(f"RoleBinding {name}-{role_name}-binding создан в пространстве имен {namespace_name}")
-                except kubernetes.client.exceptions.ApiException as e:
-                    if e.status == 409:  # Конфликт - ресурс уже существует
-                        logger.info(f"RoleBinding {name}-{role_name}-binding уже существует в пространстве имен {namespace_name}")
-                    else:
-                        logger.error(f"Ошибка при создании RoleBinding {name}-{role_name}-binding: {e}")
-            
-        except kubernetes.client.exceptions.ApiException as e:
-            logger.warning(f"Команда {team_name} не найдена: {e}")
-    
-    # Удаляем пользователя из команд, которые больше не указаны
-    for team_name in teams_to_remove:
-        try:
-            custom_api = kubernetes.client.CustomObjectsApi()
-            team = custom_api.get_cluster_custom_object(
-                group=GROUP,
-                version=VERSION,
-                plural=PLURAL_TEAMS,
-                name=team_name
-            )
-            
-            # Получаем окружения команды
-            environments = team.get('spec', {}).get('environments', [])
-            
-            # Удаляем RoleBinding для каждого окружения
-            for env in environments:
-                env_name = env.get('name')
-                if not env_name:
-                    continue
-                
-                # Формируем имя namespace на основе имени команды и окружения
-                namespace_name = f"{team_name}-{env_name}".lower()
-                
-                # Определяем возможные имена ролей
-                role_names = [f"{team_name}-admin", f"{team_name}-developer", f"{team_name}-viewer"]
-                
-                # Удаляем все возможные RoleBinding
-                for role_name in role_names:
-                    try:
-                        rbac_api.delete_namespaced_role_binding(
-                            name=f"{name}-{role_name}-binding",
-                            namespace=namespace_name
-                        )
-                        logger.info(f"RoleBinding {name}-{role_name}-binding удален из пространства имен {namespace_name}")
-                    except kubernetes.client.exceptions.ApiException as e:
-                        if e.status == 404:  # Не найдено
-                            logger.info(f"RoleBinding {name}-{role_name}-binding не существует в пространстве имен {namespace_name}")
-                        else:
-                            logger.warning(f"Ошибка при удалении RoleBinding {name}-{role_name}-binding: {e}")
-            
-        except kubernetes.client.exceptions.ApiException as e:
-            logger.warning(f"Команда {team_name} не найдена: {e}")
-    
-    # Обновляем kubeconfig для пользователя
-    try:
-        # Получаем токен из Secret
-        secret = api.read_namespaced_secret(
-            name=f"{name}-token",
-            namespace=USERS_NAMESPACE
-        )
-        
-        if secret.data and 'token' in secret.data:
-            token = base64.b64decode(secret.data['token']).decode('utf-8')
-            logger.info(f"Токен для пользователя {name} получен")
-            
-            # Получаем информацию о кластере
-            try:
-                # Получаем URL API-сервера
-                kube_config = kubernetes.config.load_kube_config()
-                contexts, active_context = kubernetes.config.list_kube_config_contexts()
-                if active_context:
-                    cluster_name = active_context['context']['cluster']
-                    cluster_info = None
-                    for context in contexts:
-                        if context['context']['cluster'] == cluster_name:
-                            cluster_info = context
-                            break
-                    
-                    if cluster_info:
-                        # Получаем информацию о кластере
-                        k8s_client = kubernetes.client.ApiClient()
-                        k8s_configuration = k8s_client.configuration
-                        
-                        # Создаем kubeconfig
-                        kubeconfig = {
-                            "apiVersion": "v1",
-                            "kind": "Config",
-                            "current-context": name,
-                            "clusters": [
-                                {
-                                    "name": cluster_name,
-                                    "cluster": {
-                                        "server": k8s_configuration.host,
-                                        "certificate-authority-data": base64.b64encode(k8s_configuration.ssl_ca_cert.encode()).decode() if k8s_configuration.ssl_ca_cert else None
-                                    }
-                                }
-                            ],
-                            "users": [
-                                {
-                                    "name": name,
-                                    "user": {
-                                        "token": token
-                                    }
-                                }
-                            ],
-                            "contexts": [
-                                {
-                                    "name": name,
-                                    "context": {
-                                        "cluster": cluster_name,
-                                        "user": name
-                                    }
-                                }
-                            ]
-                        }
-                        
-                        # Создаем ConfigMap с kubeconfig
-                        kubeconfig_cm = {
-                            'apiVersion': 'v1',
-                            'kind': 'ConfigMap',
-                            'metadata': {
-                                'name': f"{name}-kubeconfig",
-                                'namespace': USERS_NAMESPACE,
-                                'labels': {
-                                    'managed-by': 'team-operator',
-                                    'user': name
-                                },
-                                'ownerReferences': [
-                                    {
-                                        'apiVersion': f"{GROUP}/{VERSION}",
-                                        'kind': 'User',
-                                        'name': name,
-                                        'uid': body['metadata']['uid'],
-                                        'controller': True
-                                    }
-                                ]
-                            },
-                            'data': {
-                                'config': yaml.dump(kubeconfig)
-                            }
-                        }
-                        
-                        try:
-                            # Создаем или обновляем ConfigMap
-                            try:
-                                api.read_namespaced_config_map(
-                                    name=f"{name}-kubeconfig",
-                                    namespace=USERS_NAMESPACE
-                                )
-                                # ConfigMap существует - обновляем
-                                api.replace_namespaced_config_map(
-                                    name=f"{name}-kubeconfig",
-                                    namespace=USERS_NAMESPACE,
-                                    body=kubeconfig_cm
-                                )
-                                logger.info(f"ConfigMap {name}-kubeconfig обновлен в пространстве имен {USERS_NAMESPACE}")
-                            except kubernetes.client.exceptions.ApiException as e:
-                                if e.status == 404:  # Не найдено - создаем
-                                    api.create_namespaced_config_map(
-                                        namespace=USERS_NAMESPACE,
-                                        body=kubeconfig_cm
-                                    )
-                                    logger.info(f"ConfigMap {name}-kubeconfig создан в пространстве имен {USERS_NAMESPACE}")
-                                else:
-                                    logger.error(f"Ошибка при проверке ConfigMap {name}-kubeconfig: {e}")
-                        except kubernetes.client.exceptions.ApiException as e:
-                            logger.error(f"Ошибка при создании/обновлении ConfigMap {name}-kubeconfig: {e}")
-                    else:
-                        logger.warning(f"Не удалось получить информацию о кластере для пользователя {name}")
-                else:
-                    logger.warning(f"Не удалось получить активный контекст для пользователя {name}")
-            except Exception as e:
-                logger.error(f"Ошибка при создании kubeconfig для пользователя {name}: {e}")
-        else:
-            logger.warning(f"Токен для пользователя {name} не найден в Secret")
-    except kubernetes.client.exceptions.ApiException as e:
-        logger.warning(f"Не удалось получить Secret с токеном для пользователя {name}: {e}")
-    
+
+    # При смене роли пересоздаем привязки во всех командах пользователя
+    old_role = (old or {}).get('spec', {}).get('role', 'developer')
+    teams_to_rebind = [team for team in new_teams if team in current_teams] if old_role != role else []
+
+    if BINDING_MODE == 'group':
+        # Индекс участников уже содержит новое состояние пользователя, поэтому
+        # достаточно пересобрать общие RoleBinding затронутых ролей команд
+        affected_roles = {}
+        for team_name in teams_to_remove:
+            affected_roles.setdefault(team_name, []).append(old_role)
+        for team_name in teams_to_add:
+            affected_roles.setdefault(team_name, []).append(role)
+        for team_name in teams_to_rebind:
+            affected_roles.setdefault(team_name, []).extend([old_role, role])
+
+        steps = []
+        for team_name, roles in affected_roles.items():
+            namespaces = get_team_namespaces(team_namespaces, team_name)
+            if namespaces is None:
+                logger.warning(f"Команда {team_name} не найдена")
+                continue
+            steps.append(sync_team_bindings(team_name, roles, namespaces, team_members, logger))
+        await asyncio.gather(*steps)
+    else:
+        # Удаляем пользователя из команд, которые больше не указаны
+        for team_name in teams_to_remove + teams_to_rebind:
+            namespaces = get_team_namespaces(team_namespaces, team_name)
+            if namespaces is None:
+                logger.warning(f"Команда {team_name} не найдена")
+                continue
+
+            await unbind_user_from_team(name, team_name, namespaces, logger)
+
+        # Добавляем пользователя в новые команды
+        for team_name in teams_to_add + teams_to_rebind:
+            namespaces = get_team_namespaces(team_namespaces, team_name)
+            if namespaces is None:
+                logger.warning(f"Команда {team_name} не найдена")
+                continue
+
+            await bind_user_to_team(name, role, team_name, namespaces, logger)
+
+    token_expiration = get_token_expiration(owned_config_maps, name)
+    if KUBECONFIG_MODE == 'configmap':
+        # Обновляем kubeconfig для пользователя (новый токен запрашивается, только если текущий скоро истечет)
+        kubeconfig_hash = await apply_user_kubeconfig(name, body['metadata']['uid'], logger, current_hashes.get('kubeconfig'),
+                                                      token_expiration)
+    else:
+        # kubeconfig формируется при скачивании; ConfigMap, созданный в режиме configmap, больше не нужен
+        kubeconfig_hash = None
+        if current_hashes.get('kubeconfig'):
+            await delete_user_kubeconfig(name, logger)
+
+    # kubeconfig без времени истечения токена создан прежней версией оператора с токеном из Secret
+    if current_hashes.get('kubeconfig') and token_expiration is None and (kubeconfig_hash is not None or KUBECONFIG_MODE == 'on-demand'):
+        await delete_legacy_token_secret(name, logger)
+
+    # Сохраняем команды и хеши желаемого состояния пользователя
+    patch.status['team-operator'] = {
+        'teams': new_teams,
+        'kubeconfig_created': KUBECONFIG_MODE == 'on-demand' or kubeconfig_hash is not None,
+        'hashes': {
+            'account': account_hash,
+            'kubeconfig': kubeconfig_hash
+        }
+    }
+
     # Обновляем статус ресурса
     message = f'Пользователь {name} обновлен, добавлен в команды: {teams_to_add}, удален из команд: {teams_to_remove}'
     kopf.info(body, reason='Updated', message=message)
-    
+
     return {
         'service_account_updated': True,
         'teams': new_teams,
@@ -1405,29 +1731,32 @@ def update_user(body, spec, status, name, logger, **kwargs):
     }
 
 @kopf.on.field(group=GROUP, version=VERSION, plural=PLURAL_USERS, field='spec.fullName')
-def get_user_kubeconfig_handler(body, name, logger, **kwargs):
+@limited(PLURAL_USERS, PRIORITY_KUBECONFIG)
+@measured
+async def get_user_kubeconfig_handler(body, name, logger, **kwargs):
     """Обработчик для получения kubeconfig пользователя"""
     logger.info(f"Запрос kubeconfig для пользователя {name}")
     
+    if KUBECONFIG_MODE == 'on-demand':
+        logger.info(f"Kubeconfig пользователя {name} формируется веб-интерфейсом при скачивании")
+        return
+    
     # Получаем kubeconfig из ConfigMap
-    kubeconfig = get_user_kubeconfig(name, USERS_NAMESPACE, logger)
+    kubeconfig = await get_user_kubeconfig(name, USERS_NAMESPACE, logger)
     
     if kubeconfig:
         logger.info(f"Kubeconfig для пользователя {name} получен")
         # Обновляем аннотацию с временем последнего запроса kubeconfig
         try:
-            custom_api = kubernetes.client.CustomObjectsApi()
+            custom_api = kubernetes_asyncio.client.CustomObjectsApi(get_api_client())
             patch = {
                 'metadata': {
                     'annotations': {
-                        'team.example.com/last-kubeconfig-request': kubernetes.client.ApiClient().select_header_value(
-                            [kubernetes.client.ApiClient().RFC3339_DATETIME_FORMATTER(datetime.datetime.now(datetime.timezone.utc))
-                            ]
-                        )
+                        'team.example.com/last-kubeconfig-request': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
                     }
                 }
             }
-            custom_api.patch_cluster_custom_object(
+            await custom_api.patch_cluster_custom_object(
                 group=GROUP,
                 version=VERSION,
                 plural=PLURAL_USERS,
@@ -1440,94 +1769,48 @@ def get_user_kubeconfig_handler(body, name, logger, **kwargs):
         logger.warning(f"Не удалось получить kubeconfig для пользователя {name}")
 
 @kopf.on.delete(group=GROUP, version=VERSION, plural=PLURAL_USERS)
-def delete_user(body, spec, name, logger, **kwargs):
+@limited(PLURAL_USERS, PRIORITY_USER)
+@measured
+async def delete_user(body, spec, name, team_namespaces, team_members, owned_config_maps, logger, **kwargs):
     """Обработчик удаления ресурса User"""
     logger.info(f"Удаление ресурса User {name}")
     
     # Получаем данные из спецификации
     teams = spec.get('teams', [])
+    role = spec.get('role', 'developer')
     
     # Создаем API-клиент Kubernetes
-    api = kubernetes.client.CoreV1Api()
-    rbac_api = kubernetes.client.RbacAuthorizationV1Api()
+    api = kubernetes_asyncio.client.CoreV1Api(get_api_client())
     
     # Удаляем RoleBinding для каждой команды
     for team_name in teams:
-        try:
-            custom_api = kubernetes.client.CustomObjectsApi()
-            team = custom_api.get_cluster_custom_object(
-                group=GROUP,
-                version=VERSION,
-                plural=PLURAL_TEAMS,
-                name=team_name
-            )
-            
-            # Получаем окружения команды
-            environments = team.get('spec', {}).get('environments', [])
-            
-            # Удаляем RoleBinding для каждого окружения
-            for env in environments:
-                env_name = env.get('name')
-                if not env_name:
-                    continue
-                
-                # Формируем имя namespace на основе имени команды и окружения
-                namespace_name = f"{team_name}-{env_name}".lower()
-                
-                # Определяем возможные имена ролей
-                role_names = [f"{team_name}-admin", f"{team_name}-developer", f"{team_name}-viewer"]
-                
-                # Удаляем все возможные RoleBinding
-                for role_name in role_names:
-                    try:
-                        rbac_api.delete_namespaced_role_binding(
-                            name=f"{name}-{role_name}-binding",
-                            namespace=namespace_name
-                        )
-                        logger.info(f"RoleBinding {name}-{role_name}-binding удален из пространства имен {namespace_name}")
-                    except kubernetes.client.exceptions.ApiException as e:
-                        if e.status == 404:  # Не найдено
-                            logger.info(f"RoleBinding {name}-{role_name}-binding не существует в пространстве имен {namespace_name}")
-                        else:
-                            logger.warning(f"Ошибка при удалении RoleBinding {name}-{role_name}-binding: {e}")
-            
-        except kubernetes.client.exceptions.ApiException as e:
-            logger.warning(f"Команда {team_name} не найдена: {e}")
-    
-    # Удаляем ConfigMap с kubeconfig
-    try:
-        api.delete_namespaced_config_map(
-            name=f"{name}-kubeconfig",
-            namespace=USERS_NAMESPACE
-        )
-        logger.info(f"ConfigMap {name}-kubeconfig удален из пространства имен {USERS_NAMESPACE}")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 404:  # Не найдено
-            logger.info(f"ConfigMap {name}-kubeconfig не существует в пространстве имен {USERS_NAMESPACE}")
+        namespaces = get_team_namespaces(team_namespaces, team_name)
+        if namespaces is None:
+            logger.warning(f"Команда {team_name} не найдена")
+            continue
+        
+        if BINDING_MODE == 'group':
+            await sync_team_bindings(team_name, [role], namespaces, team_members, logger, exclude=name)
         else:
-            logger.warning(f"Ошибка при удалении ConfigMap {name}-kubeconfig: {e}")
+            await unbind_user_from_team(name, team_name, namespaces, logger)
     
-    # Удаляем Secret с токеном
-    try:
-        api.delete_namespaced_secret(
-            name=f"{name}-token",
-            namespace=USERS_NAMESPACE
-        )
-        logger.info(f"Secret {name}-token удален из пространства имен {USERS_NAMESPACE}")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 404:  # Не найдено
-            logger.info(f"Secret {name}-token не существует в пространстве имен {USERS_NAMESPACE}")
-        else:
-            logger.warning(f"Ошибка при удалении Secret {name}-token: {e}")
+    # Удаляем ConfigMap с kubeconfig (в режиме on-demand - только оставшийся от режима configmap)
+    config_map_key = (USERS_NAMESPACE, f"{name}-kubeconfig")
+    if KUBECONFIG_MODE == 'configmap' or config_map_key in owned_config_maps:
+        await delete_user_kubeconfig(name, logger)
+    
+    # Удаляем Secret с токеном, если пользователь создан прежней версией оператора и его токен еще не обновлялся
+    if config_map_key in owned_config_maps and not get_token_expiration(owned_config_maps, name):
+        await delete_legacy_token_secret(name, logger)
     
     # Удаляем ServiceAccount
     try:
-        api.delete_namespaced_service_account(
+        await api.delete_namespaced_service_account(
             name=name,
             namespace=USERS_NAMESPACE
         )
         logger.info(f"ServiceAccount {name} удален из пространства имен {USERS_NAMESPACE}")
-    except kubernetes.client.exceptions.ApiException as e:
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
         if e.status == 404:  # Не найдено
             logger.info(f"ServiceAccount {name} не существует в пространстве имен {USERS_NAMESPACE}")
         else:
@@ -1541,12 +1824,12 @@ def delete_user(body, spec, name, logger, **kwargs):
         'teams_removed': teams
     }
 
-def get_user_kubeconfig(name, namespace, logger):
+async def get_user_kubeconfig(name, namespace, logger):
     """Получает kubeconfig пользователя из ConfigMap"""
-    api = kubernetes.client.CoreV1Api()
+    api = kubernetes_asyncio.client.CoreV1Api(get_api_client())
     
     try:
-        config_map = api.read_namespaced_config_map(
+        config_map = await api.read_namespaced_config_map(
             name=f"{name}-kubeconfig",
             namespace=namespace
         )
@@ -1556,41 +1839,492 @@ def get_user_kubeconfig(name, namespace, logger):
         else:
             logger.warning(f"ConfigMap {name}-kubeconfig не содержит данных конфигурации")
             return None
-    except kubernetes.client.exceptions.ApiException as e:
+    except kubernetes_asyncio.client.exceptions.ApiException as e:
         if e.status == 404:  # Не найдено
             logger.warning(f"ConfigMap {name}-kubeconfig не существует в пространстве имен {namespace}")
         else:
             logger.error(f"Ошибка при получении ConfigMap {name}-kubeconfig: {e}")
         return None
 
-def main():
-    """Основная функция для запуска оператора"""
+def summarize_owned_object(body):
+    """Оставляет в объекте только поля, которые сравниваются при сверке
+
+    Содержимое ConfigMap в индексы не попадает.
+    """
+    metadata = body.get('metadata', {})
+    summary = {
+        'metadata': {
+            'labels': dict(metadata.get('labels') or {}),
+            'annotations': dict(metadata.get('annotations') or {})
+        }
+    }
+    for field in DRIFT_FIELDS:
+        if field in body:
+            summary[field] = copy.deepcopy(body[field])
+    return summary
+
+@kopf.index('v1', 'namespaces', labels=OWNED_LABELS)
+def owned_namespaces(name, body, meta, **kwargs):
+    """Индекс namespace, созданных оператором"""
+    summary = summarize_owned_object(body)
+    summary['terminating'] = bool(meta.get('deletionTimestamp'))
+    return {(None, name): summary}
+
+@kopf.index('v1', 'serviceaccounts', labels=OWNED_LABELS)
+def owned_service_accounts(name, namespace, body, **kwargs):
+    """Индекс ServiceAccount, созданных оператором"""
+    return {(namespace, name): summarize_owned_object(body)}
+
+@kopf.index('v1', 'configmaps', labels=OWNED_LABELS)
+def owned_config_maps(name, namespace, body, meta, **kwargs):
+    """Индекс ConfigMap, созданных оператором
+
+    Для ConfigMap с kubeconfig сохраняется uid пользователя-владельца,
+    который нужен при обновлении токена.
+    """
+    summary = summarize_owned_object(body)
+    for owner in meta.get('ownerReferences') or []:
+        if owner.get('kind') == 'User':
+            summary['owner_uid'] = owner.get('uid')
+    return {(namespace, name): summary}
+
+@kopf.index('v1', 'resourcequotas', labels=OWNED_LABELS)
+def owned_resource_quotas(name, namespace, body, **kwargs):
+    """Индекс ResourceQuota, созданных оператором"""
+    return {(namespace, name): summarize_owned_object(body)}
+
+@kopf.index('networking.k8s.io', 'v1', 'networkpolicies', labels=OWNED_LABELS)
+def owned_network_policies(name, namespace, body, **kwargs):
+    """Индекс NetworkPolicy, созданных оператором"""
+    return {(namespace, name): summarize_owned_object(body)}
+
+@kopf.index('rbac.authorization.k8s.io', 'v1', 'roles', labels=OWNED_LABELS)
+def owned_roles(name, namespace, body, **kwargs):
+    """Индекс Role, созданных оператором"""
+    return {(namespace, name): summarize_owned_object(body)}
+
+@kopf.index('rbac.authorization.k8s.io', 'v1', 'rolebindings', labels=OWNED_LABELS)
+def owned_role_bindings(name, namespace, body, **kwargs):
+    """Индекс RoleBinding, созданных оператором"""
+    return {(namespace, name): summarize_owned_object(body)}
+
+def get_owned_object(indexes, manifest):
+    """Возвращает сводку фактического объекта из индекса или None, если объекта нет"""
+    metadata = manifest['metadata']
+    index = indexes[OWNED_INDEXES[manifest['kind']]]
+    for summary in index.get((metadata.get('namespace'), metadata['name']), []):
+        return summary
+    return None
+
+def matches_desired(actual, desired, path=()):
+    """Проверяет, что фактическое значение содержит все желаемые поля
+
+    Поля, которые API-сервер добавляет сам (значения по умолчанию, чужие метки
+    и аннотации), расхождением не считаются. Пустые списки и словари равны
+    отсутствующему значению, величины квот сравниваются по значению.
+    """
+    if desired in ({}, [], None) and actual in ({}, [], None):
+        return True
+    if isinstance(desired, dict):
+        return isinstance(actual, dict) and all(
+            matches_desired(actual.get(key), value, path + (key,)) for key, value in desired.items()
+        )
+    if isinstance(desired, list):
+        return isinstance(actual, list) and len(actual) == len(desired) and all(
+            matches_desired(a, d, path) for a, d in zip(actual, desired)
+        )
+    if path[-2:-1] == ('hard',):
+        try:
+            return parse_quantity(actual) == parse_quantity(desired)
+        except (ValueError, TypeError):
+            pass
+    return actual == desired
+
+def is_drifted(manifest, indexes):
+    """Проверяет, отличается ли фактический объект от желаемого"""
+    actual = get_owned_object(indexes, manifest)
+    if actual is None:
+        return True
+
+    desired = {field: manifest[field] for field in DRIFT_FIELDS if field in manifest}
+    desired['metadata'] = {key: manifest['metadata'][key] for key in ('labels', 'annotations') if key in manifest['metadata']}
+    return not matches_desired(actual, desired)
+
+def get_object_name(manifest):
+    """Возвращает имя объекта для журнала в виде "Kind namespace/имя" """
+    metadata = manifest['metadata']
+    return f"{manifest['kind']} {metadata.get('namespace') or ''}/{metadata['name']}".replace(' /', ' ')
+
+async def repair_drifted(manifests, indexes, logger):
+    """Применяет только те объекты, фактическое состояние которых разошлось с желаемым
+
+    Возвращает список восстановленных объектов в виде "Kind namespace/имя".
+    """
+    repaired = []
+    for manifest in manifests:
+        # Объекты вне наблюдаемых пространств имен в индексы не попадают
+        if not is_watched_namespace(manifest['metadata'].get('namespace')) or not is_drifted(manifest, indexes):
+            continue
+
+        object_name = get_object_name(manifest)
+        logger.warning(f"{object_name} отличается от желаемого состояния, восстанавливаем")
+        try:
+            await apply_object(manifest, logger)
+            repaired.append(object_name)
+        except kubernetes_asyncio.client.exceptions.ApiException as e:
+            logger.error(f"Ошибка при восстановлении {object_name}: {e}")
+    return repaired
+
+async def patch_operator_status(plural, name, state):
+    """Записывает состояние оператора в статус Team или User вне обработчиков kopf"""
+    custom_api = kubernetes_asyncio.client.CustomObjectsApi(get_api_client())
+    await custom_api.patch_cluster_custom_object_status(
+        group=GROUP,
+        version=VERSION,
+        plural=plural,
+        name=name,
+        body={'status': {'team-operator': state}},
+        _content_type='application/merge-patch+json'
+    )
+
+async def adopt_team(name, spec, logger):
+    """Применяет окружения команды, созданной прежней версией оператора, и записывает их хеши
+
+    У такой команды нет хешей в статусе, а у ее объектов - меток, по которым
+    строятся индексы, поэтому все объекты окружений применяются заново (это
+    проставляет метки). Если какое-то окружение применить не удалось, хеши не
+    записываются и команда применяется заново при следующей сверке.
+    """
+    environments = spec.get('environments', [])
+    validate_environments(name, environments)
+
+    envs = []
+    jobs = []
+    for env in environments:
+        if env.get('name'):
+            manifests = render_environment(name, env)
+            envs.append((env, manifests))
+            jobs.append(apply_environment_job(manifests, logger))
+
+    applied = []
+    namespaces = []
+    hashes = {}
+    failed = False
+    for (env, manifests), errors in zip(envs, await run_environment_jobs(jobs)):
+        namespace_name = manifests['namespace']['metadata']['name']
+        if errors:
+            for e in errors:
+                logger.error(f"Ошибка при применении ресурсов для namespace {namespace_name}: {e}")
+            failed = True
+            continue
+
+        applied.extend(get_object_name(manifest) for manifest in manifests.values())
+        namespaces.append({
+            'name': namespace_name,
+            'environment': env['name'],
+            'description': env.get('description', '')
+        })
+        hashes[namespace_name] = compute_hash(manifests)
+
+    if not failed:
+        await patch_operator_status(PLURAL_TEAMS, name, {'namespaces': namespaces, 'hashes': hashes})
+    return applied
+
+@measured
+async def reconcile_team(name, spec, status, indexes, logger):
+    """Сверяет объекты окружений команды с желаемым состоянием
+
+    Сверяются только окружения, успешно обработанные обработчиками создания и
+    обновления (хеш в статусе совпадает с текущей спецификацией): остальные
+    окружения еще обрабатываются или будут повторно обработаны при следующем
+    изменении команды. Команда без хешей в статусе создана прежней версией
+    оператора, и ее окружения применяются целиком (adopt_team). В режиме
+    group вместе с окружением сверяются общие RoleBinding ролей команды.
+    """
+    if 'hashes' not in status.get('team-operator', {}):
+        logger.info(f"Команда {name} создана прежней версией оператора, применяем ее окружения")
+        return await adopt_team(name, spec, logger)
+
+    hashes = status['team-operator']['hashes']
+
+    repaired = []
+    for env in spec.get('environments', []):
+        if not env.get('name'):
+            continue
+
+        manifests = render_environment(name, env)
+        if hashes.get(manifests['namespace']['metadata']['name']) != compute_hash(manifests):
+            continue
+
+        # Namespace идет первым, чтобы остальные объекты было куда применять
+        repaired.extend(await repair_drifted(manifests.values(), indexes, logger))
+
+        # Общие RoleBinding сверяются один раз на команду, а не у каждого участника
+        if BINDING_MODE == 'group':
+            repaired.extend(await repair_group_bindings(name, manifests['namespace']['metadata']['name'], indexes, logger))
+    return repaired
+
+async def repair_group_bindings(team_name, namespace_name, indexes, logger):
+    """Восстанавливает общие RoleBinding ролей команды в namespace окружения
+
+    Проверяются роли, у которых есть участники. Разошедшийся RoleBinding
+    записывается через rbac_batcher и формируется в момент записи по индексу
+    team_members, поэтому сверка не затирает состав, записанный обработчиком
+    пользователя позже снимка, по которому она проверялась.
+    """
+    if not is_watched_namespace(namespace_name):
+        return []
+
+    team_members = indexes['team_members']
+    repaired = []
+    for role in sorted({role for _, role in team_members.get(team_name, [])}):
+        render = group_binding_renderer(team_name, role, namespace_name, team_members)
+        manifest = render()
+        if not is_drifted(manifest, indexes):
+            continue
+
+        object_name = get_object_name(manifest)
+        logger.warning(f"{object_name} отличается от желаемого состояния, восстанавливаем")
+        if await apply_binding(manifest, logger, render):
+            repaired.append(object_name)
+    return repaired
+
+@measured
+async def reconcile_user(name, spec, status, uid, indexes, logger):
+    """Сверяет объекты пользователя с желаемым состоянием
+
+    Сверяются ServiceAccount, ConfigMap с kubeconfig и
+    RoleBinding в командах, в которые пользователь уже добавлен (Role команд
+    и общие RoleBinding режима group сверяются вместе с окружениями команды).
+    Пользователь без хешей в статусе
+    создан прежней версией оператора, и его объекты применяются целиком (adopt_user).
+    """
+    state = status.get('team-operator', {})
+    if 'hashes' not in state:
+        logger.info(f"Пользователь {name} создан прежней версией оператора, применяем его объекты")
+        return await adopt_user(name, spec, uid, indexes, logger)
+
+    hashes = state['hashes']
+
+    manifests = [render_service_account(name, spec)]
+    if not hashes.get('account') or hashes['account'] != compute_hash(*manifests):
+        return []
+
+    role = spec.get('role', 'developer')
+    for team_name in state.get('teams', []) if BINDING_MODE == 'user' else []:
+        if team_name not in spec.get('teams', []):
+            continue
+
+        namespaces = get_team_namespaces(indexes['team_namespaces'], team_name) or []
+        role_name = get_user_role_name(team_name, role)
+        for namespace_name in namespaces:
+            manifests.append(render_user_role_binding(name, role_name, namespace_name))
+
+    repaired = await repair_drifted(manifests, indexes, logger)
+
+    # Содержимое kubeconfig зависит от токена, поэтому проверяется только наличие ConfigMap
+    config_map = {'kind': 'ConfigMap', 'metadata': {'name': f"{name}-kubeconfig", 'namespace': USERS_NAMESPACE}}
+    if KUBECONFIG_MODE == 'configmap' and hashes.get('kubeconfig') and get_owned_object(indexes, config_map) is None:
+        logger.warning(f"ConfigMap {name}-kubeconfig отсутствует, восстанавливаем")
+        if await apply_user_kubeconfig(name, uid, logger) is not None:
+            repaired.append(f"ConfigMap {USERS_NAMESPACE}/{name}-kubeconfig")
+    return repaired
+
+async def adopt_user(name, spec, uid, indexes, logger):
+    """Применяет объекты пользователя, созданного прежней версией оператора, и записывает их хеши
+
+    Объекты применяются так же, как при создании пользователя, kubeconfig
+    получает токен из TokenRequest, а Secret с токеном прежней версии удаляется.
+    """
+    state = await apply_user(name, spec, uid, indexes['team_namespaces'], indexes['team_members'], logger)
+
+    applied = [f"ServiceAccount {USERS_NAMESPACE}/{name}"]
+    if state['hashes']['kubeconfig'] is not None:
+        applied.append(f"ConfigMap {USERS_NAMESPACE}/{name}-kubeconfig")
+    elif KUBECONFIG_MODE == 'on-demand':
+        # kubeconfig формируется при скачивании, ConfigMap прежней версии больше не нужен
+        await delete_user_kubeconfig(name, logger)
+    if state['kubeconfig_created']:
+        await delete_legacy_token_secret(name, logger)
+
+    await patch_operator_status(PLURAL_USERS, name, state)
+    return applied
+
+async def run_reconcile_loop(reconcile, stopped, logger, *args):
+    """Периодически вызывает функцию сверки до остановки демона
+
+    Первая сверка откладывается на случайное время в пределах периода, а
+    каждый следующий период случайно отклоняется на RECONCILE_JITTER, чтобы
+    сверки всех объектов распределялись по времени равномерно.
+    """
+    if RECONCILE_INTERVAL <= 0:
+        return
+
+    await stopped.wait(random.uniform(0, RECONCILE_INTERVAL))
+    while not stopped:
+        try:
+            # Сверка уступает место обработчикам изменений команд и пользователей
+            async with handler_limiter.slot(PRIORITY_RECONCILE):
+                repaired = await reconcile(*args, logger)
+            if repaired:
+                logger.info(f"Восстановлены объекты: {', '.join(repaired)}")
+        except Exception as e:
+            logger.error(f"Ошибка при сверке: {e}")
+
+        jitter = random.uniform(-RECONCILE_JITTER, RECONCILE_JITTER)
+        await stopped.wait(RECONCILE_INTERVAL * (1 + jitter))
+
+@kopf.daemon(group=GROUP, version=VERSION, plural=PLURAL_TEAMS, cancellation_timeout=10)
+async def reconcile_team_daemon(name, spec, status, stopped, logger, **kwargs):
+    """Демон периодической сверки объектов команды"""
+    await run_reconcile_loop(reconcile_team, stopped, logger, name, spec, status, kwargs)
+
+@kopf.daemon(group=GROUP, version=VERSION, plural=PLURAL_USERS, cancellation_timeout=10)
+async def reconcile_user_daemon(name, spec, status, uid, stopped, logger, **kwargs):
+    """Демон периодической сверки объектов пользователя"""
+    await run_reconcile_loop(reconcile_user, stopped, logger, name, spec, status, uid, kwargs)
+
+# Фоновая задача обновления токенов пользователей
+token_refresher = None
+
+@kopf.on.startup()
+async def startup_fn(settings, owned_config_maps, logger, **kwargs):
+    """Загружает конфигурацию Kubernetes и готовит общие ресурсы оператора"""
+    # Настройки обработки объектов kopf
+    settings.batching.worker_limit = MAX_WORKERS or None
+    settings.posting.level = logging.getLevelName(POSTING_LEVEL)
+    if WATCH_SERVER_TIMEOUT > 0:
+        settings.watching.server_timeout = WATCH_SERVER_TIMEOUT
+    
     # Пытаемся загрузить конфигурацию из кластера, если не получается - из локального kubeconfig
     try:
-        kubernetes.config.load_incluster_config()
+        kubernetes_asyncio.config.load_incluster_config()
         logger.info("Запуск оператора внутри кластера Kubernetes")
-    except kubernetes.config.config_exception.ConfigException:
+    except kubernetes_asyncio.config.config_exception.ConfigException:
         try:
-            kubernetes.config.load_kube_config()
+            await kubernetes_asyncio.config.load_kube_config()
             logger.info("Запуск оператора вне кластера Kubernetes с использованием kubeconfig")
-        except kubernetes.config.config_exception.ConfigException:
+        except kubernetes_asyncio.config.config_exception.ConfigException as e:
             logger.error("Не удалось загрузить конфигурацию Kubernetes. Убедитесь, что kubeconfig доступен или оператор запущен в кластере.")
-            raise
+            raise kopf.PermanentError(f"Не удалось загрузить конфигурацию Kubernetes: {e}")
+    
+    # Публикуем метрики Prometheus
+    if METRICS_PORT > 0:
+        metrics.start_metrics_server(METRICS_PORT)
+        logger.info(f"Метрики доступны на порту {METRICS_PORT} по адресу /metrics")
     
     # Убеждаемся, что пространство имен пользователей существует
-    ensure_users_namespace(logger)
+    await ensure_users_namespace(logger)
+    
+    # Определяем параметры подключения к кластеру для kubeconfig пользователей
+    try:
+        await get_cluster_info(logger)
+    except Exception as e:
+        logger.warning(f"Не удалось получить информацию о кластере: {e}")
+    
+    # Запускаем обновление истекающих токенов пользователей (в режиме on-demand токены не хранятся)
+    global token_refresher
+    if KUBECONFIG_MODE == 'configmap':
+        token_refresher = asyncio.create_task(run_token_refresher(owned_config_maps))
+
+@kopf.on.cleanup()
+async def cleanup_fn(logger, **kwargs):
+    """Останавливает обновление токенов и закрывает соединения с API-сервером при остановке оператора"""
+    if token_refresher is not None:
+        token_refresher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await token_refresher
+    await close_api_client()
+
+def main():
+    """Основная функция для запуска оператора"""
+    # Параметры подключения перечитываются по сигналу SIGHUP
+    signal.signal(signal.SIGHUP, reset_cluster_info)
     
-    # Запускаем оператор
-    kopf.run()
+    # Запускаем оператор для всех или только для указанных пространств имен
+    if WATCH_NAMESPACES:
+        kopf.run(namespaces=list(dict.fromkeys(WATCH_NAMESPACES + [USERS_NAMESPACE])))
+    else:
+        kopf.run(clusterwide=True)
 
 if __name__ == "__main__":
     # Парсинг аргументов командной строки
     parser = argparse.ArgumentParser(description='Kubernetes оператор для управления командами и пользователями')
     parser.add_argument('--kubeconfig', help='Путь к файлу kubeconfig для запуска вне кластера')
-    parser.add_argument('--namespace', help='Пространство имен для наблюдения (по умолчанию - все)')
+    parser.add_argument('--namespace', action='append', dest='namespaces',
+                        help='Пространство имен или шаблон для наблюдения за объектами оператора (можно указать несколько раз, по умолчанию - все)')
     parser.add_argument('--verbose', action='store_true', help='Включить подробное логирование')
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS,
+                        help='Максимальное количество одновременно обрабатываемых объектов каждого типа (0 - без ограничения)')
+    parser.add_argument('--max-handlers', type=int, default=MAX_HANDLERS,
+                        help='Максимальное количество одновременно выполняемых обработчиков (0 - без ограничения)')
+    parser.add_argument('--team-concurrency', type=int, default=TEAM_CONCURRENCY,
+                        help='Максимальное количество одновременно выполняемых обработчиков команд (0 - без ограничения)')
+    parser.add_argument('--user-concurrency', type=int, default=USER_CONCURRENCY,
+                        help='Максимальное количество одновременно выполняемых обработчиков пользователей (0 - без ограничения)')
+    parser.add_argument('--api-qps', type=float, default=API_QPS,
+                        help='Ограничение частоты запросов к API-серверу в секунду (0 - без ограничения)')
+    parser.add_argument('--api-burst', type=int, default=API_BURST,
+                        help='Допустимый всплеск запросов к API-серверу')
+    parser.add_argument('--posting-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default=POSTING_LEVEL,
+                        help='Минимальный уровень сообщений, публикуемых как события Kubernetes')
+    parser.add_argument('--watch-server-timeout', type=float, default=WATCH_SERVER_TIMEOUT,
+                        help='Таймаут watch-запросов на стороне API-сервера в секундах (0 - по умолчанию)')
+    parser.add_argument('--trace-file', default=TRACE_FILE,
+                        help='Файл для записи span трассировки в формате JSON Lines (по умолчанию трассировка отключена)')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='Порт HTTP-сервера метрик Prometheus (0 - метрики не публикуются)')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                        help='Максимальное количество одновременных запросов к API при обработке окружений команды')
+    parser.add_argument('--batch-window', type=float, default=BATCH_WINDOW,
+                        help='Окно накопления записей общих RoleBinding ролей команд в режиме group в секундах (0 - без накопления)')
+    parser.add_argument('--token-expiration', type=int, default=TOKEN_EXPIRATION,
+                        help='Срок действия токенов пользователей в секундах (не меньше 600)')
+    parser.add_argument('--token-refresh-before', type=float, default=TOKEN_REFRESH_BEFORE,
+                        help='За сколько секунд до истечения токен пользователя запрашивается заново (0 - за пятую часть срока действия)')
+    parser.add_argument('--token-refresh-batch', type=int, default=TOKEN_REFRESH_BATCH,
+                        help='Максимальное количество токенов, обновляемых за одну проверку')
+    parser.add_argument('--kubeconfig-mode', choices=KUBECONFIG_MODES, default=KUBECONFIG_MODE,
+                        help='Режим выдачи kubeconfig: configmap - kubeconfig хранится в ConfigMap, on-demand - формируется веб-интерфейсом при скачивании')
+    parser.add_argument('--binding-mode', choices=BINDING_MODES, default=BINDING_MODE,
+                        help='Режим привязки пользователей к ролям: user - RoleBinding на пользователя, group - общий RoleBinding на роль команды')
     args = parser.parse_args()
     
+    # Режимы привязки пользователей к ролям и выдачи kubeconfig (значения проверяет argparse)
+    BINDING_MODE = args.binding_mode
+    KUBECONFIG_MODE = args.kubeconfig_mode
+    
+    # Срок действия и обновление токенов пользователей
+    if args.token_expiration < 600:
+        parser.error("Срок действия токенов должен быть не меньше 600 секунд")
+    if args.token_refresh_before >= args.token_expiration:
+        parser.error("Токен должен обновляться раньше, чем истечет срок его действия")
+    TOKEN_EXPIRATION = args.token_expiration
+    TOKEN_REFRESH_BEFORE = args.token_refresh_before
+    TOKEN_REFRESH_BATCH = max(1, args.token_refresh_batch)
+    
+    # Ограничение параллельной обработки окружений
+    MAX_IN_FLIGHT = max(1, args.max_in_flight)
+    
+    # Накопление записей RBAC при одновременной обработке многих пользователей (только в режиме group)
+    if args.batch_window > 0 and BINDING_MODE != 'group':
+        logger.warning("Окно накопления записей RoleBinding действует только в режиме привязки group")
+    rbac_batcher.window = args.batch_window
+    
+    # Ограничения обработки объектов и запросов к API-серверу
+    if args.namespaces:
+        WATCH_NAMESPACES = args.namespaces
+    MAX_WORKERS = args.max_workers
+    handler_limiter.limit = args.max_handlers
+    kind_limiters[PLURAL_TEAMS].limit = args.team_concurrency
+    kind_limiters[PLURAL_USERS].limit = args.user_concurrency
+    API_QPS = args.api_qps
+    API_BURST = args.api_burst
+    POSTING_LEVEL = args.posting_level
+    WATCH_SERVER_TIMEOUT = args.watch_server_timeout
+    METRICS_PORT = args.metrics_port
+    tracer.path = args.trace_file
+    
     # Настройка уровня логирования
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
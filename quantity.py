@@ -0,0 +1,92 @@
+"""Разбор величин ресурсов Kubernetes (resource.Quantity)
+
+Поддерживаются двоичные (Ki, Mi, Gi, Ti, Pi, Ei) и десятичные (n, u, m, k,
+M, G, T, P, E) суффиксы, а также экспоненциальная запись (1e3, 5E-2).
+Значения возвращаются точно, в базовых единицах (ядрах, байтах, штуках).
+"""
+
+import functools
+import re
+from fractions import Fraction
+
+# Множители суффиксов
+SUFFIXES = {
+    'Ki': 2 ** 10,
+    'Mi': 2 ** 20,
+    'Gi': 2 ** 30,
+    'Ti': 2 ** 40,
+    'Pi': 2 ** 50,
+    'Ei': 2 ** 60,
+    'n': Fraction(1, 10 ** 9),
+    'u': Fraction(1, 10 ** 6),
+    'm': Fraction(1, 10 ** 3),
+    '': 1,
+    'k': 10 ** 3,
+    'M': 10 ** 6,
+    'G': 10 ** 9,
+    'T': 10 ** 12,
+    'P': 10 ** 15,
+    'E': 10 ** 18
+}
+
+# Число, затем суффикс или десятичная экспонента ("1E" - это экса, "1E3" - экспонента)
+QUANTITY_RE = re.compile(
+    r'^(?P<number>[+-]?(?:\d+(?:\.\d*)?|\.\d+))'
+    r'(?:(?P<suffix>Ki|Mi|Gi|Ti|Pi|Ei|n|u|m|k|M|G|T|P|E)|[eE](?P<exponent>[+-]?\d+))?$'
+)
+
+# Ресурсы квоты, для которых запрос не должен превышать лимит
+REQUEST_LIMIT_PAIRS = (
+    ('cpu', 'cpu_limit'),
+    ('memory', 'memory_limit')
+)
+
+@functools.lru_cache(maxsize=4096)
+def _parse(value):
+    match = QUANTITY_RE.match(value.strip())
+    if not match:
+        raise ValueError(f"Некорректное значение величины: {value!r}")
+
+    number = Fraction(match.group('number'))
+    if match.group('exponent') is not None:
+        return number * Fraction(10) ** int(match.group('exponent'))
+    return number * SUFFIXES[match.group('suffix') or '']
+
+def parse_quantity(value):
+    """Возвращает величину в базовых единицах как Fraction
+
+    Для целых значений знаменатель равен 1, поэтому результат можно
+    сравнивать и делить без потери точности.
+    """
+    if isinstance(value, (int, Fraction)):
+        return Fraction(value)
+    return _parse(str(value))
+
+def usage_percentage(used, hard):
+    """Возвращает процент использования (не больше 100)"""
+    hard_value = parse_quantity(hard)
+    if hard_value <= 0:
+        return 0
+    return min(float(parse_quantity(used) / hard_value * 100), 100)
+
+def validate_quota(quota):
+    """Проверяет квоту окружения из спецификации Team
+
+    Возвращает список ошибок: некорректные значения и запросы, превышающие лимиты.
+    """
+    errors = []
+    values = {}
+    for key, value in (quota or {}).items():
+        try:
+            values[key] = parse_quantity(value)
+        except ValueError as e:
+            errors.append(f"{key}: {e}")
+            continue
+        if values[key] < 0:
+            errors.append(f"{key}: значение не может быть отрицательным")
+
+    for request_key, limit_key in REQUEST_LIMIT_PAIRS:
+        if request_key in values and limit_key in values and values[request_key] > values[limit_key]:
+            errors.append(f"{request_key} ({quota[request_key]}) превышает {limit_key} ({quota[limit_key]})")
+
+    return errors
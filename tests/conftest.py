@@ -0,0 +1,27 @@
+"""Общие настройки тестов
+
+Корень репозитория добавляется в конец пути, чтобы operator.py не подменял
+стандартный модуль operator (так же, как в bench/benchmark.py). Тесты
+запускаются из корня репозитория командой pytest.
+"""
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+@pytest.fixture(scope='session')
+def op():
+    """Модуль operator.py, загруженный под именем team_operator"""
+    module = sys.modules.get('team_operator')
+    if module is None:
+        spec = importlib.util.spec_from_file_location('team_operator', os.path.join(ROOT, 'operator.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['team_operator'] = module
+        spec.loader.exec_module(module)
+    return module
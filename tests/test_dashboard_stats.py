@@ -0,0 +1,73 @@
+from app import DashboardStats
+
+def make_team(name, environments):
+    return {'metadata': {'name': name}, 'spec': {'environments': [{'name': f"env{i}"} for i in range(environments)]}}
+
+def make_user(name, role='developer', teams=()):
+    return {'metadata': {'name': name}, 'spec': {'role': role, 'teams': list(teams)}}
+
+def test_empty():
+    assert DashboardStats().snapshot() == {
+        'teams_count': 0,
+        'users_count': 0,
+        'environments_count': 0,
+        'admin_count': 0,
+        'developer_count': 0,
+        'viewer_count': 0,
+        'team_environments': {},
+        'team_members': {}
+    }
+
+def test_team_events():
+    stats = DashboardStats()
+    stats.on_team(None, make_team('a', 2))
+    stats.on_team(None, make_team('b', 1))
+    stats.on_team(make_team('a', 2), make_team('a', 3))
+    stats.on_team(make_team('b', 1), None)
+
+    snapshot = stats.snapshot()
+    assert snapshot['teams_count'] == 1
+    assert snapshot['environments_count'] == 3
+    assert snapshot['team_environments'] == {'a': 3}
+
+def test_user_events():
+    stats = DashboardStats()
+    stats.on_user(None, make_user('u1', 'admin', ['a', 'b']))
+    stats.on_user(None, make_user('u2', teams=['a']))
+    stats.on_user(make_user('u2', teams=['a']), make_user('u2', 'viewer', ['b']))
+
+    snapshot = stats.snapshot()
+    assert snapshot['users_count'] == 2
+    assert (snapshot['admin_count'], snapshot['developer_count'], snapshot['viewer_count']) == (1, 0, 1)
+    assert snapshot['team_members'] == {'a': 1, 'b': 2}
+
+    stats.on_user(make_user('u1', 'admin', ['a', 'b']), None)
+    snapshot = stats.snapshot()
+    assert snapshot['users_count'] == 1
+    assert snapshot['admin_count'] == 0
+    assert snapshot['team_members'] == {'b': 1}
+
+def test_repeated_event_is_idempotent():
+    stats = DashboardStats()
+    user = make_user('u1', teams=['a'])
+    stats.on_user(None, user)
+    stats.on_user(user, user)
+    stats.on_user(user, user)
+    assert stats.snapshot()['users_count'] == 1
+    assert stats.snapshot()['team_members'] == {'a': 1}
+
+def test_duplicate_teams_and_unknown_role():
+    stats = DashboardStats()
+    user = make_user('u1', 'owner', ['a', 'a'])
+    stats.on_user(None, user)
+    snapshot = stats.snapshot()
+    assert snapshot['users_count'] == 1
+    assert snapshot['developer_count'] == 0
+    assert snapshot['team_members'] == {'a': 1}
+    stats.on_user(user, None)
+    assert stats.snapshot()['team_members'] == {}
+
+def test_user_without_spec():
+    stats = DashboardStats()
+    stats.on_user(None, {'metadata': {'name': 'u1'}})
+    assert stats.snapshot()['developer_count'] == 1
@@ -0,0 +1,84 @@
+import copy
+
+import pytest
+
+@pytest.fixture
+def environment(op):
+    return op.render_environment('t', {'name': 'dev', 'quota': {'cpu': '1', 'memory': '1Gi'}})
+
+def make_indexes(op, *bodies):
+    """Строит индексы созданных оператором объектов, как их строит kopf"""
+    index_functions = {kind: getattr(op, index) for kind, index in op.OWNED_INDEXES.items()}
+    indexes = {index: {} for index in op.OWNED_INDEXES.values()}
+    for body in bodies:
+        metadata = body['metadata']
+        index = indexes[op.OWNED_INDEXES[body['kind']]]
+        result = index_functions[body['kind']](name=metadata['name'], namespace=metadata.get('namespace'),
+                                               body=body, meta=metadata)
+        for key, value in result.items():
+            index.setdefault(key, []).append(value)
+    return indexes
+
+def test_matches_desired_ignores_server_fields(op):
+    actual = {
+        'metadata': {'labels': {'team': 't', 'extra': 'x'}, 'annotations': {'kubectl': 'y'}},
+        'spec': {'hard': {'pods': '20'}, 'scopes': []}
+    }
+    desired = {'metadata': {'labels': {'team': 't'}}, 'spec': {'hard': {'pods': '20'}}}
+    assert op.matches_desired(actual, desired)
+
+def test_matches_desired_detects_changed_values(op):
+    desired = {'metadata': {'labels': {'team': 't'}}, 'spec': {'hard': {'pods': '20'}}}
+    assert not op.matches_desired({'metadata': {'labels': {'team': 'u'}}, 'spec': {'hard': {'pods': '20'}}}, desired)
+    assert not op.matches_desired({'metadata': {'labels': {'team': 't'}}, 'spec': {'hard': {'pods': '10'}}}, desired)
+    assert not op.matches_desired({'metadata': {'labels': {'team': 't'}}}, desired)
+
+def test_matches_desired_treats_empty_as_missing(op):
+    assert op.matches_desired(None, {})
+    assert op.matches_desired({}, [])
+    assert op.matches_desired({'subjects': None}, {'subjects': []})
+
+def test_matches_desired_compares_lists_by_position(op):
+    desired = {'subjects': [{'name': 'a'}, {'name': 'b'}]}
+    assert op.matches_desired({'subjects': [{'name': 'a', 'namespace': 'users'}, {'name': 'b'}]}, desired)
+    assert not op.matches_desired({'subjects': [{'name': 'b'}, {'name': 'a'}]}, desired)
+    assert not op.matches_desired({'subjects': [{'name': 'a'}]}, desired)
+
+def test_matches_desired_compares_quota_values(op):
+    desired = {'spec': {'hard': {'requests.memory': '1Gi', 'requests.cpu': '500m'}}}
+    assert op.matches_desired({'spec': {'hard': {'requests.memory': '1024Mi', 'requests.cpu': '0.5'}}}, desired)
+    assert not op.matches_desired({'spec': {'hard': {'requests.memory': '1G', 'requests.cpu': '0.5'}}}, desired)
+    # Величины сравниваются по значению только внутри hard
+    assert not op.matches_desired({'metadata': {'labels': {'size': '1024Mi'}}}, {'metadata': {'labels': {'size': '1Gi'}}})
+
+def test_is_drifted_missing_object(op, environment):
+    assert op.is_drifted(environment['resource_quota'], make_indexes(op))
+
+def test_is_drifted_matching_objects(op, environment):
+    indexes = make_indexes(op, *(copy.deepcopy(manifest) for manifest in environment.values()))
+    for manifest in environment.values():
+        assert not op.is_drifted(manifest, indexes)
+
+def test_is_drifted_ignores_server_defaults(op, environment):
+    actual = copy.deepcopy(environment['resource_quota'])
+    actual['metadata']['labels']['added-by'] = 'someone'
+    actual['metadata']['resourceVersion'] = '42'
+    actual['spec']['hard']['requests.memory'] = '1024Mi'
+    actual['status'] = {'used': {'pods': '3'}}
+    assert not op.is_drifted(environment['resource_quota'], make_indexes(op, actual))
+
+def test_is_drifted_changed_spec(op, environment):
+    actual = copy.deepcopy(environment['resource_quota'])
+    actual['spec']['hard']['pods'] = '100'
+    assert op.is_drifted(environment['resource_quota'], make_indexes(op, actual))
+
+def test_is_drifted_removed_label(op, environment):
+    actual = copy.deepcopy(environment['namespace'])
+    del actual['metadata']['labels']['team']
+    assert op.is_drifted(environment['namespace'], make_indexes(op, actual))
+
+def test_is_drifted_changed_subjects(op):
+    desired = op.render_group_role_binding('t', 'developer', 't-dev', ['u1', 'u2'])
+    actual = op.render_group_role_binding('t', 'developer', 't-dev', ['u1'])
+    assert op.is_drifted(desired, make_indexes(op, actual))
+    assert not op.is_drifted(desired, make_indexes(op, copy.deepcopy(desired)))
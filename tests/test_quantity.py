@@ -0,0 +1,76 @@
+from fractions import Fraction
+
+import pytest
+
+from quantity import parse_quantity, usage_percentage, validate_quota
+
+@pytest.mark.parametrize('value, expected', [
+    ('1', 1),
+    ('0', 0),
+    ('250m', Fraction(1, 4)),
+    ('1.5', Fraction(3, 2)),
+    ('.5', Fraction(1, 2)),
+    ('+2', 2),
+    ('-1', -1),
+    ('100n', Fraction(1, 10 ** 7)),
+    ('10u', Fraction(1, 10 ** 5)),
+    ('2k', 2000),
+    ('3M', 3 * 10 ** 6),
+    ('1G', 10 ** 9),
+    ('1T', 10 ** 12),
+    ('1P', 10 ** 15),
+    ('1E', 10 ** 18),
+    ('1Ki', 1024),
+    ('1.5Ki', 1536),
+    ('8Gi', 8 * 2 ** 30),
+    ('1Ti', 2 ** 40),
+    ('1Pi', 2 ** 50),
+    ('1Ei', 2 ** 60),
+    ('1e3', 1000),
+    ('5E-2', Fraction(1, 20)),
+    ('1.5e+2', 150),
+    (' 2Mi ', 2 * 2 ** 20),
+    (3, 3),
+    (Fraction(1, 3), Fraction(1, 3)),
+])
+def test_parse_quantity(value, expected):
+    assert parse_quantity(value) == expected
+
+@pytest.mark.parametrize('value', ['', 'abc', '1Kb', '1.2.3', 'Mi', '1 Gi', '1e', '1mi', '--1'])
+def test_parse_quantity_invalid(value):
+    with pytest.raises(ValueError):
+        parse_quantity(value)
+
+def test_parse_quantity_is_exact():
+    assert parse_quantity('100m') * 3 == parse_quantity('300m')
+    assert parse_quantity('1Gi') == parse_quantity('1024Mi')
+    assert parse_quantity('1000M') == parse_quantity('1G')
+
+def test_usage_percentage():
+    assert usage_percentage('500m', '2') == 25
+    assert usage_percentage('1Gi', '512Mi') == 100
+    assert usage_percentage('1', '0') == 0
+
+def test_validate_quota_accepts_valid_quota():
+    assert validate_quota({'cpu': '2', 'cpu_limit': '4', 'memory': '1Gi', 'memory_limit': '2Gi', 'pods': '10'}) == []
+    assert validate_quota({'cpu': '2', 'cpu_limit': '2000m'}) == []
+    assert validate_quota({}) == []
+    assert validate_quota(None) == []
+
+def test_validate_quota_reports_invalid_values():
+    errors = validate_quota({'cpu': 'two', 'pods': '-1'})
+    assert len(errors) == 2
+    assert errors[0].startswith('cpu: ')
+    assert errors[1].startswith('pods: ')
+
+def test_validate_quota_reports_request_above_limit():
+    errors = validate_quota({'cpu': '4', 'cpu_limit': '2', 'memory': '3Gi', 'memory_limit': '2048Mi'})
+    assert errors == [
+        'cpu (4) превышает cpu_limit (2)',
+        'memory (3Gi) превышает memory_limit (2048Mi)'
+    ]
+
+def test_validate_quota_skips_pair_with_invalid_value():
+    errors = validate_quota({'cpu': 'x', 'cpu_limit': '1'})
+    assert len(errors) == 1
+    assert errors[0].startswith('cpu: ')
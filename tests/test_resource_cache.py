@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+import app
+from app import ResourceCache
+
+def make_obj(name, version, namespace=None, **spec):
+    metadata = {'name': name, 'resourceVersion': str(version)}
+    if namespace:
+        metadata['namespace'] = namespace
+    return {'metadata': metadata, 'spec': spec}
+
+class Response:
+    def __init__(self, data):
+        self.data = json.dumps(data)
+
+class FakeWatch:
+    """Замена kubernetes.watch.Watch, которая отдает заданные события"""
+
+    events = []
+
+    def stream(self, func, **kwargs):
+        return iter(self.events)
+
+    def stop(self):
+        pass
+
+@pytest.fixture
+def cache():
+    cache = ResourceCache('test', lambda **kwargs: None)
+    cache.changes = []
+    cache.add_handler(lambda old, new: cache.changes.append((old, new)))
+    return cache
+
+def watch_events(monkeypatch, cache, *events):
+    monkeypatch.setattr(FakeWatch, 'events', [{'type': kind, 'raw_object': obj} for kind, obj in events])
+    monkeypatch.setattr(app.kubernetes.watch, 'Watch', FakeWatch)
+    cache.watch(1)
+
+def test_key():
+    assert ResourceCache.key(make_obj('a', 1)) == 'a'
+    assert ResourceCache.key(make_obj('a', 1, namespace='ns')) == 'ns/a'
+
+@pytest.mark.parametrize('version, current, expected', [
+    ('9', '10', True),
+    ('10', '10', False),
+    ('11', '10', False),
+    ('', '10', False),
+    ('abc', '10', False),
+])
+def test_is_older(version, current, expected):
+    assert ResourceCache.is_older(make_obj('a', version), make_obj('a', current)) is expected
+
+def test_is_older_without_version():
+    assert not ResourceCache.is_older({'metadata': {'name': 'a'}}, make_obj('a', 1))
+    assert not ResourceCache.is_older(make_obj('a', 1), {})
+
+def test_set_skips_older_object(cache):
+    cache.set('a', make_obj('a', 10, role='admin'))
+    cache.set('a', make_obj('a', 9, role='viewer'))
+    assert cache.get('a')['spec'] == {'role': 'admin'}
+    assert len(cache.changes) == 1
+
+def test_set_notifies_old_and_new(cache):
+    first, second = make_obj('a', 1), make_obj('a', 2)
+    cache.set('a', first)
+    cache.set('a', second)
+    cache.set('a', None)
+    cache.set('a', None)
+    assert cache.changes == [(None, first), (first, second), (second, None)]
+
+def test_get_returns_copy(cache):
+    cache.set('a', make_obj('a', 1, role='admin'))
+    cache.get('a')['spec']['role'] = 'viewer'
+    assert cache.get('a')['spec'] == {'role': 'admin'}
+
+def test_store_requires_synced_cache(cache):
+    cache.store(make_obj('a', 1))
+    assert cache.get('a') is None
+    cache.synced.set()
+    cache.store(make_obj('a', 1))
+    assert cache.get('a') is not None
+
+def test_relist_replaces_items(cache):
+    cache.set('gone', make_obj('gone', 1))
+    cache.list_func = lambda **kwargs: Response({'metadata': {'resourceVersion': '7'}, 'items': [make_obj('a', 5)]})
+    cache.relist()
+    assert [obj['metadata']['name'] for obj in cache.list()] == ['a']
+    assert cache.resource_version == '7'
+    assert cache.synced.is_set()
+
+def test_watch_applies_events(monkeypatch, cache):
+    watch_events(monkeypatch, cache,
+                 ('ADDED', make_obj('a', 1)),
+                 ('MODIFIED', make_obj('a', 3, role='viewer')),
+                 ('MODIFIED', make_obj('a', 2, role='admin')),
+                 ('ADDED', make_obj('b', 4)),
+                 ('DELETED', make_obj('b', 5)))
+    assert cache.get('a')['spec'] == {'role': 'viewer'}
+    assert cache.get('b') is None
+    assert cache.resource_version == '5'
+
+def test_watch_keeps_recreated_object(monkeypatch, cache):
+    cache.set('a', make_obj('a', 8))
+    watch_events(monkeypatch, cache, ('DELETED', make_obj('a', 6)))
+    assert cache.get('a')['metadata']['resourceVersion'] == '8'
+
+def test_watch_error_event(monkeypatch, cache):
+    with pytest.raises(app.ApiException) as error:
+        watch_events(monkeypatch, cache, ('ERROR', {'code': 410, 'message': 'too old'}))
+    assert error.value.status == 410
@@ -0,0 +1,157 @@
+import threading
+
+import pytest
+from kubernetes.client.rest import ApiException
+
+from user_import import detect_format, import_users, parse_users, split_teams, validate_users
+
+CSV = """name,fullName,email,role,teams
+alice,Alice Smith,alice@example.com,developer,backend;frontend
+bob,Bob Jones,bob@example.com,,
+"""
+
+def make_row(name='alice', full_name='Alice Smith', email='alice@example.com', role='developer', teams=()):
+    return {'name': name, 'fullName': full_name, 'email': email, 'role': role, 'teams': list(teams)}
+
+def test_detect_format():
+    assert detect_format('users.yaml') == 'yaml'
+    assert detect_format('USERS.YML') == 'yaml'
+    assert detect_format('users.csv') == 'csv'
+    assert detect_format(None) == 'csv'
+
+def test_split_teams():
+    assert split_teams('a; b;;c ') == ['a', 'b', 'c']
+    assert split_teams(['a', ' b ', '']) == ['a', 'b']
+    assert split_teams(None) == []
+
+def test_parse_csv():
+    assert parse_users(CSV, 'csv') == [
+        make_row(teams=['backend', 'frontend']),
+        make_row('bob', 'Bob Jones', 'bob@example.com')
+    ]
+
+def test_parse_yaml_list_and_users_key():
+    content = """
+- name: alice
+  fullName: Alice Smith
+  email: alice@example.com
+  teams: [backend, frontend]
+"""
+    assert parse_users(content, 'yaml') == [make_row(teams=['backend', 'frontend'])]
+    assert parse_users("users:\n  - name: alice\n    teams: backend;frontend\n", 'yaml')[0]['teams'] == ['backend', 'frontend']
+
+def test_parse_yaml_user_resources():
+    content = """
+apiVersion: team.example.com/v1
+kind: User
+metadata:
+  name: alice
+spec:
+  fullName: Alice Smith
+  email: alice@example.com
+  role: viewer
+---
+apiVersion: team.example.com/v1
+kind: User
+metadata:
+  name: bob
+spec:
+  fullName: Bob Jones
+  email: bob@example.com
+  teams: [backend]
+"""
+    assert parse_users(content, 'yaml') == [
+        make_row(role='viewer'),
+        make_row('bob', 'Bob Jones', 'bob@example.com', teams=['backend'])
+    ]
+
+def test_parse_yaml_rejects_scalars():
+    with pytest.raises(ValueError):
+        parse_users("- alice\n- bob\n", 'yaml')
+
+def test_validate_users_accepts_valid_rows():
+    rows = [make_row(teams=['backend']), make_row('bob', email='bob@example.com', role='admin')]
+    assert validate_users(rows, known_teams={'backend'}, known_users={'carol'}) == []
+
+@pytest.mark.parametrize('row, message', [
+    (make_row(name=''), "не указано имя"),
+    (make_row(name='Alice'), "некорректное имя 'Alice'"),
+    (make_row(name='alice-'), "некорректное имя 'alice-'"),
+    (make_row(name='a' * 64), "некорректное имя"),
+    (make_row(full_name=''), "не указано полное имя"),
+    (make_row(email='alice'), "некорректный email 'alice'"),
+    (make_row(role='owner'), "некорректная роль 'owner'"),
+    (make_row(teams=['missing']), "команды не найдены: missing"),
+    (make_row(name='carol'), "пользователь carol уже существует"),
+])
+def test_validate_users_reports_errors(row, message):
+    invalid = validate_users([row], known_teams={'backend'}, known_users={'carol'})
+    assert len(invalid) == 1
+    assert invalid[0]['row'] == 1
+    assert any(error.startswith(message) for error in invalid[0]['errors'])
+
+def test_validate_users_reports_duplicates_and_all_errors():
+    rows = [make_row(), make_row(email='bad', role='owner')]
+    invalid = validate_users(rows)
+    assert [item['row'] for item in invalid] == [2]
+    assert invalid[0]['errors'] == [
+        "имя alice повторяется (строка 1)",
+        "некорректный email 'bad'",
+        "некорректная роль 'owner', допустимы: admin, developer, viewer"
+    ]
+
+def test_validate_users_skips_unknown_lookups():
+    assert validate_users([make_row(teams=['anything'])]) == []
+
+def test_import_users_creates_nothing_when_invalid():
+    created = []
+    content = CSV + "Bad Name,X,x@example.com,developer,\n"
+    ok, results = import_users(content, 'csv', created.append)
+    assert not ok
+    assert created == []
+    assert [(result['row'], result['status']) for result in results] == [(3, 'invalid')]
+
+def test_import_users_creates_all_rows():
+    created = []
+    lock = threading.Lock()
+
+    def create(user):
+        with lock:
+            created.append(user)
+
+    ok, results = import_users(CSV, 'csv', create, known_teams={'backend', 'frontend'})
+    assert ok
+    assert [result['status'] for result in results] == ['created', 'created']
+    assert sorted(user['metadata']['name'] for user in created) == ['alice', 'bob']
+    bob = next(user for user in created if user['metadata']['name'] == 'bob')
+    assert bob['spec'] == {'fullName': 'Bob Jones', 'email': 'bob@example.com', 'role': 'developer'}
+
+def test_import_users_reports_api_errors():
+    def create(user):
+        if user['metadata']['name'] == 'alice':
+            raise ApiException(status=409, reason='Conflict')
+        raise ApiException(status=500, reason='Internal Server Error')
+
+    ok, results = import_users(CSV, 'csv', create)
+    assert not ok
+    assert [result['status'] for result in results] == ['exists', 'error']
+    assert results[1]['message'] == '500 Internal Server Error'
+
+def test_import_users_dry_run():
+    created = []
+    ok, results = import_users(CSV, 'csv', created.append, dry_run=True)
+    assert ok
+    assert created == []
+    assert [result['status'] for result in results] == ['valid', 'valid']
+
+@pytest.mark.parametrize('content, fmt, message', [
+    ('', 'csv', "Файл не содержит пользователей"),
+    ('- [unclosed', 'yaml', "Не удалось разобрать файл"),
+    (CSV, 'csv', "Файл содержит 2 пользователей, за один импорт допустимо не более 1"),
+])
+def test_import_users_rejects_file(content, fmt, message):
+    ok, results = import_users(content, fmt, lambda user: None, max_rows=1)
+    assert not ok
+    assert len(results) == 1
+    assert results[0]['status'] == 'invalid'
+    assert results[0]['message'].startswith(message)
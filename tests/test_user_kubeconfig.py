@@ -0,0 +1,78 @@
+import pytest
+
+import user_kubeconfig
+from user_kubeconfig import KubeconfigCache
+
+class Clock:
+    """Управляемая замена time.monotonic"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(user_kubeconfig.time, 'monotonic', clock)
+    return clock
+
+def test_get_missing():
+    assert KubeconfigCache(60, 2).get('alice') is None
+
+def test_put_and_get(clock):
+    cache = KubeconfigCache(60, 2)
+    cache.put('alice', 'config-a')
+    assert cache.get('alice') == 'config-a'
+
+def test_entry_expires_after_ttl(clock):
+    cache = KubeconfigCache(60, 2)
+    cache.put('alice', 'config-a')
+    clock.now += 59
+    assert cache.get('alice') == 'config-a'
+    clock.now += 1
+    assert cache.get('alice') is None
+    assert 'alice' not in cache.items
+
+def test_entry_expires_with_token(clock):
+    cache = KubeconfigCache(60, 2)
+    cache.put('alice', 'config-a', lifetime=10)
+    cache.put('bob', 'config-b', lifetime=600)
+    clock.now += 30
+    assert cache.get('alice') is None
+    assert cache.get('bob') == 'config-b'
+    clock.now += 30
+    assert cache.get('bob') is None
+
+def test_evicts_least_recently_used(clock):
+    cache = KubeconfigCache(60, 2)
+    cache.put('alice', 'config-a')
+    cache.put('bob', 'config-b')
+    assert cache.get('alice') == 'config-a'
+    cache.put('carol', 'config-c')
+    assert cache.get('bob') is None
+    assert cache.get('alice') == 'config-a'
+    assert cache.get('carol') == 'config-c'
+
+def test_put_replaces_entry(clock):
+    cache = KubeconfigCache(60, 2)
+    cache.put('alice', 'old')
+    clock.now += 50
+    cache.put('alice', 'new')
+    clock.now += 50
+    assert cache.get('alice') == 'new'
+    assert len(cache.items) == 1
+
+def test_invalidate(clock):
+    cache = KubeconfigCache(60, 2)
+    cache.put('alice', 'config-a')
+    cache.invalidate('alice')
+    cache.invalidate('bob')
+    assert cache.get('alice') is None
+
+@pytest.mark.parametrize('ttl, max_size', [(0, 2), (60, 0)])
+def test_disabled(ttl, max_size):
+    cache = KubeconfigCache(ttl, max_size)
+    cache.put('alice', 'config-a')
+    assert cache.get('alice') is None
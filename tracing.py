@@ -0,0 +1,118 @@
+"""Трассировка обработки в стиле OpenTelemetry
+
+Каждый обработчик оператора и каждый HTTP-запрос веб-интерфейса
+оборачивается в корневой span, а запросы к API-серверу внутри него - в
+дочерние span с глаголом, ресурсом, namespace и кодом ответа. Завершенные
+span записываются в файл по одному JSON-объекту на строку с полями trace_id,
+span_id, parent_span_id, временем начала и окончания в наносекундах и
+атрибутами. Если файл не задан, трассировка отключена и span не создаются.
+"""
+
+import contextlib
+import contextvars
+import json
+import secrets
+import threading
+import time
+
+# Текущий span. Задачи asyncio и обработчики, запущенные внутри span, наследуют его как родительский
+current_span = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+    """Интервал обработки с атрибутами"""
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.status = 'OK'
+        self.start_time = time.time_ns()
+        self.end_time = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.status = 'ERROR'
+        self.attributes['error'] = f"{type(error).__name__}: {error}"
+
+    def to_dict(self, service):
+        return {
+            'service': service,
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_span_id,
+            'start_time_unix_nano': self.start_time,
+            'end_time_unix_nano': self.end_time,
+            'duration_ms': round((self.end_time - self.start_time) / 1e6, 3),
+            'status': self.status,
+            'attributes': self.attributes
+        }
+
+class NoopSpan:
+    """Span, который ничего не записывает (трассировка отключена)"""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, error):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+class Tracer:
+    """Создает span и записывает завершенные span в файл"""
+
+    def __init__(self, service, path=None):
+        self.service = service
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def start_span(self, name, root=True, **attributes):
+        """Открывает span и делает его текущим
+
+        Если root ложно, span создается только внутри уже открытого span.
+        Возвращает span и токен для end_span.
+        """
+        parent = current_span.get()
+        if not self.enabled or (parent is None and not root):
+            return NOOP_SPAN, None
+
+        span = Span(name, parent, attributes)
+        return span, current_span.set(span)
+
+    def end_span(self, span, token):
+        """Закрывает span, открытый start_span, и записывает его"""
+        if token is None:
+            return
+
+        current_span.reset(token)
+        span.end_time = time.time_ns()
+        self.export(span)
+
+    @contextlib.contextmanager
+    def span(self, name, root=True, **attributes):
+        """Контекст span; ошибка внутри контекста отмечается в span"""
+        span, token = self.start_span(name, root, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            self.end_span(span, token)
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(self.service), ensure_ascii=False, default=str)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8', buffering=1)
+            self.file.write(line + '\n')
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""Массовый импорт пользователей из CSV или YAML
+
+Файл проверяется целиком до создания первого пользователя: если хотя бы
+одна строка некорректна, ни один ресурс User не создается. Корректный
+пакет создается с ограниченным числом одновременных запросов, результат
+возвращается по каждой строке.
+
+CSV: колонки name, fullName, email, role, teams (команды через ";").
+YAML: список записей с теми же полями (teams - список или строка через ";"),
+список ресурсов User или словарь {"users": [...]}.
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import io
+import logging
+import re
+import sys
+
+import kubernetes
+import yaml
+from kubernetes.client.rest import ApiException
+
+# Определение группы, версии и типа ресурса
+GROUP = 'team.example.com'
+VERSION = 'v1'
+PLURAL_USERS = 'users'
+
+# Допустимые роли пользователей (как в crd.yaml)
+ROLES = ('admin', 'developer', 'viewer')
+
+# Имя пользователя входит в имена ServiceAccount, Secret и RoleBinding, поэтому ограничено меткой DNS
+NAME_RE = re.compile(r'^[a-z0-9]([-a-z0-9]*[a-z0-9])?$')
+NAME_MAX_LENGTH = 63
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+# Количество одновременных запросов на создание пользователей по умолчанию
+DEFAULT_CONCURRENCY = 8
+
+def detect_format(filename):
+    """Определяет формат файла по расширению"""
+    if filename and filename.lower().endswith(('.yaml', '.yml')):
+        return 'yaml'
+    return 'csv'
+
+def split_teams(teams):
+    """Приводит список команд к списку строк"""
+    if not teams:
+        return []
+    if isinstance(teams, str):
+        teams = teams.split(';')
+    return [str(team).strip() for team in teams if str(team).strip()]
+
+def normalize_row(entry):
+    """Приводит запись из CSV или YAML к полям спецификации User"""
+    if entry.get('kind') == 'User':
+        spec = entry.get('spec') or {}
+        entry = dict(spec, name=(entry.get('metadata') or {}).get('name'))
+
+    return {
+        'name': str(entry.get('name') or '').strip(),
+        'fullName': str(entry.get('fullName') or '').strip(),
+        'email': str(entry.get('email') or '').strip(),
+        'role': str(entry.get('role') or 'developer').strip(),
+        'teams': split_teams(entry.get('teams'))
+    }
+
+def parse_users(content, fmt):
+    """Разбирает содержимое файла импорта в список записей"""
+    if fmt == 'yaml':
+        documents = [doc for doc in yaml.safe_load_all(content) if doc is not None]
+        entries = []
+        for doc in documents:
+            if isinstance(doc, dict) and 'users' in doc:
+                entries.extend(doc['users'] or [])
+            elif isinstance(doc, list):
+                entries.extend(doc)
+            else:
+                entries.append(doc)
+        if not all(isinstance(entry, dict) for entry in entries):
+            raise ValueError("Каждая запись YAML должна быть словарем")
+    else:
+        entries = list(csv.DictReader(io.StringIO(content)))
+
+    return [normalize_row(entry) for entry in entries]
+
+def validate_users(rows, known_teams=None, known_users=None):
+    """Проверяет пакет пользователей
+
+    Возвращает список ошибок вида {'row': номер строки, 'name': имя, 'errors': [...]}
+    только для некорректных строк. Строки нумеруются с 1.
+    """
+    invalid = []
+    seen = {}
+    for number, row in enumerate(rows, start=1):
+        errors = []
+        name = row['name']
+
+        if not name:
+            errors.append("не указано имя")
+        elif len(name) > NAME_MAX_LENGTH or not NAME_RE.match(name):
+            errors.append(f"некорректное имя {name!r}: допустимы строчные буквы, цифры и дефисы, не более {NAME_MAX_LENGTH} символов")
+        elif name in seen:
+            errors.append(f"имя {name} повторяется (строка {seen[name]})")
+        elif known_users is not None and name in known_users:
+            errors.append(f"пользователь {name} уже существует")
+        seen.setdefault(name, number)
+
+        if not row['fullName']:
+            errors.append("не указано полное имя")
+        if not EMAIL_RE.match(row['email']):
+            errors.append(f"некорректный email {row['email']!r}")
+        if row['role'] not in ROLES:
+            errors.append(f"некорректная роль {row['role']!r}, допустимы: {', '.join(ROLES)}")
+        if known_teams is not None:
+            unknown = [team for team in row['teams'] if team not in known_teams]
+            if unknown:
+                errors.append(f"команды не найдены: {', '.join(unknown)}")
+
+        if errors:
+            invalid.append({'row': number, 'name': name, 'errors': errors})
+
+    return invalid
+
+def build_user(row):
+    """Формирует ресурс User из записи импорта"""
+    spec = {
+        'fullName': row['fullName'],
+        'email': row['email'],
+        'role': row['role']
+    }
+    if row['teams']:
+        spec['teams'] = row['teams']
+
+    return {
+        'apiVersion': f"{GROUP}/{VERSION}",
+        'kind': 'User',
+        'metadata': {
+            'name': row['name']
+        },
+        'spec': spec
+    }
+
+def create_users(rows, create_func, concurrency=DEFAULT_CONCURRENCY):
+    """Создает пользователей не более чем concurrency запросами одновременно
+
+    create_func принимает манифест User. Возвращает результаты в порядке строк.
+    """
+    def create(number, row):
+        try:
+            create_func(build_user(row))
+            return {'row': number, 'name': row['name'], 'status': 'created', 'message': ''}
+        except ApiException as e:
+            if e.status == 409:  # Уже существует
+                return {'row': number, 'name': row['name'], 'status': 'exists', 'message': 'пользователь уже существует'}
+            return {'row': number, 'name': row['name'], 'status': 'error', 'message': f"{e.status} {e.reason}"}
+        except Exception as e:
+            return {'row': number, 'name': row['name'], 'status': 'error', 'message': str(e)}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        return list(pool.map(create, range(1, len(rows) + 1), rows))
+
+def import_users(content, fmt, create_func, known_teams=None, known_users=None,
+                 concurrency=DEFAULT_CONCURRENCY, dry_run=False, max_rows=None):
+    """Разбирает, проверяет и создает пакет пользователей
+
+    Возвращает пару (успех, результаты по строкам). При ошибках проверки
+    пользователи не создаются, а результаты содержат только некорректные строки.
+    Пакет больше max_rows записей не создается целиком.
+    """
+    try:
+        rows = parse_users(content, fmt)
+    except (ValueError, yaml.YAMLError, csv.Error) as e:
+        return False, [{'row': None, 'name': '', 'status': 'invalid', 'message': f"Не удалось разобрать файл: {e}"}]
+
+    if not rows:
+        return False, [{'row': None, 'name': '', 'status': 'invalid', 'message': "Файл не содержит пользователей"}]
+
+    if max_rows is not None and len(rows) > max_rows:
+        return False, [{'row': None, 'name': '', 'status': 'invalid',
+                        'message': f"Файл содержит {len(rows)} пользователей, за один импорт допустимо не более {max_rows}"}]
+
+    invalid = validate_users(rows, known_teams, known_users)
+    if invalid:
+        return False, [
+            {'row': item['row'], 'name': item['name'], 'status': 'invalid', 'message': '; '.join(item['errors'])}
+            for item in invalid
+        ]
+
+    if dry_run:
+        return True, [
+            {'row': number, 'name': row['name'], 'status': 'valid', 'message': ''}
+            for number, row in enumerate(rows, start=1)
+        ]
+
+    results = create_users(rows, create_func, concurrency)
+    return all(result['status'] == 'created' for result in results), results
+
+def main():
+    """Импорт пользователей из командной строки"""
+    parser = argparse.ArgumentParser(description='Массовый импорт пользователей из CSV или YAML')
+    parser.add_argument('file', help='Файл с пользователями (CSV или YAML, "-" - стандартный ввод)')
+    parser.add_argument('--format', choices=['csv', 'yaml'], help='Формат файла (по умолчанию - по расширению)')
+    parser.add_argument('--kubeconfig', help='Путь к файлу kubeconfig')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Количество одновременных запросов на создание пользователей')
+    parser.add_argument('--dry-run', action='store_true', help='Только проверить файл, не создавая пользователей')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.file == '-':
+        content = sys.stdin.read()
+    else:
+        with open(args.file, encoding='utf-8') as f:
+            content = f.read()
+
+    # Загружаем конфигурацию Kubernetes
+    if args.kubeconfig:
+        kubernetes.config.load_kube_config(config_file=args.kubeconfig)
+    else:
+        try:
+            kubernetes.config.load_incluster_config()
+        except kubernetes.config.config_exception.ConfigException:
+            kubernetes.config.load_kube_config()
+
+    custom_api = kubernetes.client.CustomObjectsApi()
+
+    def create_func(user):
+        return custom_api.create_cluster_custom_object(group=GROUP, version=VERSION, plural=PLURAL_USERS, body=user)
+
+    # Существующие команды и пользователи для проверки пакета
+    teams = custom_api.list_cluster_custom_object(group=GROUP, version=VERSION, plural='teams')
+    users = custom_api.list_cluster_custom_object(group=GROUP, version=VERSION, plural=PLURAL_USERS)
+    known_teams = {team['metadata']['name'] for team in teams.get('items', [])}
+    known_users = {user['metadata']['name'] for user in users.get('items', [])}
+
+    ok, results = import_users(
+        content, args.format or detect_format(args.file), create_func,
+        known_teams=known_teams, known_users=known_users,
+        concurrency=args.concurrency, dry_run=args.dry_run
+    )
+
+    for result in results:
+        row = result['row'] if result['row'] is not None else '-'
+        print(f"{row}\t{result['name']}\t{result['status']}\t{result['message']}")
+
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
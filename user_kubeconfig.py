@@ -0,0 +1,126 @@
+"""Формирование kubeconfig пользователей
+
+Используется оператором (kubeconfig в ConfigMap) и веб-интерфейсом
+(kubeconfig, формируемый при скачивании). В режиме configmap оператор
+хранит kubeconfig каждого пользователя в ConfigMap, в режиме on-demand
+ничего не хранится: веб-интерфейс запрашивает свежий токен при скачивании и
+держит готовый kubeconfig в небольшом LRU-кеше с ограниченным временем жизни.
+"""
+
+import base64
+import collections
+import threading
+import time
+
+# Режимы выдачи kubeconfig пользователям
+KUBECONFIG_MODES = ('configmap', 'on-demand')
+
+# Параметры подключения к кластеру, которые попадают в kubeconfig пользователей
+ClusterInfo = collections.namedtuple('ClusterInfo', ['name', 'server', 'certificate_authority_data', 'verify_ssl'])
+
+def make_cluster_info(name, configuration):
+    """Формирует параметры подключения к кластеру из конфигурации клиента Kubernetes"""
+    # Загрузчики конфигурации сохраняют CA-сертификат во временный файл
+    certificate_authority_data = None
+    if configuration.ssl_ca_cert:
+        with open(configuration.ssl_ca_cert, 'rb') as f:
+            certificate_authority_data = base64.b64encode(f.read()).decode()
+
+    return ClusterInfo(
+        name=name,
+        server=configuration.host,
+        certificate_authority_data=certificate_authority_data,
+        verify_ssl=configuration.verify_ssl
+    )
+
+def render_kubeconfig(name, token, cluster_info):
+    """Формирует kubeconfig пользователя"""
+    cluster = {'server': cluster_info.server}
+    if cluster_info.certificate_authority_data:
+        cluster['certificate-authority-data'] = cluster_info.certificate_authority_data
+    elif not cluster_info.verify_ssl:
+        # Если используется небезопасное соединение, добавляем insecure-skip-tls-verify
+        cluster['insecure-skip-tls-verify'] = True
+
+    return {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "current-context": name,
+        "clusters": [
+            {
+                "name": cluster_info.name,
+                "cluster": cluster
+            }
+        ],
+        "users": [
+            {
+                "name": name,
+                "user": {
+                    "token": token
+                }
+            }
+        ],
+        "contexts": [
+            {
+                "name": name,
+                "context": {
+                    "cluster": cluster_info.name,
+                    "user": name
+                }
+            }
+        ]
+    }
+
+def render_token_request(expiration_seconds):
+    """Формирует тело запроса токена ServiceAccount (TokenRequest)"""
+    return {
+        'apiVersion': 'authentication.k8s.io/v1',
+        'kind': 'TokenRequest',
+        'spec': {'expirationSeconds': expiration_seconds}
+    }
+
+class KubeconfigCache:
+    """LRU-кеш kubeconfig пользователей с ограниченным временем жизни записей
+
+    Запись живет не дольше ttl секунд и не дольше, чем действует токен в ней.
+    При переполнении вытесняется запись, которая дольше всех не
+    использовалась. При ttl <= 0 или max_size <= 0 кеш отключен.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """Возвращает kubeconfig пользователя или None, если его нет или он устарел"""
+        with self.lock:
+            entry = self.items.get(name)
+            if entry is None:
+                return None
+
+            kubeconfig, expires = entry
+            if expires <= time.monotonic():
+                del self.items[name]
+                return None
+
+            self.items.move_to_end(name)
+            return kubeconfig
+
+    def put(self, name, kubeconfig, lifetime=None):
+        """Сохраняет kubeconfig пользователя не дольше чем на lifetime секунд"""
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+
+        lifetime = self.ttl if lifetime is None else min(self.ttl, lifetime)
+        with self.lock:
+            self.items[name] = (kubeconfig, time.monotonic() + lifetime)
+            self.items.move_to_end(name)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def invalidate(self, name):
+        """Удаляет kubeconfig пользователя из кеша"""
+        with self.lock:
+            self.items.pop(name, None)